@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Benchmark rendering the full email set of one order against a mongod
+
+Renders every email of an order's life (creation to shipment, plus failure)
+including the shipping document PDF (needs wkhtmltopdf), without sending
+them. Compares cold runs (QR codes, dashboard entries and shipping documents
+caches emptied before each set) with warm ones. Uses a throwaway database
+(dropped afterwards) on MONGODB_URI's server.
+
+    MONGODB_URI=mongodb://localhost python contrib/email_render_benchmark.py \
+        --rounds 5 """
+
+import argparse
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+SRC_DIR = pathlib.Path(__file__).parent.parent / "scheduler" / "src"
+sys.path.insert(0, str(SRC_DIR))
+os.environ.setdefault("SHIPPING_CACHE_DIR", tempfile.mkdtemp(prefix="shipping_"))
+import emailing  # noqa: E402
+from utils import mongo, templates  # noqa: E402
+
+DBNAME = "Cardshop_benchmark"
+CONFIG_YAML = """files:
+- to: /data/contents/dashboard.yaml
+  content: |
+    packages:
+""" + "".join(
+    f"    - {{title: Package {index}, description: Description {index}}}\n"
+    for index in range(50)
+)
+
+
+def prepare():
+    """an order with its tasks and operator. returns (order_id, writer_id)"""
+    mongo.Users().insert_one(
+        {"username": "operator", "email": "operator@example.com", "role": "writer"}
+    )
+    mongo.Channels().insert_one(
+        {
+            "slug": "kiwix",
+            "sender_name": "Kiwix",
+            "sender_address": "Some street\nSome city",
+            "sender_email": "shop@example.com",
+        }
+    )
+    person = {"name": "Someone", "email": "someone@example.com", "language": "en"}
+    order_id = (
+        mongo.Orders()
+        .insert_one(
+            {
+                "channel": "kiwix",
+                "quantity": 1,
+                "units": 1,
+                "fname": "benchmark.img",
+                "client": person,
+                "recipient": {
+                    **person,
+                    "phone": "+123456",
+                    "address": "Other street\nOther city",
+                    "country": "fr",
+                },
+                "sd_card": {"name": "64GB", "type": "sd", "size": 64, "duration": 30},
+                "warehouse": {"download_uri": "https+torrent://download.example.com/"},
+                "config": {
+                    "name": "Benchmark",
+                    "project_name": "benchmark",
+                    "language": "en",
+                    "timezone": "UTC",
+                    "size": "64GB",
+                    "wifi_password": None,
+                    "admin_account": {"login": "admin", "password": "admin"},
+                    "branding": {},
+                    "content": {
+                        "zims": [f"package_{index}" for index in range(50)],
+                        "kalite": ["fr"],
+                        "wikifundi": [],
+                        "edupi": False,
+                    },
+                },
+                "config_yaml": CONFIG_YAML,
+                "status": "pending_shipment",
+                "statuses": [{"status": "created", "on": None, "payload": None}],
+                "tasks": {},
+                "logs": [],
+            }
+        )
+        .inserted_id
+    )
+    task = {"order": order_id, "status": "written", "statuses": [], "logs": {}}
+    tasks = {
+        "create": mongo.CreatorTasks().insert_one(dict(task)).inserted_id,
+        "download": mongo.DownloaderTasks()
+        .insert_one({**task, "worker": "operator"})
+        .inserted_id,
+        "write": [
+            mongo.WriterTasks()
+            .insert_one({**task, "worker": "operator", "slot": "0"})
+            .inserted_id
+        ],
+    }
+    mongo.Orders().update_one({"_id": order_id}, {"$set": {"tasks": tasks}})
+    return order_id, tasks["write"][0]
+
+
+def render_all(order_id, writer_id):
+    emailing.send_order_created_email(order_id)
+    emailing.send_image_uploaded_email(order_id)
+    emailing.send_image_uploaded_public_email(order_id)
+    emailing.send_insert_card_email(order_id, writer_id)
+    emailing.send_image_writing_email(order_id, writer_id)
+    emailing.send_image_written_email(order_id, writer_id)
+    emailing.send_order_pending_shipment_email(order_id)
+    emailing.send_order_shipped_email(order_id)
+    emailing.send_order_failed_email(order_id)
+
+
+def clear_caches():
+    templates.b64qrcode.cache_clear()
+    emailing.DASHBOARD_ENTRIES.clear()
+    shutil.rmtree(emailing.SHIPPING_CACHE_DIR, ignore_errors=True)
+
+
+def timed(order_id, writer_id, rounds, cold):
+    durations = []
+    for _ in range(rounds):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        render_all(order_id, writer_id)
+        durations.append(time.perf_counter() - start)
+    return sum(durations) / len(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=5, help="email sets per run")
+    args = parser.parse_args()
+
+    os.environ["MONGODB_DBNAME"] = DBNAME
+    os.chdir(SRC_DIR)  # templates are loaded from there
+    client = mongo.Client()
+    print(f"using {DBNAME} on {os.getenv('MONGODB_URI', 'mongo')}")
+
+    sent = []
+    emailing.send_email = lambda **kwargs: sent.append(kwargs["subject"])
+    try:
+        client.drop_database(DBNAME)
+        mongo.create_indexes()
+        order_id, writer_id = prepare()
+
+        render_all(order_id, writer_id)  # warm-up (imports, templates)
+        print(f"{len(sent)} emails per set", flush=True)
+
+        cold = timed(order_id, writer_id, args.rounds, cold=True)
+        warm = timed(order_id, writer_id, args.rounds, cold=False)
+        print(
+            f"cold {cold * 1000:>8.1f}ms  warm {warm * 1000:>8.1f}ms  "
+            f"(x{cold / warm:.1f})",
+            flush=True,
+        )
+    finally:
+        client.drop_database(DBNAME)
+        shutil.rmtree(emailing.SHIPPING_CACHE_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Benchmark worker's image hashing (checksum, S3 ETag and torrent pieces)
+
+Creates a synthetic sparse image (mostly holes with a few data extents, like
+a built image) and compares torf's Torrent.generate() with worker's
+single-pass ImageDigests using one then several threads.
+
+    python contrib/hashing_benchmark.py --size 20GiB --threads 1,4,8 """
+
+import argparse
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+import humanfriendly
+import torf
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "workers" / "worker"))
+from utils.digest import ImageDigests  # noqa: E402
+from utils.s3 import get_part_size  # noqa: E402
+
+
+def make_sparse_file(size, data_ratio, directory=None):
+    """sparse file of size bytes with data_ratio of it being random data"""
+    fpath = pathlib.Path(tempfile.mkstemp(suffix=".img", dir=directory)[1])
+    block = os.urandom(2**20)
+    nb_extents = 16
+    extent_size = int(size * data_ratio / nb_extents)
+    with open(fpath, "wb") as fh:
+        fh.truncate(size)
+        for index in range(nb_extents):
+            fh.seek(index * (size // nb_extents))
+            for _ in range(extent_size // len(block)):
+                fh.write(block)
+    return fpath
+
+
+def report(name, size, duration):
+    rate = humanfriendly.format_size(size / duration, binary=True)
+    print(f"{name:<40} {duration:>8.2f}s {rate:>12}/s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", default="10GiB", help="size of test image")
+    parser.add_argument("--data", default=0.1, type=float, help="non-hole ratio")
+    parser.add_argument("--threads", default=f"1,{os.cpu_count()}", help="counts")
+    parser.add_argument("--dir", help="where to create image (tmp by default)")
+    parser.add_argument("--skip-torf", action="store_true", help="skip torf")
+    args = parser.parse_args()
+
+    size = humanfriendly.parse_size(args.size)
+    fpath = make_sparse_file(size, args.data, args.dir)
+    piece_size = torf.Torrent.calculate_piece_size(size)
+    part_size = get_part_size(size)
+    print(
+        f"hashing {humanfriendly.format_size(size, binary=True)} sparse image "
+        f"({fpath.stat().st_blocks * 512 / size:.0%} allocated), "
+        f"pieces of {humanfriendly.format_size(piece_size, binary=True)}"
+    )
+
+    try:
+        pieces = None
+        if not args.skip_torf:
+            torrent = torf.Torrent(path=fpath)
+            start = time.perf_counter()
+            torrent.generate()
+            report(
+                "torf Torrent.generate() (pieces only)",
+                size,
+                time.perf_counter() - start,
+            )
+            pieces = torrent.metainfo["info"]["pieces"]
+
+        for threads in args.threads.split(","):
+            start = time.perf_counter()
+            digests = ImageDigests(
+                fpath,
+                piece_size=piece_size,
+                part_size=part_size,
+                multipart_threshold=part_size,
+                threads=int(threads),
+            ).compute()
+            report(
+                f"ImageDigests x{threads} (md5, etag, pieces)",
+                size,
+                time.perf_counter() - start,
+            )
+            if pieces and b"".join(digests.pieces) != pieces:
+                print("  pieces differ from torf's!")
+    finally:
+        fpath.unlink()
+
+
+if __name__ == "__main__":
+    main()
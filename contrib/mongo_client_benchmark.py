@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Benchmark scheduler's Mongo client reuse against a mongod
+
+Replays the queries of a task status update (PATCH /tasks/<type>/<id>/status)
+with a new MongoClient per collection access (former behavior) and with the
+process-wide client. Reports per-request latency, memory and threads of each
+run, made in its own process. Uses a throwaway database (dropped afterwards)
+on MONGODB_URI's server.
+
+    MONGODB_URI=mongodb://localhost python contrib/mongo_client_benchmark.py \
+        --requests 200 """
+
+import argparse
+import gc
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "scheduler" / "src"))
+from utils import mongo  # noqa: E402
+
+DBNAME = "Cardshop_benchmark"
+
+
+def get_rss():
+    """resident memory of this process, in bytes (linux)"""
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def prepare():
+    mongo.Users().insert_one({"username": "creator", "role": "creator"})
+    order_id = (
+        mongo.Orders()
+        .insert_one({"status": "creating", "statuses": [], "tasks": {}, "logs": []})
+        .inserted_id
+    )
+    task_id = (
+        mongo.CreatorTasks()
+        .insert_one(
+            {"order": order_id, "status": "received", "statuses": [], "logs": {}}
+        )
+        .inserted_id
+    )
+    mongo.Orders().update_one(
+        {"_id": order_id}, {"$set": {"tasks": {"create": task_id}}}
+    )
+    return task_id
+
+
+def status_request(task_id, index):
+    """queries of a status update request"""
+    mongo.Users.by_username("creator")
+    status = "building" if index % 2 else "received"
+    task = mongo.CreatorTasks.update_status(task_id, status=status)
+    mongo.CreatorTasks.cascade_status(task_id, status, task=task)
+    mongo.Orders.get_with_tasks(task["order"])
+
+
+def run(mode, nb_requests):
+    if mode == "per-call":
+        mongo.get_client = mongo.Client
+
+    task_id = prepare()
+    status_request(task_id, 0)  # warm-up (imports, first connection)
+    gc.collect()
+    rss = get_rss()
+
+    durations = []
+    for index in range(nb_requests):
+        start = time.perf_counter()
+        status_request(task_id, index)
+        durations.append(time.perf_counter() - start)
+    gc.collect()
+
+    print(
+        f"{mode:<10} "
+        f"mean {statistics.mean(durations) * 1000:>7.2f}ms  "
+        f"p95 {sorted(durations)[int(len(durations) * 0.95)] * 1000:>7.2f}ms  "
+        f"RSS +{(get_rss() - rss) / 2**20:>6.1f}MiB  "
+        f"threads {threading.active_count():>4}",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200, help="per run")
+    parser.add_argument("--mode", choices=["per-call", "shared"], help="run only")
+    args = parser.parse_args()
+
+    os.environ["MONGODB_DBNAME"] = DBNAME
+    if args.mode:
+        return run(args.mode, args.requests)
+
+    print(f"using {DBNAME} on {os.getenv('MONGODB_URI', 'mongo')}")
+    client = mongo.Client()
+    try:
+        for mode in ("per-call", "shared"):
+            client.drop_database(DBNAME)
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--mode",
+                    mode,
+                    "--requests",
+                    str(args.requests),
+                ],
+                check=True,
+            )
+    finally:
+        client.drop_database(DBNAME)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Benchmark scheduler's Orders.get_with_tasks against a mongod
+
+Compares the single $lookup aggregation with the former one-query-per-task
+retrieval, on orders with many writer tasks. Uses a throwaway database
+(dropped afterwards) on MONGODB_URI's server.
+
+    MONGODB_URI=mongodb://localhost python contrib/order_tasks_benchmark.py \
+        --orders 50 --writers 10,20 --rounds 5 """
+
+import argparse
+import os
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "scheduler" / "src"))
+from utils import mongo  # noqa: E402
+
+DBNAME = "Cardshop_benchmark"
+
+
+def legacy_get_with_tasks(order_id, with_logs=False):
+    """order then each of its task, as was done before the aggregation"""
+    order = mongo.Orders.get(order_id, with_logs=with_logs)
+    order = mongo.Orders.get(order_id, with_logs=with_logs)  # read by get_tasks
+    order["tasks"].update(
+        {
+            "create": mongo.CreatorTasks.get(
+                order["tasks"].get("create"), with_logs=with_logs
+            ),
+            "download": mongo.DownloaderTasks.get(
+                order["tasks"].get("download"), with_logs=with_logs
+            ),
+            "write": [
+                mongo.WriterTasks.get(task, with_logs=with_logs)
+                for task in order["tasks"].get("write", [])
+            ],
+        }
+    )
+    return order
+
+
+def make_task(order_id):
+    return {
+        "order": order_id,
+        "status": "written",
+        "statuses": [{"status": "received", "on": None, "payload": None}] * 10,
+        "logs": {"worker": "x" * 2**14},
+    }
+
+
+def make_orders(nb_orders, nb_writers):
+    order_ids = []
+    for _ in range(nb_orders):
+        order_id = mongo.Orders().insert_one({"logs": [], "tasks": {}}).inserted_id
+        tasks = {
+            "create": mongo.CreatorTasks().insert_one(make_task(order_id)),
+            "download": mongo.DownloaderTasks().insert_one(make_task(order_id)),
+            "write": mongo.WriterTasks().insert_many(
+                [make_task(order_id) for _ in range(nb_writers)]
+            ),
+        }
+        mongo.Orders().update_one(
+            {"_id": order_id},
+            {
+                "$set": {
+                    "tasks": {
+                        "create": tasks["create"].inserted_id,
+                        "download": tasks["download"].inserted_id,
+                        "write": tasks["write"].inserted_ids,
+                    }
+                }
+            },
+        )
+        order_ids.append(order_id)
+    return order_ids
+
+
+def timed(func, order_ids, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for order_id in order_ids:
+            func(order_id)
+    return (time.perf_counter() - start) / (rounds * len(order_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=50, help="orders per run")
+    parser.add_argument("--writers", default="10,20", help="writer tasks per order")
+    parser.add_argument("--rounds", type=int, default=5, help="reads of each order")
+    args = parser.parse_args()
+
+    os.environ["MONGODB_DBNAME"] = DBNAME
+    client = mongo.Client()
+    print(f"using {DBNAME} on {os.getenv('MONGODB_URI', 'mongo')}")
+
+    try:
+        for nb_writers in [int(value) for value in args.writers.split(",")]:
+            client.drop_database(DBNAME)
+            mongo.create_indexes()
+            order_ids = make_orders(args.orders, nb_writers)
+
+            # same documents either way
+            for order_id in order_ids[:3]:
+                assert legacy_get_with_tasks(order_id) == mongo.Orders.get_with_tasks(
+                    order_id
+                )
+
+            legacy = timed(legacy_get_with_tasks, order_ids, args.rounds)
+            aggregated = timed(mongo.Orders.get_with_tasks, order_ids, args.rounds)
+            print(
+                f"{nb_writers:>3} writers: "
+                f"per-task queries {legacy * 1000:>7.2f}ms  "
+                f"$lookup {aggregated * 1000:>7.2f}ms  "
+                f"(x{legacy / aggregated:.1f})",
+                flush=True,
+            )
+    finally:
+        client.drop_database(DBNAME)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Benchmark worker's S3 image upload against a local S3 stand-in
+
+Compares KiwixStorage.upload_file defaults with worker's MultipartUploader for
+several part sizes and concurrency levels, and measures an interrupted then
+resumed upload.
+
+Uses a moto server (pip install "moto[server]") unless --url points to an
+S3-compatible endpoint such as MinIO, as a KiwixStorage URL:
+http://host:port/?keyId=xxx&secretAccessKey=xxx&bucketName=xxx
+
+    python contrib/s3_upload_benchmark.py --size 1GiB --parts 8MiB,64MiB \
+        --concurrency 1,4,10 """
+
+import argparse
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import humanfriendly
+from kiwixstorage import KiwixStorage
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "workers" / "worker"))
+from utils.digest import ImageDigests  # noqa: E402
+from utils.s3 import MultipartUploader, UploadInterrupted  # noqa: E402
+
+BUCKET_NAME = "benchmark"
+
+
+def start_moto():
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    qs = {
+        "keyId": "testing",
+        "secretAccessKey": "testing",
+        "bucketName": BUCKET_NAME,
+    }
+    return server, f"http://{host}:{port}/?{urllib.parse.urlencode(qs)}"
+
+
+def get_storage(url):
+    s3_storage = KiwixStorage(url)
+    if not s3_storage.bucket_name:
+        raise ValueError("URL must include a bucketName")
+    try:
+        s3_storage.client.create_bucket(Bucket=s3_storage.bucket_name)
+    except Exception:
+        pass  # already exists
+    return s3_storage
+
+
+def make_file(size):
+    fpath = pathlib.Path(tempfile.mkstemp(suffix=".img")[1])
+    with open(fpath, "wb") as fh:
+        block = os.urandom(2**20)
+        for _ in range(size // len(block)):
+            fh.write(block)
+        fh.write(block[: size % len(block)])
+    return fpath
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def report(name, size, duration, etag=""):
+    rate = humanfriendly.format_size(size / duration, binary=True)
+    print(f"{name:<40} {duration:>8.2f}s {rate:>12}/s {etag}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="KiwixStorage URL (moto if unset)")
+    parser.add_argument("--size", default="256MiB", help="size of test image")
+    parser.add_argument("--parts", default="8MiB,32MiB", help="part sizes")
+    parser.add_argument("--concurrency", default="1,4,10", help="threads counts")
+    parser.add_argument("--bandwidth", default="0", help="cap in bytes/s")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server, url = start_moto()
+
+    size = humanfriendly.parse_size(args.size)
+    bandwidth = humanfriendly.parse_size(args.bandwidth)
+    fpath = make_file(size)
+    state_path = fpath.with_suffix(".upload.json")
+    s3_storage = get_storage(url)
+    print(f"uploading {humanfriendly.format_size(size, binary=True)} to {url}")
+
+    try:
+        duration, _ = timed(
+            lambda: s3_storage.upload_file(fpath=str(fpath), key=fpath.name)
+        )
+        report("KiwixStorage.upload_file (defaults)", size, duration)
+
+        for part_size in args.parts.split(","):
+            expected = ImageDigests(
+                fpath,
+                piece_size=2**20,
+                part_size=humanfriendly.parse_size(part_size),
+                multipart_threshold=humanfriendly.parse_size(part_size),
+            ).compute()
+            for concurrency in args.concurrency.split(","):
+                uploader = MultipartUploader(
+                    s3_storage,
+                    fpath,
+                    fpath.name,
+                    state_path,
+                    part_size=humanfriendly.parse_size(part_size),
+                    concurrency=int(concurrency),
+                    bandwidth=bandwidth,
+                )
+                duration, etag = timed(uploader.upload)
+                report(
+                    f"MultipartUploader {part_size} x{concurrency}",
+                    size,
+                    duration,
+                    "(etag OK)" if etag == expected.etag else f"(etag {etag}!)",
+                )
+
+        # interrupt after half the parts then resume with a new uploader
+        part_size = humanfriendly.parse_size(args.parts.split(",")[0])
+        concurrencies = [int(value) for value in args.concurrency.split(",")]
+        uploaded = [0]
+
+        def count(amount):
+            uploaded[0] += amount
+
+        uploader = MultipartUploader(
+            s3_storage,
+            fpath,
+            fpath.name,
+            state_path,
+            part_size=part_size,
+            concurrency=min(concurrencies),
+            callback=count,
+            should_stop=lambda: uploaded[0] >= size // 2,
+        )
+        try:
+            uploader.upload()
+        except UploadInterrupted:
+            pass
+        print(f"interrupted after {len(uploader.parts)}/{uploader.nb_parts} parts")
+        uploader = MultipartUploader(
+            s3_storage,
+            fpath,
+            fpath.name,
+            state_path,
+            part_size=part_size,
+            concurrency=max(concurrencies),
+        )
+        duration, etag = timed(uploader.upload)
+        report("MultipartUploader resumed", size - uploaded[0], duration, etag)
+    finally:
+        fpath.unlink()
+        state_path.unlink(missing_ok=True)
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
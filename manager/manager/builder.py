@@ -1,8 +1,10 @@
+import collections
 from dataclasses import dataclass, field
 
 from django.conf import settings
 from offspot_config.builder import (
     BRANDING_PATH,
+    KIWIX_ZIM_LOAD_BALANCER_URL,
     AppPackage,
     ConfigBuilder,
     FilesPackage,
@@ -18,6 +20,8 @@ from manager.kiwix_library import catalog
 from manager.models import Configuration
 from manager.utils import retrieve_branding_file
 
+KIWIX_ZIM_MIRROR = "https://mirror.download.kiwix.org/zim/"
+
 
 @dataclass
 class ConfigLike:
@@ -119,7 +123,7 @@ def prepare_builder_for(config: Configuration | ConfigLike) -> ConfigBuilder:
             "ADMIN_PASSWORD": str(config.admin_password),
         },
         write_config=True,
-        kiwix_zim_mirror="https://mirror.download.kiwix.org/zim/",
+        kiwix_zim_mirror=KIWIX_ZIM_MIRROR,
     )
 
     # add branding
@@ -221,3 +225,62 @@ def prepare_builder_for(config: Configuration | ConfigLike) -> ConfigBuilder:
     #     builder.config["image-creator"] = {"version": "1.1.0"}
 
     return builder
+
+
+def get_popular_content(limit: int = 50) -> list[dict]:
+    """most used ZIMs, package files and OCI images across configurations
+
+    items are {kind, ident, url, size, count} with url as it appears in
+    built configs (so creators can match it), most used first"""
+    zims: collections.Counter = collections.Counter()
+    packages: collections.Counter = collections.Counter()
+    for content_zims, content_packages in Configuration.objects.values_list(
+        "content_zims", "content_packages"
+    ):
+        zims.update(content_zims or [])
+        packages.update(content_packages or [])
+
+    items = []
+    for ident, count in zims.items():
+        book = catalog.get_or_none(ident)
+        if book is None:
+            continue
+        url = book.url
+        if url.startswith(KIWIX_ZIM_LOAD_BALANCER_URL):
+            url = f"{KIWIX_ZIM_MIRROR}{url[len(KIWIX_ZIM_LOAD_BALANCER_URL):]}"
+        items.append(
+            {
+                "kind": "file",
+                "ident": ident,
+                "url": url,
+                "size": book.size,
+                "count": count,
+            }
+        )
+
+    for ident, count in packages.items():
+        package = app_catalog.get(ident)
+        if isinstance(package, AppPackage):
+            image = package.oci_image
+            items.append(
+                {
+                    "kind": "image",
+                    "ident": str(image),
+                    "url": image.url,
+                    "size": image.filesize,
+                    "count": count,
+                }
+            )
+        if getattr(package, "download_url", None):
+            items.append(
+                {
+                    "kind": "file",
+                    "ident": ident,
+                    "url": package.download_url,
+                    "size": package.get_download_size(),
+                    "count": count,
+                }
+            )
+
+    items.sort(key=lambda item: item["count"], reverse=True)
+    return items[:limit]
@@ -5,7 +5,9 @@ import logging
 
 from django.core.management.base import BaseCommand
 
+from manager.builder import get_popular_content
 from manager.models import Order, Profile
+from manager.scheduler import set_popular_content
 
 logger = logging.getLogger(__name__)
 
@@ -30,4 +32,9 @@ class Command(BaseCommand):
             profile.expire_on = None
             profile.save()
 
+        logger.info("publishing popular content for creators' cache...")
+        success, response = set_popular_content(get_popular_content())
+        if not success:
+            logger.error(f"  failed to publish popular content: {response}")
+
         logger.info(">done")
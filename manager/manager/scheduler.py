@@ -24,6 +24,7 @@ ROLES = {
 }
 logger = logging.getLogger(__name__)
 
+
 class Tokens:
     access = ""
     access_expiry = datetime.datetime(1970, 1, 1)
@@ -289,12 +290,13 @@ def get_warehouse_from(warehouse_slug):
 
 
 @auth_required
-def add_warehouse(slug, upload_uri, download_uri, *, active=True):
+def add_warehouse(slug, upload_uri, download_uri, *, active=True, compression=None):
     payload = {
         "slug": slug,
         "upload_uri": upload_uri,
         "download_uri": download_uri,
         "active": active,
+        "compression": compression,
     }
 
     success, code, response = query_api(POST, "/warehouses/", payload=payload)
@@ -325,6 +327,14 @@ def disable_warehouse(warehouse_id):
     return change_warehouse_status(warehouse_id, False)
 
 
+@auth_required
+def set_popular_content(items):
+    success, code, response = query_api(
+        PUT, "/workers/popular-content", payload={"items": items}
+    )
+    return success, response
+
+
 @auth_required
 def get_orders_list():
     success, code, response = query_api(GET, "/orders/")
@@ -386,6 +396,17 @@ def get_task(task_id):
     return success, response
 
 
+@auth_required
+def get_task_log(task_type, task_id, kind, offset=0, size=None):
+    params = {"offset": offset}
+    if size is not None:
+        params["size"] = size
+    success, code, response = query_api(
+        GET, f"/tasks/{task_type}/{task_id}/logs/{kind}", params=params
+    )
+    return success, response
+
+
 def get_channel_choices():
     from manager.scheduler import as_items_or_none, get_channels_list
 
@@ -2,11 +2,11 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import logging
+from urllib.parse import urlencode
 
 from ansi2html import Ansi2HTMLConverter
 from django.conf import settings
 from django.contrib import messages
-from django.core.paginator import Paginator
 from django.http import Http404, HttpResponse
 from django.shortcuts import redirect, render
 from django.utils.translation import gettext as _
@@ -14,16 +14,48 @@ from django.utils.translation import gettext as _
 from manager.decorators import staff_required
 from manager.models import Order, OrderData
 from manager.scheduler import (
+    GET,
     delete_order,
     get_order,
+    get_task_log,
+    query_api,
     test_connection,
 )
 from manager.views.common import APIQuerySet
 
 logger = logging.getLogger(__name__)
+TASK_TYPES = {"create": "creator", "download": "downloader", "write": "writer"}
 
 
 class OrdersQuerySet(APIQuerySet):
+    """A page of orders (newest first) using scheduler's keyset pagination
+
+    `before` is the ID of the last order of the previous page. Once executed,
+    `orders` holds the page and `next` the `before` of the following one."""
+
+    def __init__(self, query, before=None, limit=10, params=None):
+        self.before = before
+        self.limit = limit
+        self.orders = []
+        self.next = None
+        super().__init__(query, params=params)
+
+    def execute(self, skip=None, limit=None):
+        success, code, response = query_api(
+            GET,
+            self.query,
+            params={
+                **self.params,
+                "before": self.before,
+                "limit": self.limit,
+                "count": False,
+            },
+        )
+        if success and "items" in response:
+            self.next = response["meta"].get("next")
+            self.orders = self.process(response.get("items", []))
+        return self.orders
+
     def process(self, results):
         return [OrderData(order) for order in super().process(results)]
 
@@ -43,14 +75,19 @@ def get_list(request):
         )
         return redirect("admin")
 
-    items = OrdersQuerySet("/orders/")
-    page = request.GET.get("page")
-    paginator = Paginator(items, 10)
-    orders_page = paginator.get_page(page)
+    filters = {
+        key: request.GET[key]
+        for key in ("status", "channel", "client_email")
+        if request.GET.get(key)
+    }
+    before = request.GET.get("before")
+    items = OrdersQuerySet("/orders/", before=before, params=filters)
 
     context = {
-        "orders_page": orders_page,
-        "orders": orders_page.object_list,
+        "orders": items.orders,
+        "before": before,
+        "next": items.next,
+        "filters": urlencode(filters),
     }
 
     if success:
@@ -160,7 +197,7 @@ def yaml_config(request, order_id):
 
 
 @staff_required
-def order_log(request, order_id, step, kind, index=None, fmt="txt"):  # noqa: ARG001
+def order_log(request, order_id, step, kind, index=None, fmt="txt"):
     if fmt not in ("txt", "html"):
         raise Http404(_("Unhandled format `%(fmt)s`") % {"fmt": fmt})
     else:
@@ -176,16 +213,18 @@ def order_log(request, order_id, step, kind, index=None, fmt="txt"):  # noqa: AR
     ):
         raise Http404(_("`%(kind)s` log does not exists") % {"kind": kind})
 
-    retrieved, order = get_order(order_id, with_logs=True)
+    retrieved, order = get_order(order_id)
     if not retrieved:
         raise Http404(order)
 
     try:
         if step == "write":
             index = int(index) - 1
-            content = order["tasks"][step][index]["logs"][kind]
+            task_id = order["tasks"][step][index]["_id"]
         else:
-            content = order["tasks"][step]["logs"][kind]
+            task_id = order["tasks"][step]["_id"]
+        offset = int(request.GET.get("offset", 0))
+        size = int(request.GET["size"]) if request.GET.get("size") else None
     except Exception as exc:
         logger.exception(exc)
         raise Http404(
@@ -193,6 +232,13 @@ def order_log(request, order_id, step, kind, index=None, fmt="txt"):  # noqa: AR
             % {"step": step, "kind": kind, "id": order_id}
         ) from exc
 
+    retrieved, log = get_task_log(
+        TASK_TYPES[step], task_id, kind, offset=offset, size=size
+    )
+    if not retrieved:
+        raise Http404(log)
+    content = log["content"]
+
     if content and fmt == "html":
         try:
             content = Ansi2HTMLConverter().convert(content)
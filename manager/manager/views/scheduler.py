@@ -107,6 +107,9 @@ class WarehouseForm(SchedulerForm):
     slug = forms.CharField()
     upload_uri = S3URLFormField()
     download_uri = S3URLFormField()
+    compression = forms.ChoiceField(
+        choices=[("", "none"), ("zstd", "zstd")], required=False
+    )
     active = forms.BooleanField(initial=True, required=False)
 
     def success_message(self, result):
@@ -128,6 +131,7 @@ class WarehouseForm(SchedulerForm):
             upload_uri=self.cleaned_data.get("upload_uri"),
             download_uri=self.cleaned_data.get("download_uri"),
             active=self.cleaned_data.get("active"),
+            compression=self.cleaned_data.get("compression") or None,
         )
         if not success:
             raise SchedulerAPIError(warehouse_id)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import sys
+import time
+import logging
+import threading
+
+from emailing import send_from_outbox
+
+# nb of threads sending emails
+EMAIL_SENDERS = int(os.getenv("EMAIL_SENDERS", "2"))
+# emails sent over a single provider connection
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "10"))
+# seconds between outbox checks when it's empty
+EMAIL_OUTBOX_INTERVAL = int(os.getenv("EMAIL_OUTBOX_INTERVAL", "5"))
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def run_sender(batch_size, interval):
+    """send outbox emails batch after batch, waiting when there's none"""
+    while True:
+        try:
+            nb_handled = send_from_outbox(batch_size)
+        except Exception as exc:
+            logger.error("outbox batch failed: {}".format(exc))
+            logger.exception(exc)
+            nb_handled = 0
+        if not nb_handled:
+            time.sleep(interval)
+
+
+def run_forever(nb_senders, batch_size, interval):
+    """sender pool (long-lived)"""
+    logger.info("starting {} outbox sender(s)".format(nb_senders))
+    senders = [
+        threading.Thread(
+            target=run_sender, args=(batch_size, interval), name=f"sender-{index}"
+        )
+        for index in range(nb_senders)
+    ]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+
+def drain(batch_size):
+    """send all due emails once"""
+    nb_handled = 0
+    while True:
+        nb_batch = send_from_outbox(batch_size)
+        if not nb_batch:
+            return nb_handled
+        nb_handled += nb_batch
+
+
+if __name__ == "__main__":
+    if "--loop" in sys.argv[1:]:
+        run_forever(EMAIL_SENDERS, EMAIL_BATCH_SIZE, EMAIL_OUTBOX_INTERVAL)
+    else:
+        logger.info("handled {} email(s)".format(drain(EMAIL_BATCH_SIZE)))
@@ -4,7 +4,13 @@
 
 import os
 import logging
+import shutil
 import pathlib
+import hashlib
+import datetime
+import threading
+import collections
+import copy
 from typing import Optional, Sequence
 from contextlib import contextmanager
 
@@ -17,7 +23,14 @@ from werkzeug.datastructures import MultiDict
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 import yaml
 
-from utils.mongo import Orders, Users, Channels, WriterTasks, Acknowlegments
+from utils.mongo import (
+    Orders,
+    Users,
+    Channels,
+    WriterTasks,
+    Acknowlegments,
+    EmailOutbox,
+)
 from utils.templates import (
     get_id,
     country_name,
@@ -88,16 +101,38 @@ RECIPIENT_EMAIL_STATUSES = [Orders.shipped]
 
 FAILED_ORDER_EMAIL = os.getenv("FAILED_ORDER_EMAIL")
 
+# dashboard entries of parsed config_yaml (LRU), by YAML digest
+DASHBOARD_ENTRIES = collections.OrderedDict()
+DASHBOARD_ENTRIES_SIZE = int(os.getenv("DASHBOARD_ENTRIES_CACHE_SIZE", "256"))
+DASHBOARD_ENTRIES_LOCK = threading.Lock()
+
+# rendered shipping documents, by order and HTML digest (LRU, size-bounded)
+SHIPPING_CACHE_DIR = pathlib.Path(
+    os.getenv(
+        "SHIPPING_CACHE_DIR", os.path.join(os.getenv("TMP_DIR", "/tmp"), "shipping")
+    )
+)
+SHIPPING_CACHE_SIZE = int(os.getenv("SHIPPING_CACHE_SIZE", str(100 * 2**20)))  # bytes
+
+# jinja_env's translations and locale are global: renders (outbox senders run
+# in threads) must hold it
+RENDER_LOCK = threading.RLock()
+
+# provider connection reused by sends of an outbox batch (see provider_session)
+# and (outbox email _id, recipients already sent to) of the email being sent
+transport = threading.local()
+
 
 @contextmanager
 def localized_for(lang, *args, **kwargs):
     translations = Translations.load(locale_dir, [lang])
-    try:
-        jinja_env._locale = lang
-        yield jinja_env.install_gettext_translations(translations)
-    finally:
-        jinja_env.uninstall_gettext_translations(translations)
-        jinja_env._locale = "en"
+    with RENDER_LOCK:
+        try:
+            jinja_env._locale = lang
+            yield jinja_env.install_gettext_translations(translations)
+        finally:
+            jinja_env.uninstall_gettext_translations(translations)
+            jinja_env._locale = "en"
 
 
 def get_sender():
@@ -115,6 +150,22 @@ def get_sender():
     )
 
 
+@contextmanager
+def provider_session():
+    """reuse a single provider connection for emails sent within
+
+    sending errors are raised (instead of logged) so they can be retried"""
+    session = (
+        requests.Session() if os.getenv("MAILGUN_API_KEY", False) else get_sender()
+    )
+    transport.session = session
+    try:
+        yield session
+    finally:
+        transport.session = None
+        session.close()
+
+
 def send_email_via_smtp(
     to,
     subject,
@@ -124,7 +175,7 @@ def send_email_via_smtp(
     headers: Optional[dict] = None,
     attachments: Optional[Sequence] = None,
 ):
-    yag = get_sender()
+    yag = getattr(transport, "session", None) or get_sender()
     if attachments:
         if not isinstance(contents, list):
             contents = [contents]
@@ -157,7 +208,7 @@ def send_email_via_api(
     ]
     data = MultiDict(values)
 
-    resp = requests.post(
+    resp = (getattr(transport, "session", None) or requests).post(
         url=os.getenv("MAILGUN_API_URL") + "/messages",
         auth=("api", os.getenv("MAILGUN_API_KEY")),
         data=data,
@@ -202,8 +253,15 @@ def send_email(
     # make sure we don't send message to same address twice
     cc = [a for a in cc if a not in to]
     bcc = [a for a in bcc if a not in to and a not in cc]
+
+    # outbox email being retried: skip messages sent by previous attempts
+    part = ",".join(to)
+    sent_parts = getattr(transport, "sent_parts", None)
+    if sent_parts is not None and part in sent_parts[1]:
+        logger.info(f"already sent --{subject}-- to --{to}--, skipping")
+        return None
     try:
-        return func(
+        message_id = func(
             to=to,
             subject=subject,
             contents=contents,
@@ -212,60 +270,103 @@ def send_email(
             headers=headers or {},
             attachments=attachments or [],
         )
+        if sent_parts is not None:
+            EmailOutbox.add_sent_part(sent_parts[0], part)
+            sent_parts[1].add(part)
+        return message_id
     except Exception as exp:
+        if getattr(transport, "session", None) is not None:
+            raise
         logger.error("Unable to send email: {}".format(exp))
         logger.exception(exp)
 
 
-def get_full_context(order_id, extra: Optional[dict] = None):
-    order = Orders().get_with_tasks(order_id, {"logs": 0})
-    order.update(
-        {
-            "id": order_id,
-            "status": order["statuses"][-1],
-            "min_id": order_id[:8] + order_id[-3:],
-        }
-    )
-    context = {"order": order}
-    if extra:
-        context.update(extra)
-    return context
-
-
-def get_order_status_update_template(status):
-    return "email_order_{}.html".format(status)
-
+class OrderContext:
+    """order (with its tasks) an email is about, retrieved once per send"""
+
+    def __init__(self, order_id):
+        self.order_id = str(order_id)
+        # outbox email: order as it was when queued (not as it is when sent)
+        snapshot = getattr(transport, "snapshot", None)
+        if snapshot and str(snapshot["_id"]) == self.order_id:
+            self.order = copy.deepcopy(snapshot)
+        else:
+            self.order = Orders.get_with_tasks(order_id)
+        self.order.update(
+            {
+                "id": self.order_id,
+                "status": self.order["statuses"][-1],
+                "min_id": self.order_id[:8] + self.order_id[-3:],
+            }
+        )
+        self.operator = None  # download worker's user, retrieved on first use
+
+    def get_full_context(self, extra: Optional[dict] = None):
+        context = {"order": self.order}
+        if extra:
+            context.update(extra)
+        return context
+
+    def get_write_task(self, task_id):
+        for task in self.order["tasks"].get("write") or []:
+            if task and str(task["_id"]) == str(task_id):
+                return task
+        return WriterTasks.get(task_id)
+
+    def get_email_for(self, kind, formatted=True):
+        def _fmt(name, email):
+            return "{name} <{email}>".format(name=name, email=email)
+
+        if kind not in ("client", "recipient", "operator", "error-manager"):
+            return None, "en"
+
+        if kind == "error-manager" and FAILED_ORDER_EMAIL:
+            return _fmt("Imager Error Manager", FAILED_ORDER_EMAIL), "en"
+
+        order = self.order
+        if kind == "client":
+            return (
+                _fmt(order["client"]["name"], order["client"]["email"]),
+                order["client"]["language"],
+            )
 
-def get_email_for(order_id, kind, formatted=True):
-    def _fmt(name, email):
-        return "{name} <{email}>".format(name=name, email=email)
+        if kind == "recipient":
+            return (
+                _fmt(order["recipient"]["name"], order["recipient"]["email"]),
+                order["recipient"]["language"],
+            )
 
-    if kind not in ("client", "recipient", "operator", "error-manager"):
+        if kind == "operator":
+            if self.operator is None:
+                self.operator = Users().by_username(
+                    order["tasks"]["download"]["worker"]
+                )
+            return self.operator["email"], "en"
         return None, "en"
 
-    if kind == "error-manager" and FAILED_ORDER_EMAIL:
-        return _fmt("Imager Error Manager", FAILED_ORDER_EMAIL), "en"
 
-    order = Orders.get_with_tasks(order_id, {"logs": 0})
-    if kind == "client":
-        return (
-            _fmt(order["client"]["name"], order["client"]["email"]),
-            order["client"]["language"],
-        )
+def get_order_status_update_template(status):
+    return "email_order_{}.html".format(status)
 
-    if kind == "recipient":
-        return (
-            _fmt(order["recipient"]["name"], order["recipient"]["email"]),
-            order["recipient"]["language"],
-        )
 
-    if kind == "operator":
-        worker = Users().by_username(order["tasks"]["download"]["worker"])
-        return worker["email"], "en"
-    return None, "en"
+def get_dashboard_entries(yaml_text):
+    """(title, description) of packages in config's dashboard. memoized"""
+    key = hashlib.sha256(yaml_text.encode("utf-8")).digest()
+    with DASHBOARD_ENTRIES_LOCK:
+        entries = DASHBOARD_ENTRIES.get(key)
+        if entries is not None:
+            DASHBOARD_ENTRIES.move_to_end(key)
+            return list(entries)
+
+    entries = parse_dashboard_entries(yaml_text)
+    with DASHBOARD_ENTRIES_LOCK:
+        while len(DASHBOARD_ENTRIES) >= DASHBOARD_ENTRIES_SIZE:
+            DASHBOARD_ENTRIES.popitem(last=False)
+        DASHBOARD_ENTRIES[key] = entries
+    return list(entries)
 
 
-def get_dashboard_entries(yaml_text):
+def parse_dashboard_entries(yaml_text):
 
     payload = yaml.load(yaml_text, Loader=SafeLoader)
     content = {}
@@ -291,10 +392,12 @@ def send_order_email_for(
     bcc: Optional[Sequence] = None,
     attachments: Optional[Sequence] = None,
     extra: Optional[dict] = None,
+    order_context: Optional[OrderContext] = None,
 ):
-    to, lang = get_email_for(order_id, kind=to)
+    order_context = order_context or OrderContext(order_id)
+    to, lang = order_context.get_email_for(to)
     with localized_for(lang):
-        context = get_full_context(str(order_id), extra=extra)
+        context = order_context.get_full_context(extra=extra)
         try:
             context["order_entries"] = get_dashboard_entries(
                 context["order"]["config_yaml"]
@@ -315,8 +418,8 @@ def send_order_email_for(
         to=to,
         subject=subject,
         contents=content,
-        cc=[get_email_for(order_id, kind=item)[0] for item in cc],
-        bcc=[get_email_for(order_id, kind=item)[0] for item in bcc],
+        cc=[order_context.get_email_for(item)[0] for item in cc],
+        bcc=[order_context.get_email_for(item)[0] for item in bcc],
         attachments=attachments or {},
     )
 
@@ -329,6 +432,7 @@ def send_order_created_email(order_id):
 
 
 def send_order_failed_email(order_id):
+    order_context = OrderContext(order_id)
     # recipient: order failed. you'll be refunded and contacted by client
     send_order_email_for(
         order_id,
@@ -337,17 +441,24 @@ def send_order_failed_email(order_id):
         "recipient",
         "client",
         "error-manager",
+        order_context=order_context,
     )
 
     # operator: download/write failed, please check conn and SD and contact client
-    order = Orders().get_with_tasks(order_id, {"logs": 0})
-    if order["tasks"].get("write") and order["tasks"]["write"]["status"] in (
-        WriterTasks.failed_to_download,
-        WriterTasks.failed_to_write,
-    ):
-
+    failed_writes = [
+        task
+        for task in order_context.order["tasks"].get("write") or []
+        if task
+        and task["status"]
+        in (WriterTasks.failed_to_download, WriterTasks.failed_to_write)
+    ]
+    if failed_writes:
         send_order_email_for(
-            order_id, "subject_order_failed", "operator_order_failed", "operator"
+            order_id,
+            "subject_order_failed",
+            "operator_order_failed",
+            "operator",
+            order_context=order_context,
         )
 
 
@@ -371,49 +482,54 @@ def send_image_uploaded_public_email(order_id):
 
 def send_insert_card_email(order_id, task_id):
     # operator: please insert XXGB SD card onto
-    write_task = WriterTasks.get(task_id)
+    order_context = OrderContext(order_id)
     send_order_email_for(
         order_id,
         "subject_insert_card",
         "operator_insert_card",
         "operator",
-        extra={"task": write_task},
+        extra={"task": order_context.get_write_task(task_id)},
+        order_context=order_context,
     )
 
 
 def send_image_writing_email(order_id, task_id):
     # operator: thank you ; write started
-    write_task = WriterTasks.get(task_id)
+    order_context = OrderContext(order_id)
     send_order_email_for(
         order_id,
         "subject_card_inserted",
         "operator_card_inserted",
         "operator",
-        extra={"task": write_task},
+        extra={"task": order_context.get_write_task(task_id)},
+        order_context=order_context,
     )
 
 
 def send_image_written_email(order_id, task_id):
     # client: image writing successful.
-    write_task = WriterTasks.get(task_id)
+    order_context = OrderContext(order_id)
     send_order_email_for(
         order_id,
         "subject_image_written",
         "operator_image_written",
         "operator",
-        extra={"task": write_task},
+        extra={"task": order_context.get_write_task(task_id)},
+        order_context=order_context,
     )
 
 
 def send_order_pending_shipment_email(order_id):
     # operator: please ship SD card from X to YY
-    attachments = [build_shipping_document(order_id)]
+    order_context = OrderContext(order_id)
+    attachments = [build_shipping_document(order_id, order_context=order_context)]
     send_order_email_for(
         order_id,
         "subject_ship_card",
         "operator_ship_card",
         "operator",
         attachments=attachments,
+        order_context=order_context,
     )
 
 
@@ -432,8 +548,9 @@ def send_worker_sos_email(ack_id):
     # client: image writing successful.
     ack = Acknowlegments.get(ack_id)
     context = {"ack": ack}
-    subject = jinja_env.get_template("subject_worker_sos.txt").render(**context)
-    content = jinja_env.get_template("operator_worker_sos.html").render(**context)
+    with RENDER_LOCK:
+        subject = jinja_env.get_template("subject_worker_sos.txt").render(**context)
+        content = jinja_env.get_template("operator_worker_sos.html").render(**context)
     send_email(
         to=Users().by_username(ack["username"])["email"],
         subject=subject,
@@ -441,22 +558,142 @@ def send_worker_sos_email(ack_id):
     )
 
 
-def build_shipping_document(order_id):
-    order = Orders().get(order_id, {"logs": 0})
-    channel = Channels().get(order["channel"])
-    context = get_full_context(str(order_id), extra={"channel": channel})
+def build_shipping_document(order_id, order_context: Optional[OrderContext] = None):
+    order_context = order_context or OrderContext(order_id)
+    channel = Channels().get(order_context.order["channel"])
+    context = order_context.get_full_context(extra={"channel": channel})
     context.update({"cwd": os.path.abspath(".")})
 
     fname = "Shipping_{oid}.pdf".format(oid=context["order"]["min_id"])
     fpath = os.path.join(os.getenv("TMP_DIR", "/tmp"), fname)
 
-    content = jinja_env.get_template("shipping.html").render(**context)
-    options = {
-        "page-size": "A4",
-        "encoding": "UTF-8",
-        "custom-header": [("Accept-Encoding", "gzip")],
-        "no-outline": None,
-        "viewport-size": "1280x1024",
-    }
-    pdfkit.from_string(content, fpath, options=options)
+    with RENDER_LOCK:
+        content = jinja_env.get_template("shipping.html").render(**context)
+    # digest changes with template and with order's data
+    cached = SHIPPING_CACHE_DIR.joinpath(
+        "{oid}_{digest}.pdf".format(
+            oid=order_context.order_id,
+            digest=hashlib.sha256(content.encode("utf-8")).hexdigest()[:16],
+        )
+    )
+    if cached.exists():
+        os.utime(cached)  # most recently used
+    else:
+        options = {
+            "page-size": "A4",
+            "encoding": "UTF-8",
+            "custom-header": [("Accept-Encoding", "gzip")],
+            "no-outline": None,
+            "viewport-size": "1280x1024",
+        }
+        SHIPPING_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached.with_name(f"{cached.name}.{threading.get_ident()}.part")
+        pdfkit.from_string(content, str(tmp_path), options=options)
+        tmp_path.replace(cached)
+        evict_shipping_documents(SHIPPING_CACHE_SIZE)
+    shutil.copyfile(cached, fpath)
     return fpath
+
+
+def evict_shipping_documents(max_size):
+    """remove least recently used cached shipping documents above max_size"""
+    documents = []
+    for fpath in SHIPPING_CACHE_DIR.glob("*.pdf"):
+        try:
+            stat = fpath.stat()
+        except FileNotFoundError:  # evicted concurrently
+            continue
+        documents.append((stat.st_mtime, stat.st_size, fpath))
+
+    total = 0
+    for _, size, fpath in sorted(documents, reverse=True):
+        total += size
+        if total > max_size:
+            logger.debug(f"evicting {fpath.name} from shipping cache")
+            fpath.unlink(missing_ok=True)
+
+
+# emails queue_email() can defer to the outbox
+QUEUEABLE_EMAILS = {
+    func.__name__: func
+    for func in (
+        send_order_created_email,
+        send_order_failed_email,
+        send_image_uploaded_email,
+        send_image_uploaded_public_email,
+        send_insert_card_email,
+        send_image_writing_email,
+        send_image_written_email,
+        send_order_pending_shipment_email,
+        send_order_shipped_email,
+        send_worker_sos_email,
+    )
+}
+
+
+def status_event(document_id, on):
+    """identifies a status entry of an order or task, for queue_email()"""
+    return f"{document_id}@{on.isoformat()}"
+
+
+def queue_email(func, *args, event=None):
+    """defer func(*args) to the outbox (sent by email-outbox.py)
+
+    event: what the email is about (see status_event). not queued again for
+    same func, args and event (idempotency key)
+
+    order emails are rendered from a snapshot of the order (with its tasks)
+    taken now, so a later status change doesn't alter the queued email"""
+    if func.__name__ not in QUEUEABLE_EMAILS:
+        raise ValueError(f"{func.__name__} can't be queued")
+    key = (
+        ":".join([func.__name__] + [str(arg) for arg in args] + [event])
+        if event
+        else None
+    )
+    snapshot = None if func is send_worker_sos_email else Orders.get_with_tasks(args[0])
+    return EmailOutbox.enqueue(func.__name__, args, key=key, snapshot=snapshot)
+
+
+def send_from_outbox(limit):
+    """send up to limit due outbox emails over one provider session
+
+    failed emails are retried later (backoff). returns nb of emails handled"""
+    emails = EmailOutbox.claim(datetime.datetime.now(), limit)
+    if not emails:
+        return 0
+
+    unsent = list(emails)
+    try:
+        with provider_session():
+            while unsent:
+                email = unsent.pop(0)
+                transport.sent_parts = (
+                    email["_id"],
+                    set(email.get("sent_parts") or []),
+                )
+                transport.snapshot = email.get("snapshot")
+                try:
+                    QUEUEABLE_EMAILS[email["email"]](*email["args"])
+                except Exception as exc:
+                    mark_outbox_failed(email, exc)
+                else:
+                    EmailOutbox.mark_sent(email["_id"], datetime.datetime.now())
+                finally:
+                    transport.sent_parts = None
+                    transport.snapshot = None
+    except Exception as exc:
+        # provider session failed (login): emails not sent are retried later
+        logger.error(f"provider session failed: {exc}")
+        for email in unsent:
+            mark_outbox_failed(email, exc)
+    return len(emails)
+
+
+def mark_outbox_failed(email, exc):
+    """record failure of a claimed outbox email (retried or given up on)"""
+    status = EmailOutbox.mark_failed(email, str(exc), datetime.datetime.now())
+    logger.error(
+        f"unable to send {email['email']} #{email['_id']} "
+        f"(attempt {email['attempts']}, now {status}): {exc}"
+    )
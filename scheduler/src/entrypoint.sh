@@ -1,18 +1,26 @@
 #!/bin/bash
 
+# run a long-lived command in background, restarting it should it exit
+function supervise {
+    (
+        while true; do
+            "$@"
+            echo "$* exited with $?, restarting in 10s"
+            sleep 10
+        done
+    ) &
+}
+
 echo "execute our prestart script"
 python /app/prestart.py
 
-echo "dump environment"
-declare -p | grep -Ev 'BASHOPTS|BASH_VERSINFO|EUID|PPID|SHELLOPTS|UID' > /container.env
-
-echo "start cron"
-cron
-
-sleep 2
+if [ "$DISABLE_PERIODIC_TASKS" != "y" ]; then
+    echo "start periodic tasks runner"
+    supervise python /app/periodic-tasks.py --loop
+fi
 
-# reload crontab
-crontab /etc/cron.d/scheduler-cron
+echo "start email outbox senders"
+supervise python /app/email-outbox.py --loop
 
 echo "run parent's (tiangolo/uwsgi-nginx) entrypoint"
 exec /entrypoint.sh "$@"
@@ -3,25 +3,27 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import sys
+import time
 import logging
 import datetime
 import subprocess
 
 import requests
-import humanfriendly
 
-from emailing import send_order_failed_email
-from utils.mongo import Orders, Tasks, AutoImages
+from emailing import queue_email, status_event, send_order_failed_email
+from utils.mongo import Orders, Tasks, AutoImages, PeriodicRuns
 from utils.templates import (
     get_public_download_url,
     get_public_download_torrent_url,
-    get_magnet_for_torrent,
+    get_magnet_for,
 )
 from routes.orders import create_order_from
 
 MANAGER_API_URL = os.getenv("MANAGER_API_URL", "https://imager.kiwix.org/api")
 MANAGER_ACCOUNTS_API_TOKEN = os.getenv("MANAGER_ACCOUNTS_API_TOKEN")
 DISABLE_PERIODIC_TASKS = bool(os.getenv("DISABLE_PERIODIC_TASKS", "") == "y")
+PERIODIC_TASKS_INTERVAL = int(os.getenv("PERIODIC_TASKS_INTERVAL", "300"))
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
@@ -34,99 +36,116 @@ def get_next_month():
     )
 
 
-def is_expired(status, since, size=0):
-    now = datetime.datetime.now()
-    min_bps = int(humanfriendly.parse_size("4MiB") / 8)
+def timeout_tasks(now):
+    """timeout in-progress tasks past their expires_at. returns count"""
+    expired = {}
+    for task_cls, task in Tasks.all_expired(now):
+        expired.setdefault(task_cls, {})[task["_id"]] = task
 
-    if status == Tasks.building:
-        return since < now - datetime.timedelta(hours=12)
+    nb_timedout = 0
+    for task_cls, tasks in expired.items():
+        for task_id in task_cls.timeout(list(tasks.keys()), now):
+            task = tasks[task_id]
+            logger.info("timed out task #{} ({})".format(task_id, task["status"]))
+            nb_timedout += 1
 
-    if status == Tasks.wiping_sdcard:
-        return since < now - datetime.timedelta(minutes=30)
+            # if write, cancel peers
+            if task["status"] in (Tasks.wiping_sdcard, Tasks.writing):
+                task_cls.cancel_peers(task["order"], task_id)
 
-    if status in (Tasks.uploading, Tasks.downloading, Tasks.writing):
-        return since < now - datetime.timedelta(seconds=int(size / min_bps))
-
-
-def run_periodic_tasks():
-    logger.info("running periodic tasks !!")
-
-    # manage auto-images
-    logger.info("managing auto-images")
-    check_autoimages()
-
-    logger.info("timing out expired orders")
-    for task_cls, task in Tasks.all_inprogress():
-        task_id = task["_id"]
-        ls = task["statuses"][-1]
-
-        if not is_expired(ls["status"], ls["on"], task_cls.get_size(task_id)):
-            logger.info("skipping non-expired task #{}".format(task_id))
-            continue
-
-        logger.info("timing out task #{}".format(task_id))
-
-        order = Orders().get_with_tasks(task["order"])
-
-        # timeout task
-        task_cls.update_status(task_id=task_id, status=Tasks.timedout)
+            # cascade
+            task_cls.cascade_status(
+                task_id=task_id, task_status=task_cls.timedout, task=task
+            )
 
-        # if write, cancel peers
-        if ls["status"] in (Tasks.wiping_sdcard, Tasks.writing):
-            for peer in order["tasks"]["write"]:
-                if peer["_id"] == task_id:
-                    continue
-                task_cls.update_status(task_id=peer["_id"], status=Tasks.canceled)
+            # notify
+            # TODO: forward to mgmt
+            queue_email(
+                send_order_failed_email,
+                task["order"],
+                event=status_event(task_id, now),
+            )
+    return nb_timedout
 
-        # cascade
-        task_cls.cascade_status(task_id=task_id, task_status=task_cls.timedout)
 
-        # notify
-        send_order_failed_email(order["_id"])  # TODO: forward to task/order mgmt
+def expire_orders(now):
+    """orders which downloads expired. returns count"""
+    nb_expired = Orders.expire_all(now)
+    if nb_expired:
+        logger.info("{} order(s) reached expiration".format(nb_expired))
+    return nb_expired
 
-    logger.info("removing expired donwload files")
-    now = datetime.datetime.now()
 
-    for order in Orders.all_pending_expiry():
-        ls = order["statuses"][-1]
+def run_periodic_tasks():
+    logger.info("running periodic tasks !!")
+    started_on = datetime.datetime.now()
+    steps, counts = {}, {}
+    for name, func in (
+        ("autoimages", lambda now: check_autoimages()),
+        ("timeouts", timeout_tasks),
+        ("expiries", expire_orders),
+    ):
+        logger.info("running {}".format(name))
+        step_start = time.monotonic()
+        try:
+            counts[name] = func(datetime.datetime.now())
+        except Exception as exc:
+            logger.error("{} failed: {}".format(name, exc))
+            logger.exception(exc)
+        steps[name] = round(time.monotonic() - step_start, 3)
 
-        if not ls["status"] == Orders.pending_expiry:
-            continue  # wrong timing
+    duration = round((datetime.datetime.now() - started_on).total_seconds(), 3)
+    logger.info("ran periodic tasks in {}s: {}".format(duration, steps))
+    PeriodicRuns.record(started_on, duration, steps, counts)
 
-        if not order["sd_card"]["expiration"] < now:
-            continue  # expiration not reached
 
-        logger.info("Order #{} has reach expiration.".format(order["_id"]))
-        Orders().update_status(order["_id"], Orders.expired)
+def run_forever(interval):
+    """run periodic tasks every interval seconds (long-lived runner)"""
+    while True:
+        started = time.monotonic()
+        try:
+            run_periodic_tasks()
+        except Exception as exc:
+            logger.error("periodic tasks failed: {}".format(exc))
+            logger.exception(exc)
+        time.sleep(max([interval - (time.monotonic() - started), 0]))
 
 
 def check_autoimages():
+    nb_updated = 0
+
     # update images that were building
     logger.info("Looking for currently building images…")
-    for image in AutoImages.all_currently_building():
+    images = list(AutoImages.all_currently_building())
+    orders = Orders.get_many([image["order"] for image in images])
+    for image in images:
         logger.info(f".. {image['slug']}")
         # check order status
-        order = Orders.get(image["order"])
+        order = orders.get(image["order"])
+        if order is None:
+            logger.error(f".. order #{image['order']} not found")
+            continue
 
         # order is considered failed
         if order["status"] in Orders.FAILED_STATUSES:
             logger.info(f".. order failed: {order['status']}")
             AutoImages.update_status(image["slug"], status="failed")
+            nb_updated += 1
             continue
 
         # order is considered successful
         if order["status"] in Orders.SUCCESS_STATUSES + [Orders.pending_expiry]:
             logger.info(f".. order succeeded: {order['status']}")
-            torrent_url = get_public_download_torrent_url(order)
             AutoImages.update_status(
                 image["slug"],
                 status="ready",
                 order=None,
                 http_url=get_public_download_url(order),
-                torrent_url=torrent_url,
-                magnet_url=get_magnet_for_torrent(torrent_url),
+                torrent_url=get_public_download_torrent_url(order),
+                magnet_url=get_magnet_for(order),
                 expire_on=get_next_month(),
             )
+            nb_updated += 1
             continue
 
         logger.info(f".. order still building: {order['status']}")
@@ -157,8 +176,19 @@ def check_autoimages():
 
         # update with order ID and status: building
         AutoImages.update_status(image["slug"], status="building", order=order_id)
+        nb_updated += 1
+
+    return nb_updated
 
 
 if __name__ == "__main__":
     if not DISABLE_PERIODIC_TASKS:
-        run_periodic_tasks()
+        logger.info(
+            "recorded expiry of {} task(s) updated before expires_at".format(
+                Tasks.backfill_expires_at()
+            )
+        )
+        if "--loop" in sys.argv[1:]:
+            run_forever(PERIODIC_TASKS_INTERVAL)
+        else:
+            run_periodic_tasks()
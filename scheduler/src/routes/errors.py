@@ -6,6 +6,7 @@ def register_handlers(app: Flask):
     app.errorhandler(BadRequest)(BadRequest.handler)
     app.errorhandler(Unauthorized)(Unauthorized.handler)
     app.errorhandler(NotFound)(NotFound.handler)
+    app.errorhandler(TooManyRequests)(TooManyRequests.handler)
     app.errorhandler(InternalError)(InternalError.handler)
 
     @app.errorhandler(jwt_exceptions.ExpiredSignature)
@@ -71,6 +72,24 @@ class NotFound(Exception):
             return Response(status=404)
 
 
+# 429
+class TooManyRequests(Exception):
+    def __init__(self, message: str = None, retry_after: int = None):
+        self.message = message
+        self.retry_after = retry_after
+
+    @staticmethod
+    def handler(e):
+        if isinstance(e, TooManyRequests) and e.message is not None:
+            response = jsonify({"error": e.message})
+            response.status_code = 429
+        else:
+            response = Response(status=429)
+        if isinstance(e, TooManyRequests) and e.retry_after is not None:
+            response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+
 # 500
 class InternalError(Exception):
     @staticmethod
@@ -3,6 +3,7 @@ import datetime
 
 import pymongo
 from bson import ObjectId
+from bson.errors import InvalidId
 from distutils.util import strtobool
 from flask import Blueprint, request, jsonify, render_template
 from jsonschema import validate, ValidationError
@@ -10,6 +11,8 @@ from jsonschema import validate, ValidationError
 from utils.mongo import Orders, Users
 from utils.json import ensure_objectid
 from emailing import (
+    queue_email,
+    status_event,
     send_order_created_email,
     send_order_shipped_email,
     send_order_failed_email,
@@ -24,6 +27,31 @@ def string_to_bool(string):
     return bool(strtobool(str(string)))
 
 
+def get_orders_query(args):
+    """orders filter from list request args. ValueError on invalid ones
+
+    - status: comma-separated list of statuses
+    - channel, client_email: exact match
+    - created_after, created_before: ISO 8601 datetimes (UTC)"""
+    query = {}
+    # creation time is part of the _id
+    for arg, operator in (("created_after", "$gte"), ("created_before", "$lt")):
+        if not args.get(arg):
+            continue
+        try:
+            boundary = datetime.datetime.fromisoformat(args[arg])
+        except ValueError:
+            raise ValueError(f"{arg} is not an ISO 8601 datetime")
+        query.setdefault("_id", {})[operator] = ObjectId.from_datetime(boundary)
+    if args.get("status"):
+        query["status"] = {"$in": args["status"].split(",")}
+    if args.get("channel"):
+        query["channel"] = args["channel"]
+    if args.get("client_email"):
+        query["client.email"] = args["client_email"]
+    return query
+
+
 def create_order_from(payload):
     # validate payload
     validate(payload, Orders().schema)
@@ -50,7 +78,11 @@ def create_order_from(payload):
     Orders.update(order_id, {"fname": fname})
 
     # send email about new order
-    send_order_created_email(order_id)
+    queue_email(
+        send_order_created_email,
+        order_id,
+        event=status_event(order_id, payload["statuses"][-1]["on"]),
+    )
 
     # create creation task
     Orders.create_creator_task(order_id)
@@ -72,21 +104,42 @@ def collection(user: dict):
         limit = request.args.get("limit", default=20, type=int)
         skip = 0 if skip < 0 else skip
         limit = 20 if limit <= 0 else limit
+        with_count = request.args.get("count", default=True, type=string_to_bool)
+
+        try:
+            query = get_orders_query(request.args)
+        except ValueError as exc:
+            raise errors.BadRequest(str(exc))
+
+        # newest first, paginated by `before` (last _id of previous page)
+        page_query = query
+        if request.args.get("before"):
+            try:
+                before = ObjectId(request.args["before"])
+            except InvalidId:
+                raise errors.BadRequest("before is not a valid order ID")
+            page_query = {"$and": [query, {"_id": {"$lt": before}}]}
 
-        query = {}
-        projection = {"_id": 1}
         cursor = (
             Orders()
-            .find(query, projection)
-            .sort([("$natural", pymongo.DESCENDING)])
+            .find(page_query, Orders.list_projection)
+            .sort([("_id", pymongo.DESCENDING)])
             .skip(skip)
             .limit(limit)
         )
-        count = Orders().count_documents(query)
-        orders = [Orders.get(order.get("_id")) for order in cursor]
+        orders = [order for order in cursor]
+        count = Orders().count_documents(query) if with_count else None
 
         return jsonify(
-            {"meta": {"skip": skip, "limit": limit, "count": count}, "items": orders}
+            {
+                "meta": {
+                    "skip": skip,
+                    "limit": limit,
+                    "count": count,
+                    "next": orders[-1]["_id"] if len(orders) == limit else None,
+                },
+                "items": orders,
+            }
         )
     if request.method == "POST":
 
@@ -141,7 +194,7 @@ def document(order_id: ObjectId, user: dict):
         request_json = request.get_json()
         Orders().add_shipment(order_id, request_json.get("shipment_details"))
 
-        send_order_shipped_email(order_id)
+        queue_email(send_order_shipped_email, order_id)
 
         return jsonify(order)
 
@@ -166,7 +219,12 @@ def cancel(order_id: ObjectId, user: dict):
         raise errors.NotFound()
 
     Orders().cancel(order_id)
-    send_order_failed_email(order_id)
+    order = Orders.get(order_id)
+    queue_email(
+        send_order_failed_email,
+        order_id,
+        event=status_event(order_id, order["statuses"][-1]["on"]),
+    )
 
     return jsonify({"_id": order_id})
 
@@ -194,7 +252,7 @@ def add_shipment(order_id: ObjectId):
         # refresh order object
         order = Orders.get(order_id)
         # send recipient an email
-        send_order_shipped_email(order_id)
+        queue_email(send_order_shipped_email, order_id)
 
         return render_template(
             "pub_thank_shipment.html", order=order, order_id=order["_id"]
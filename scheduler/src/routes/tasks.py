@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import os
+import base64
 import logging
 import datetime
+import threading
+import time
 from bson import ObjectId
+from bson.objectid import InvalidId
 from flask import Blueprint, request, jsonify, Response, render_template
 
 from utils.mongo import (
@@ -15,9 +20,12 @@ from utils.mongo import (
     Tasks,
     Orders,
     Acknowlegments,
+    TaskLogs,
 )
 from . import authenticate, bson_object_id, errors, only_for_roles
 from emailing import (
+    queue_email,
+    status_event,
     send_image_uploaded_email,
     send_image_uploaded_public_email,
     send_insert_card_email,
@@ -30,6 +38,15 @@ from emailing import (
 
 blueprint = Blueprint("task", __name__, url_prefix="/tasks")
 
+# long-poll: max duration of a request and delay between checks (seconds)
+POLL_MAX_TIMEOUT = 60
+POLL_CHECK_INTERVAL = int(os.getenv("POLL_CHECK_INTERVAL", "5"))
+# a waiting poll holds one of uwsgi's threads (see uwsgi.ini) and queries
+# mongo every POLL_CHECK_INTERVAL. polls over that many (per process) are
+# refused (429) so waiting workers can't starve other requests
+POLL_MAX_CONCURRENT = int(os.getenv("POLL_MAX_CONCURRENT", "4"))
+POLL_SLOTS = threading.BoundedSemaphore(POLL_MAX_CONCURRENT)
+
 
 # def tasks_cls_for(user):
 #     return CreatorTasks if user["role"] == Users.CREATOR_ROLE else WriterTasks
@@ -56,11 +73,88 @@ def typed_collection(task_type: str, user: dict):
             worker_type=task_type,
             slot=request.args.get("slot"),
         )
-        tasks = tasks_cls_for(task_type).find_availables(channel=user.get("channel"))
+        tasks = tasks_cls_for(task_type).find_availables(
+            worker=user["username"],
+            channel=user.get("channel"),
+            limit=min([max([request.args.get("limit", default=10, type=int), 1]), 100]),
+        )
 
         return jsonify(tasks)
 
 
+@blueprint.route("/<string:task_type>/poll", methods=["GET"])
+@authenticate()
+@only_for_roles(roles=Users.WORKER_ROLES)
+def poll(task_type: str, user: dict):
+    """long-poll: returns once there are tasks or a watched task changed
+
+    - `tasks`: 1 to return available tasks (worker has free slots)
+    - `max_size`: only consider tasks of at most that size (GB), as in claim
+    - `watch`: comma-separated `task_id:status` as known by worker. Returns
+      when scheduler's status differs (a deleted task has status None)
+    - `timeout`: max seconds to wait (returns with nothing new then)
+
+    429 if POLL_MAX_CONCURRENT polls are already waiting: retry later"""
+    task_cls = tasks_cls_for(task_type)
+    want_tasks = request.args.get("tasks", default=0, type=int) == 1
+    max_size = request.args.get("max_size", type=int)
+    timeout = min([request.args.get("timeout", default=20, type=int), POLL_MAX_TIMEOUT])
+
+    watched = {}
+    for item in filter(None, request.args.get("watch", default="").split(",")):
+        task_id, _, status = item.partition(":")
+        try:
+            watched[ObjectId(task_id)] = status or None
+        except InvalidId:
+            raise errors.BadRequest(message="Invalid ObjectID")
+
+    if want_tasks:
+        Acknowlegments.idle_update(
+            username=user["username"],
+            worker_type=task_type,
+            slot=request.args.get("slot"),
+        )
+
+    if not POLL_SLOTS.acquire(blocking=False):
+        raise errors.TooManyRequests(
+            message="too many workers polling", retry_after=POLL_CHECK_INTERVAL
+        )
+    try:
+        deadline = time.monotonic() + max([timeout, 0])
+        while True:
+            statuses = task_cls.get_statuses(list(watched.keys())) if watched else {}
+            changed = any(
+                statuses.get(str(task_id)) != status
+                for task_id, status in watched.items()
+            )
+            has_tasks = want_tasks and task_cls.has_availables(
+                worker=user["username"], channel=user.get("channel"), max_size=max_size
+            )
+            remaining = deadline - time.monotonic()
+            if changed or has_tasks or remaining <= 0:
+                break
+            time.sleep(min([POLL_CHECK_INTERVAL, remaining]))
+    finally:
+        POLL_SLOTS.release()
+
+    return jsonify(
+        {
+            "tasks": (
+                task_cls.find_availables(
+                    worker=user["username"],
+                    channel=user.get("channel"),
+                    max_size=max_size,
+                )
+                if has_tasks
+                else []
+            ),
+            "watched": {
+                str(task_id): statuses.get(str(task_id)) for task_id in watched.keys()
+            },
+        }
+    )
+
+
 @blueprint.route("/<string:task_type>/<string:task_id>", methods=["GET", "DELETE"])
 @authenticate()
 @only_for_roles(roles=Users.WORKER_ROLES)
@@ -80,6 +174,7 @@ def document(task_id: ObjectId, task_type: str, user: dict):
         deleted_count = task_cls().delete_one({"_id": task_id}).deleted_count
         if deleted_count == 0:
             raise errors.NotFound()
+        TaskLogs.delete_for(task_id)
 
         # send email about deletion
 
@@ -92,12 +187,10 @@ def document(task_id: ObjectId, task_type: str, user: dict):
 @bson_object_id(["task_id"])
 def register_task(task_id: ObjectId, task_type: str, user: dict):
     task_cls = tasks_cls_for(task_type)
-    task = task_cls().find({"_id": task_id, "status": task_cls.pending})
+    task = task_cls.register(task_id, user)
     if task is None:
         raise errors.NotFound()
 
-    task_cls.register(task_id, user)
-
     # update ACK
     Acknowlegments.busy_update(
         username=user["username"],
@@ -109,6 +202,45 @@ def register_task(task_id: ObjectId, task_type: str, user: dict):
     return jsonify({"_id": task_id})
 
 
+@blueprint.route("/<string:task_type>/claim", methods=["POST"])
+@authenticate()
+@only_for_roles(roles=Users.WORKER_ROLES)
+def claim_task(task_type: str, user: dict):
+    """assign a pending task to requesting worker and return it
+
+    - `task_id`: claim that task (404 if no longer pending)
+    - `max_size`: otherwise, claim oldest task of at most that size
+
+    returns an empty object if there's no task to claim"""
+    task_cls = tasks_cls_for(task_type)
+    task_id = request.args.get("task_id")
+    try:
+        task_id = ObjectId(task_id) if task_id else None
+    except InvalidId:
+        raise errors.BadRequest(message="Invalid ObjectID")
+
+    task = task_cls.claim(
+        user, task_id=task_id, max_size=request.args.get("max_size", type=int)
+    )
+    if task is None:
+        if task_id:
+            raise errors.NotFound()
+        Acknowlegments.idle_update(
+            username=user["username"],
+            worker_type=task_type,
+            slot=request.args.get("slot"),
+        )
+        return jsonify({})
+
+    Acknowlegments.busy_update(
+        username=user["username"],
+        worker_type=task_type,
+        slot=request.args.get("slot"),
+        task_id=task["_id"],
+    )
+    return jsonify(task)
+
+
 @blueprint.route(
     "/<string:task_type>/<string:task_id>/confirm_inserted", methods=["GET", "POST"]
 )
@@ -124,8 +256,8 @@ def confirm_inserted_task(task_id: ObjectId, task_type: str):
         return render_template("pub_confirm_inserted.html", order=order, task=task)
 
     elif request.method == "POST":
-        task_cls.update_status(task_id, status=task_cls.card_inserted)
-        task_cls.cascade_status(task_id, task_cls.card_inserted)
+        task = task_cls.update_status(task_id, status=task_cls.card_inserted)
+        task_cls.cascade_status(task_id, task_cls.card_inserted, task=task)
 
         order = Orders().get(task["order"])
 
@@ -139,10 +271,6 @@ def confirm_inserted_task(task_id: ObjectId, task_type: str):
 @bson_object_id(["task_id"])
 def update_status(task_id: ObjectId, task_type: str, user: dict):
     task_cls = tasks_cls_for(task_type)
-    task = task_cls().get(task_id)
-    if task is None:
-        raise errors.NotFound()
-
     request_json = request.get_json()
     # try:
     #     request_json = request.get_json()
@@ -152,18 +280,24 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
 
     # update task status
     status = request_json.get("status")
-    task_cls.update_status(
+    task = task_cls.update_status(
         task_id,
         status=request_json.get("status"),
         payload=request_json.get("log"),
         extra_update=request_json.get("extra"),
     )
+    if task is None:
+        raise errors.NotFound()
 
     # update order status based on this task
-    task_cls.cascade_status(task_id, request_json.get("status"))
+    task_cls.cascade_status(task_id, request_json.get("status"), task=task)
 
-    # send email if appropriate
+    # queue email if appropriate (once per status entry)
     order_id = task["order"]
+    event = status_event(task_id, task["statuses"][-1]["on"])
+
+    # image details may come along with upload updates
+    image = (request_json.get("extra") or {}).get("image") or task.get("image") or {}
 
     # create task uploaded image
     if status == Tasks.uploaded_public:
@@ -172,18 +306,25 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
         expiration = datetime.datetime.now() + datetime.timedelta(
             days=order["sd_card"]["duration"]
         )
-        Orders().update(order_id, {"sd_card.expiration": expiration})
-        send_image_uploaded_public_email(order_id)
+        update = {"sd_card.expiration": expiration}
+        if image.get("torrent"):
+            update["torrent"] = image["torrent"]
+        Orders().update(order_id, update)
+        queue_email(send_image_uploaded_public_email, order_id, event=event)
     elif status == Tasks.uploaded:
-        send_image_uploaded_email(order_id)
+        if image.get("torrent"):
+            Orders().update(order_id, {"torrent": image["torrent"]})
+        queue_email(send_image_uploaded_email, order_id, event=event)
 
         # create DownloadTask
         Orders().create_downloader_task(
             order_id,
             {
-                "fname": task.get("image", {}).get("fname"),
-                "size": task.get("image", {}).get("size"),
-                "checksum": task.get("image", {}).get("checksum"),
+                "fname": image.get("fname"),
+                "size": image.get("size"),
+                "checksum": image.get("checksum"),
+                "compression": image.get("compression"),
+                "compressed_size": image.get("compressed_size"),
             },
         )
 
@@ -195,22 +336,22 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
     # write task was registered
     elif status == Tasks.waiting_for_card:
         # send email to insert card
-        send_insert_card_email(order_id, task_id)
+        queue_email(send_insert_card_email, order_id, task_id, event=event)
 
     # write task started writing
     elif status == Tasks.writing:
-        send_image_writing_email(order_id, task_id)
+        queue_email(send_image_writing_email, order_id, task_id, event=event)
 
     # write task completed
     elif status == Tasks.written:
-        send_image_written_email(order_id, task_id)
+        queue_email(send_image_written_email, order_id, task_id, event=event)
 
         order = Orders().get_with_tasks(order_id)
         # all write tasks are marked as written
         if not [1 for wt in order["tasks"]["write"] if wt["status"] != Tasks.written]:
             Orders().update_status(order_id, Orders.pending_shipment)
 
-            send_order_pending_shipment_email(order_id)
+            queue_email(send_order_pending_shipment_email, order_id, event=event)
 
             # find matching download task and mark it for file removal
             DownloaderTasks().update_status(
@@ -219,7 +360,7 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
             )
 
     elif status in Tasks.FAILED_STATUSES:
-        send_order_failed_email(order_id)
+        queue_email(send_order_failed_email, order_id, event=event)
 
     return jsonify({"_id": task_id})
 
@@ -255,3 +396,76 @@ def add_log(task_id: ObjectId, task_type: str, user: dict):
     )
 
     return jsonify({"_id": task_id})
+
+
+@blueprint.route("/<string:task_type>/<string:task_id>/logs/append", methods=["POST"])
+@authenticate()
+@only_for_roles(roles=Users.WORKER_ROLES)
+@bson_object_id(["task_id"])
+def append_log(task_id: ObjectId, task_type: str, user: dict):
+    """append a chunk to a task log. returns offset to send next chunk from"""
+    task_cls = tasks_cls_for(task_type)
+    if task_cls().count_documents({"_id": task_id}) == 0:
+        raise errors.NotFound()
+
+    request_json = request.get_json() or {}
+    kind = request_json.get("kind")
+    offset = request_json.get("offset")
+    # raw bytes (base64) so offsets match the worker's. text `chunk` is legacy
+    chunk = request_json.get("chunk")
+    if request_json.get("data") is not None:
+        try:
+            chunk = base64.b64decode(request_json["data"], validate=True)
+        except (TypeError, ValueError):
+            raise errors.BadRequest("Invalid data")
+    if kind not in TaskLogs.KINDS:
+        raise errors.BadRequest("Invalid log kind")
+    if not isinstance(offset, int) or offset < 0 or not isinstance(chunk, (str, bytes)):
+        raise errors.BadRequest("Invalid offset or chunk")
+
+    end = TaskLogs.append(task_id, kind=kind, offset=offset, chunk=chunk)
+
+    # update ACK
+    Acknowlegments.busy_update(
+        username=user["username"],
+        worker_type=task_type,
+        slot=request.args.get("slot"),
+        task_id=task_id,
+    )
+
+    return jsonify({"_id": task_id, "kind": kind, "offset": end})
+
+
+@blueprint.route("/<string:task_type>/<string:task_id>/logs/<string:kind>")
+@authenticate()
+@only_for_roles(roles=Users.ROLES)
+@bson_object_id(["task_id"])
+def read_log(task_id: ObjectId, task_type: str, kind: str, user: dict):
+    """range of a task log: `offset` and `size` (bytes) querystring params"""
+    if kind not in TaskLogs.KINDS:
+        raise errors.NotFound()
+    offset = max([request.args.get("offset", default=0, type=int), 0])
+    size = request.args.get("size", default=None, type=int)
+
+    data, total = TaskLogs.read(task_id, kind=kind, offset=offset, size=size)
+    if not total:
+        # logs used to be stored as a single string on the task
+        task = tasks_cls_for(task_type)().find_one(
+            {"_id": task_id}, {"logs.{}".format(kind): 1}
+        )
+        if task is None:
+            raise errors.NotFound()
+        data = ((task.get("logs") or {}).get(kind) or "").encode("utf-8")
+        total = len(data)
+        data = data[offset:] if size is None else data[offset : offset + size]
+
+    return jsonify(
+        {
+            "_id": task_id,
+            "kind": kind,
+            "offset": offset,
+            "size": len(data),
+            "total": total,
+            "content": data.decode("utf-8", errors="replace"),
+        }
+    )
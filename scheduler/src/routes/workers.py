@@ -5,9 +5,9 @@ from flask import Blueprint, request, jsonify
 from jsonschema import ValidationError
 
 from . import errors
-from . import authenticate, only_for_roles
-from emailing import send_worker_sos_email
-from utils.mongo import Users, Acknowlegments, CreatorTasks, Orders
+from . import authenticate, ensure_user_matches_role, only_for_roles
+from emailing import queue_email, send_worker_sos_email
+from utils.mongo import Users, Acknowlegments, CreatorTasks, Orders, PopularContent
 
 
 blueprint = Blueprint("worker", __name__, url_prefix="/workers")
@@ -66,7 +66,7 @@ def sos(user: dict):
 
     # only email operator once
     if status_changed:
-        send_worker_sos_email(aid)
+        queue_email(send_worker_sos_email, aid)
 
     return jsonify({"_id": aid})
 
@@ -148,3 +148,30 @@ def calculate_load(user: dict):
             "estimated_completion": estimated_completion.isoformat(),
         }
     )
+
+
+@blueprint.route("/popular-content", methods=["GET", "PUT"])
+@authenticate()
+@only_for_roles(roles=Users.WORKER_ROLES + [Users.MANAGER_ROLE])
+def popular_content(user: dict):
+    """content to pre-fetch into creators' cache (published by manager)"""
+
+    if request.method == "GET":
+        limit = request.args.get("limit", default=0, type=int)
+        items = PopularContent.get_top(limit=max([limit, 0]))
+        return jsonify({"meta": {"limit": limit, "count": len(items)}, "items": items})
+
+    ensure_user_matches_role(user, Users.MANAGER_ROLE)
+    request_json = request.get_json()
+    try:
+        items = request_json["items"]
+        for item in items:
+            if item.get("kind") not in ("file", "image") or not item.get("ident"):
+                raise ValueError(f"invalid item: {item}")
+            item["size"] = int(item.get("size") or 0)
+            item["count"] = int(item.get("count") or 0)
+    except (KeyError, TypeError, ValueError) as exc:
+        raise errors.BadRequest(str(exc))
+
+    PopularContent.replace_all(items)
+    return jsonify({"count": len(items)})
@@ -1,23 +1,134 @@
 import os
+import logging
 import datetime
+import threading
 
 import humanfriendly
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, IndexModel, ReturnDocument
+from pymongo import monitoring
+from pymongo.errors import DuplicateKeyError
 from pymongo.database import Database as BaseDatabase
 from pymongo.collection import Collection as BaseCollection
 
 from utils.json import ensure_objectid
 
+logger = logging.getLogger(__name__)
+
+# log commands slower than this (ms). 0 disables
+SLOW_QUERY_MS = int(os.getenv("MONGODB_SLOW_QUERY_MS", "0"))
+
+
+class SlowQueryLogger(monitoring.CommandListener):
+    """logs mongo commands taking more than threshold ms, with their route
+
+    only filter keys are logged (values may be personal data)"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.pending = {}  # request_id: (collection, filter keys)
+
+    @staticmethod
+    def get_route():
+        try:
+            from flask import has_request_context, request
+        except ImportError:
+            return None
+        if not has_request_context():
+            return None
+        return f"{request.method} {request.url_rule or request.path}"
+
+    def started(self, event):
+        command = event.command
+        query = command.get("filter", command.get("query", command.get("q"))) or {}
+        with self.lock:
+            self.pending[event.request_id] = (
+                command.get(event.command_name),
+                sorted(query.keys()) if isinstance(query, dict) else [],
+            )
+
+    def report(self, event, failed=False):
+        with self.lock:
+            collection, keys = self.pending.pop(event.request_id, (None, []))
+        duration = event.duration_micros / 1000
+        if duration < self.threshold:
+            return
+        logger.warning(
+            f"slow mongo {event.command_name}{' (failed)' if failed else ''} "
+            f"on {collection} {keys}: {duration:.0f}ms "
+            f"[{self.get_route() or 'no route'}]"
+        )
+
+    def succeeded(self, event):
+        self.report(event)
+
+    def failed(self, event):
+        self.report(event, failed=True)
+
+
+if SLOW_QUERY_MS:
+    monitoring.register(SlowQueryLogger(SLOW_QUERY_MS))
+
 
 class Client(MongoClient):
     def __init__(self):
-        super().__init__(host=os.getenv("MONGODB_URI", "mongo"))
+        super().__init__(
+            host=os.getenv("MONGODB_URI", "mongo"),
+            maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE", "100")),
+            minPoolSize=int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+        )
+
+
+CLIENT = None  # (pid, Client) shared by the process' collections
+CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """process-wide Client, created on first use
+
+    MongoClient is not fork-safe: uwsgi workers forked from a master that
+    used it get their own"""
+    global CLIENT
+    if CLIENT is None or CLIENT[0] != os.getpid():
+        with CLIENT_LOCK:
+            if CLIENT is None or CLIENT[0] != os.getpid():
+                CLIENT = (os.getpid(), Client())
+    return CLIENT[1]
 
 
 class Database(BaseDatabase):
     def __init__(self):
-        super().__init__(Client(), "Cardshop")
+        super().__init__(get_client(), os.getenv("MONGODB_DBNAME", "Cardshop"))
+
+
+def create_indexes():
+    """create indexes declared by collections (`indexes`). returns names"""
+    names = []
+    for collection_cls in (
+        Users,
+        RefreshTokens,
+        Acknowlegments,
+        Channels,
+        Warehouses,
+        Orders,
+        CreatorTasks,
+        DownloaderTasks,
+        WriterTasks,
+        TaskLogs,
+        AutoImages,
+        PopularContent,
+        PeriodicRuns,
+        EmailOutbox,
+        StripeCustomer,
+        StripeSession,
+    ):
+        collection = collection_cls()
+        names += [
+            f"{collection.name}.{name}"
+            for name in collection.create_indexes(collection_cls.indexes)
+        ]
+    return names
 
 
 class Users(BaseCollection):
@@ -44,6 +155,11 @@ class Users(BaseCollection):
         "role": {"type": "string", "required": True},
     }
 
+    indexes = [
+        IndexModel([("username", ASCENDING)], name="username", unique=True),
+        IndexModel([("email", ASCENDING)], name="email", unique=True),
+    ]
+
     def __init__(self):
         super().__init__(Database(), "users")
 
@@ -57,6 +173,8 @@ class Users(BaseCollection):
 
 
 class RefreshTokens(BaseCollection):
+    indexes = [IndexModel([("token", ASCENDING)], name="token", unique=True)]
+
     def __init__(self):
         super().__init__(Database(), "refresh_tokens")
 
@@ -69,6 +187,13 @@ class Acknowlegments(BaseCollection):
     error = "error"
     no_slot = "no_slot"
 
+    indexes = [
+        IndexModel(
+            [("username", ASCENDING), ("worker_type", ASCENDING), ("slot", ASCENDING)],
+            name="username_worker_type_slot",
+        )
+    ]
+
     def __init__(self):
         super().__init__(Database(), "acknowlegments")
 
@@ -81,20 +206,52 @@ class Acknowlegments(BaseCollection):
         "payload": {"type": "string", "required": False},
     }
 
+    # unchanged acks are written at most once per interval (seconds) and
+    # process. acks written by other processes can thus be that late.
+    write_interval = int(os.getenv("ACK_WRITE_INTERVAL", "30"))
+    written = {}  # (username, worker_type, slot): (_id, status, payload, on)
+    written_lock = threading.Lock()
+
     @classmethod
     def update(
-        cls, username, worker_type, slot, status, payload=None, extra={}, on=None
+        cls, username, worker_type, slot, status, payload=None, extra=None, on=None
     ):
-        # retrieve previsous status
+        key = (username, worker_type, slot)
+        now = datetime.datetime.now()
+        with cls.written_lock:
+            last = cls.written.get(key)
+        if (
+            not extra
+            and last is not None
+            and last[1:3] == (status, payload)
+            and (now - last[3]).total_seconds() < cls.write_interval
+        ):
+            return last[0], False
+
+        # update ack, retrieving previous status
         mfilter = {"username": username, "worker_type": worker_type, "slot": slot}
-        existing = cls().find_one(mfilter, {"status"})
-        previous_status = existing["status"] if existing else None
-        # update ack
-        extra.update(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
+        existing = cls().find_one_and_update(
+            mfilter,
+            {
+                "$set": {
+                    **(extra or {}),
+                    "status": status,
+                    "on": now,
+                    "payload": payload,
+                }
+            },
+            projection={"status": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
         )
-        res = cls().update_one(mfilter, {"$set": extra}, upsert=True)
-        return res.upserted_id or existing["_id"], status != previous_status
+        if existing is None:  # just created
+            existing = {
+                "_id": cls().find_one(mfilter, {"_id": 1})["_id"],
+                "status": None,
+            }
+        with cls.written_lock:
+            cls.written[key] = (existing["_id"], status, payload, now)
+        return existing["_id"], status != existing["status"]
 
     @classmethod
     def idle_update(cls, username, worker_type, slot):
@@ -144,6 +301,8 @@ class Channels(BaseCollection):
         },
     }
 
+    indexes = [IndexModel([("slug", ASCENDING)], name="slug")]
+
     def __init__(self):
         super().__init__(Database(), "channels")
 
@@ -154,6 +313,16 @@ class Channels(BaseCollection):
             raise ValueError("Unable to retrieve channel with slug `{}`".format(slug))
         return channel
 
+    @classmethod
+    def get_private_slugs(cls, but=None):
+        """slugs of private channels, except `but`"""
+        return [
+            channel["slug"]
+            for channel in cls().find(
+                {"private": True, "slug": {"$ne": but}}, {"slug": 1}
+            )
+        ]
+
 
 class Warehouses(BaseCollection):
     schema = {
@@ -161,8 +330,20 @@ class Warehouses(BaseCollection):
         "upload_uri": {"type": "string", "regex": "^.+$", "required": True},
         "download_uri": {"type": "string", "regex": "^.+$", "required": True},
         "active": {"type": "boolean", "default": True, "required": True},
+        # compression of uploaded images (raw images if None)
+        "compression": {
+            "type": "string",
+            "allowed": ["zstd"],
+            "nullable": True,
+            "required": False,
+        },
     }
 
+    indexes = [
+        IndexModel([("slug", ASCENDING)], name="slug"),
+        IndexModel([("upload_uri", ASCENDING)], name="upload_uri"),
+    ]
+
     def __init__(self):
         super().__init__(Database(), "warehouses")
 
@@ -173,6 +354,13 @@ class Warehouses(BaseCollection):
             raise ValueError(f"Unable to find/retrieve object with slug {slug}")
         return order
 
+    @classmethod
+    def get_compression_for(cls, upload_uri):
+        """compression of warehouse uploaded to at upload_uri (orders only
+        record URIs)"""
+        warehouse = cls().find_one({"upload_uri": upload_uri}, {"compression": 1})
+        return (warehouse or {}).get("compression")
+
 
 class Orders(BaseCollection):
 
@@ -263,12 +451,43 @@ class Orders(BaseCollection):
             },
         },
         "warehouse": {"type": "dict", "required": False},
+        # image's torrent, recorded by creator on upload
+        "torrent": {
+            "type": "dict",
+            "required": False,
+            "schema": {
+                "infohash": {"type": "string", "required": True},
+                "magnet": {"type": "string", "required": True},
+            },
+        },
         "channel": {"type": "string", "required": True},
         "statuses": {"type": "list", "required": False},
         "logs": {"type": "list", "required": False},
         "tasks": {"type": "dict", "required": False},
     }
 
+    indexes = [
+        IndexModel([("status", ASCENDING), ("_id", DESCENDING)], name="status_id"),
+        IndexModel([("client.email", ASCENDING)], name="client_email"),
+        IndexModel(
+            [("status", ASCENDING), ("sd_card.expiration", ASCENDING)],
+            name="status_expiration",
+        ),
+    ]
+
+    # fields used when listing orders (config is large: includes branding)
+    list_projection = {
+        "config.name": 1,
+        "sd_card": 1,
+        "quantity": 1,
+        "units": 1,
+        "client": 1,
+        "recipient": 1,
+        "channel": 1,
+        "status": 1,
+        "statuses": 1,
+    }
+
     def __init__(self):
         super().__init__(Database(), "orders")
 
@@ -286,29 +505,60 @@ class Orders(BaseCollection):
 
     @classmethod
     def get_tasks(cls, order_id, with_logs=False):
-        order = cls().get(order_id)
-        return {
-            "create": CreatorTasks().get(
-                order["tasks"].get("create"), with_logs=with_logs
-            ),
-            "download": DownloaderTasks().get(
-                order["tasks"].get("download"), with_logs=with_logs
-            ),
-            "write": [
-                WriterTasks().get(task, with_logs=with_logs)
-                for task in order["tasks"].get("write", [])
-            ],
-        }
+        order = cls.get_with_tasks(order_id, with_logs=with_logs)
+        if order is None:
+            raise ValueError(
+                "Unable to find/retrieve object with ID {}".format(order_id)
+            )
+        return {key: order["tasks"][key] for key in ("create", "download", "write")}
 
     @classmethod
     def get_with_tasks(cls, order_id, with_logs=False):
-        try:
-            order = cls().get(order_id, with_logs=with_logs)
-        except ValueError:
-            order = None
+        """order with its tasks documents in place of their IDs (single query)"""
+        lookups = {
+            "create": CreatorTasks,
+            "download": DownloaderTasks,
+            "write": WriterTasks,
+        }
+        pipeline = [{"$match": {"_id": ensure_objectid(order_id)}}]
+        for key, task_cls in lookups.items():
+            pipeline.append(
+                {
+                    "$lookup": {
+                        "from": task_cls.collection_name,
+                        "localField": f"tasks.{key}",
+                        "foreignField": "_id",
+                        "as": f"_{key}_tasks",
+                    }
+                }
+            )
+        if not with_logs:
+            pipeline.append(
+                {
+                    "$project": {
+                        "logs": 0,
+                        **{f"_{key}_tasks.logs": 0 for key in lookups.keys()},
+                    }
+                }
+            )
+
+        order = next(cls().aggregate(pipeline), None)
         if order is None:
             return order
-        order["tasks"].update(cls().get_tasks(order_id, with_logs=with_logs))
+        tasks = {
+            key: {task["_id"]: task for task in order.pop(f"_{key}_tasks")}
+            for key in lookups.keys()
+        }
+        order["tasks"].update(
+            {
+                "create": tasks["create"].get(order["tasks"].get("create")),
+                "download": tasks["download"].get(order["tasks"].get("download")),
+                "write": [
+                    tasks["write"].get(task_id)
+                    for task_id in order["tasks"].get("write", [])
+                ],
+            }
+        )
         return order
 
     @classmethod
@@ -329,6 +579,9 @@ class Orders(BaseCollection):
             "fname": order["fname"],
             "upload_uri": order["warehouse"]["upload_uri"],
             "download_uri": order["warehouse"]["download_uri"],
+            "compression": Warehouses.get_compression_for(
+                order["warehouse"]["upload_uri"]
+            ),
             "worker": None,
             "config": order["config"],
             "config_yaml": order.get("config_yaml", ""),
@@ -375,6 +628,8 @@ class Orders(BaseCollection):
             "image_fname": upload_details.get("fname"),
             "image_checksum": upload_details.get("checksum"),
             "image_size": upload_details.get("size"),
+            "image_compression": upload_details.get("compression"),
+            "image_compressed_size": upload_details.get("compressed_size"),
             "logs": {"worker": None, "downloader": None},
             "status": DownloaderTasks.pending,
             "statuses": [
@@ -404,6 +659,7 @@ class Orders(BaseCollection):
             "image_fname": order["tasks"]["download"]["image_fname"],
             "image_checksum": order["tasks"]["download"]["image_checksum"],
             "image_size": order["tasks"]["download"]["image_size"],
+            "image_compression": order["tasks"]["download"].get("image_compression"),
             "logs": {"worker": None, "downloader": None},
             "status": DownloaderTasks.pending,
             "statuses": [
@@ -423,18 +679,21 @@ class Orders(BaseCollection):
         return task_ids
 
     @classmethod
-    def update_status(cls, order_id, status, payload=None, extra_update={}):
-        order = cls.get(order_id)
+    def update_status(cls, order_id, status, payload=None, extra_update=None):
         # don't update if still current status
-        if status == order["status"]:
-            return
-        statuses = order["statuses"]
-        statuses.append(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
+        cls().update_one(
+            {"_id": ObjectId(order_id), "status": {"$ne": status}},
+            {
+                "$set": {"status": status, **(extra_update or {})},
+                "$push": {
+                    "statuses": {
+                        "status": status,
+                        "on": datetime.datetime.now(),
+                        "payload": payload,
+                    }
+                },
+            },
         )
-        update = {"status": status, "statuses": statuses}
-        update.update(extra_update)
-        cls().update_one({"_id": ObjectId(order_id)}, {"$set": update})
 
     @classmethod
     def add_shipment(cls, order_id, shipment_details):
@@ -443,11 +702,32 @@ class Orders(BaseCollection):
         cls().update_status(order_id, Orders.shipped)
 
     @classmethod
-    def all_pending_expiry(cls):
-        return [
-            cls().get(res["_id"])
-            for res in cls().find({"status": cls.pending_expiry}, {"_id": 1})
-        ]
+    def get_many(cls, order_ids):
+        """{order_id: order} of existing orders amongst order_ids (no logs)"""
+        return {
+            order["_id"]: order
+            for order in cls().find(
+                {"_id": {"$in": [ensure_objectid(oid) for oid in order_ids]}},
+                {"logs": 0},
+            )
+        }
+
+    @classmethod
+    def expire_all(cls, now):
+        """mark pending_expiry orders which expiration passed. returns count"""
+        return (
+            cls()
+            .update_many(
+                {"status": cls.pending_expiry, "sd_card.expiration": {"$lt": now}},
+                {
+                    "$set": {"status": cls.expired},
+                    "$push": {
+                        "statuses": {"status": cls.expired, "on": now, "payload": None}
+                    },
+                },
+            )
+            .modified_count
+        )
 
     @classmethod
     def anonymize(cls, order_ids):
@@ -546,6 +826,18 @@ class Tasks(BaseCollection):
         timedout,
     ]
     IN_PROGRESS_STATUSES = [building, uploading, downloading, wiping_sdcard, writing]
+    # in-progress statuses time out after a delay or, for transfers, at a
+    # minimum rate for the image size. recorded as expires_at
+    TIMEOUTS = {
+        building: datetime.timedelta(hours=12),
+        wiping_sdcard: datetime.timedelta(minutes=30),
+    }
+    TRANSFER_STATUSES = [uploading, downloading, writing]
+    TRANSFER_MIN_BPS = int(humanfriendly.parse_size("4MiB") / 8)
+    # transfers of unknown size
+    TRANSFER_DEFAULT_TIMEOUT = datetime.timedelta(
+        hours=int(os.getenv("TRANSFER_DEFAULT_TIMEOUT_HOURS", "12"))
+    )
 
     CREATOR_SUCCESS_STATUSES = [uploaded, uploaded_public]
     DOWNLOADER_SUCCESS_STATUSES = [
@@ -565,8 +857,12 @@ class Tasks(BaseCollection):
         )
 
     @classmethod
-    def cascade_status(cls, task_id, task_status):
-        task = cls.get(task_id)
+    def cascade_status(cls, task_id, task_status, task=None):
+        """update task's order status according to task_status
+
+        task: the task document if at hand (from update_status), to spare a read"""
+        if task is None:
+            task = cls.get(task_id)
 
         cascade_map = {
             Tasks.received: Orders.creating,
@@ -615,8 +911,6 @@ class Tasks(BaseCollection):
         wipe_log=None,
         writer_log=None,
     ):
-        if worker_log is None and installer_log is None:
-            return
         update = {}
         if worker_log is not None:
             update.update({"logs.worker": worker_log})
@@ -631,57 +925,230 @@ class Tasks(BaseCollection):
         if writer_log is not None:
             update.update({"logs.writer": writer_log})
 
+        if not update:
+            return
         cls().update_one({"_id": ObjectId(task_id)}, {"$set": update})
 
     @classmethod
-    def update_status(cls, task_id, status, payload=None, extra_update={}):
-        task = cls.get(task_id)
-        statuses = task["statuses"]
-        statuses.append(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
+    def get_expires_at(cls, status, since, task=None):
+        """when a task in status since `since` times out (None if it doesn't)
+
+        transfers' require the task (its size). TRANSFER_DEFAULT_TIMEOUT
+        applies to those of unknown size"""
+        if status in cls.TIMEOUTS:
+            return since + cls.TIMEOUTS[status]
+        if status in cls.TRANSFER_STATUSES and task is not None:
+            size = cls.get_size(task)
+            if not size:
+                return since + cls.TRANSFER_DEFAULT_TIMEOUT
+            return since + datetime.timedelta(seconds=int(size / cls.TRANSFER_MIN_BPS))
+        return None
+
+    @classmethod
+    def status_update(
+        cls, status, on, payload=None, extra_update=None, expires_at=None
+    ):
+        """update document recording a new status"""
+        update = {
+            "$set": {"status": status, **(extra_update or {})},
+            "$push": {"statuses": {"status": status, "on": on, "payload": payload}},
+        }
+        if expires_at:
+            update["$set"]["expires_at"] = expires_at
+        else:
+            update["$unset"] = {"expires_at": ""}
+        return update
+
+    @classmethod
+    def update_status(cls, task_id, status, payload=None, extra_update=None):
+        """record new status atomically. returns updated task (None if missing)"""
+        now = datetime.datetime.now()
+        task = cls().find_one_and_update(
+            {"_id": ObjectId(task_id)},
+            cls.status_update(
+                status,
+                on=now,
+                payload=payload,
+                extra_update=extra_update,
+                expires_at=cls.get_expires_at(status, now),
+            ),
+            projection={"logs": 0},
+            return_document=ReturnDocument.AFTER,
         )
-        update = {"status": status, "statuses": statuses}
-        update.update(extra_update)
-        cls().update_one({"_id": ObjectId(task_id)}, {"$set": update})
+        # transfers' timeout depends on task's size
+        if task is not None and status in cls.TRANSFER_STATUSES:
+            task["expires_at"] = cls.get_expires_at(status, now, task)
+            if task["expires_at"]:
+                cls().update_one(
+                    {"_id": task["_id"], "status": status},
+                    {"$set": {"expires_at": task["expires_at"]}},
+                )
+        return task
 
     @classmethod
     def register(cls, task_id, worker):
-        cls.update_status(
-            task_id=task_id,
-            status=cls.received,
-            extra_update={"worker": worker["username"]},
-            payload="assigned worker: {}".format(worker["username"]),
+        return cls.claim(worker, task_id=task_id)
+
+    # shared by all tasks collections
+    indexes = [
+        IndexModel(
+            [("status", ASCENDING), ("channel", ASCENDING), ("worker", ASCENDING)],
+            name="status_channel_worker",
+        ),
+        IndexModel([("order", ASCENDING)], name="order"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at", sparse=True),
+    ]
+
+    # additional filter on tasks workers can claim
+    claimable_query = {}
+    # field (GB) availables' max_size applies to. max_size ignored if None
+    max_size_field = None
+    # fields workers don't need in tasks lists
+    availables_projection = {"config": 0, "logs": 0, "statuses": 0}
+
+    @classmethod
+    def availables_query(cls, worker, channel=None, max_size=None):
+        """pending tasks worker can take (uses status_channel_worker index)
+
+        tasks of private channels only go to workers of that channel.
+        max_size (GB) excludes tasks worker has no room for (creators')"""
+        query = {
+            "status": cls.pending,
+            "worker": {"$in": [None, worker]},
+            **cls.claimable_query,
+        }
+        private_channels = Channels.get_private_slugs(but=channel)
+        if private_channels:
+            query["channel"] = {"$nin": private_channels}
+        if max_size is not None and cls.max_size_field:
+            query[cls.max_size_field] = {"$lte": max_size}
+        return query
+
+    @classmethod
+    def claim(cls, worker, task_id=None, max_size=None):
+        """atomically assign a pending task to worker. returns it or None
+
+        task_id to claim that one, otherwise the oldest pending task not
+        assigned to another worker (and of at most max_size)"""
+        query = cls.availables_query(
+            worker["username"], worker.get("channel"), max_size
+        )
+        if task_id is not None:
+            query["_id"] = ensure_objectid(task_id)
+        return cls().find_one_and_update(
+            query,
+            {
+                "$set": {"status": cls.received, "worker": worker["username"]},
+                "$push": {
+                    "statuses": {
+                        "status": cls.received,
+                        "on": datetime.datetime.now(),
+                        "payload": "assigned worker: {}".format(worker["username"]),
+                    }
+                },
+            },
+            projection={"logs": 0},
+            sort=[("_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
         )
 
     @classmethod
-    def find_availables(cls, channel):
-        tasks = [
-            cls.get(task.get("_id"))
-            for task in cls().find({"status": cls.pending}, {"_id": 1})
-        ]
-        return tasks
+    def find_availables(cls, worker, channel=None, limit=10, max_size=None):
+        """oldest pending tasks worker can take, in a single query"""
+        return list(
+            cls()
+            .find(
+                cls.availables_query(worker, channel, max_size),
+                cls.availables_projection,
+            )
+            .sort([("_id", ASCENDING)])
+            .limit(limit)
+        )
 
     @classmethod
-    def all_inprogress(cls):
-        tasks = []
-        for tcls in (CreatorTasks, DownloaderTasks, WriterTasks):
-            xtasks = tcls().find(
-                {"status": {"$in": cls.IN_PROGRESS_STATUSES}}, {"_id": 1}
+    def has_availables(cls, worker, channel=None, max_size=None):
+        """whether find_availables() would return tasks (cheap check)"""
+        return bool(
+            cls().count_documents(
+                cls.availables_query(worker, channel, max_size), limit=1
             )
-            tasks += [(tcls, tcls.get(t["_id"])) for t in xtasks]
-        return tasks
+        )
+
+    @classmethod
+    def get_statuses(cls, task_ids):
+        """{task_id: status} for existing tasks among task_ids"""
+        return {
+            str(task["_id"]): task["status"]
+            for task in cls().find({"_id": {"$in": task_ids}}, {"status": 1})
+        }
 
     @classmethod
     def cancel(cls, task_id):
         cls.update_status(task_id, cls.canceled)
 
     @classmethod
-    def get_size(cls, task_id):
-        task = cls.get(task_id)
-        if isinstance(task, CreatorTasks):
-            return humanfriendly.parse_size(task["config"]["size"])
-        if isinstance(task, (DownloaderTasks, WriterTasks)):
-            return task["image_size"]
+    def get_size(cls, task):
+        """size of the image the task transfers (bytes). None if unknown"""
+        return task.get("image_size")
+
+    @classmethod
+    def all_expired(cls, now):
+        """(task class, task) of in-progress tasks which timed out by now"""
+        tasks = []
+        for tcls in (CreatorTasks, DownloaderTasks, WriterTasks):
+            tasks += [
+                (tcls, task)
+                for task in tcls().find(
+                    {"expires_at": {"$lte": now}},
+                    {"order": 1, "status": 1, "expires_at": 1},
+                )
+            ]
+        return tasks
+
+    @classmethod
+    def timeout(cls, task_ids, now):
+        """mark tasks (that are still expired) as timedout. returns their IDs"""
+        cls().update_many(
+            {"_id": {"$in": task_ids}, "expires_at": {"$lte": now}},
+            cls.status_update(cls.timedout, on=now),
+        )
+        return [
+            task["_id"]
+            for task in cls().find(
+                {"_id": {"$in": task_ids}, "status": cls.timedout}, {"_id": 1}
+            )
+        ]
+
+    @classmethod
+    def cancel_peers(cls, order_id, task_id):
+        """mark tasks of the order other than task_id as canceled"""
+        cls().update_many(
+            {"order": order_id, "_id": {"$ne": task_id}},
+            cls.status_update(cls.canceled, on=datetime.datetime.now()),
+        )
+
+    @classmethod
+    def backfill_expires_at(cls):
+        """record expires_at of in-progress tasks last updated without it"""
+        count = 0
+        for tcls in (CreatorTasks, DownloaderTasks, WriterTasks):
+            for task in tcls().find(
+                {
+                    "status": {"$in": cls.IN_PROGRESS_STATUSES},
+                    "expires_at": {"$exists": False},
+                },
+                {"logs": 0},
+            ):
+                expires_at = tcls.get_expires_at(
+                    task["status"], task["statuses"][-1]["on"], task
+                )
+                if expires_at:
+                    tcls().update_one(
+                        {"_id": task["_id"], "status": task["status"]},
+                        {"$set": {"expires_at": expires_at}},
+                    )
+                    count += 1
+        return count
 
 
 class CreatorTasks(Tasks):
@@ -694,6 +1161,7 @@ class CreatorTasks(Tasks):
         "worker": {"type": "string", "required": True, "nullable": True},
         "config": {"type": "dict", "required": True},
         "config_yaml": {"type": "string", "required": False},
+        "compression": {"type": "string", "required": False, "nullable": True},
         "size": {"type": "integer", "required": True},
         "logs": {"type": "dict"},
         "image": {"type": "dict", "required": False},
@@ -701,8 +1169,24 @@ class CreatorTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
+    # creators only handle tasks uploading to S3 from a YAML config
+    claimable_query = {
+        "upload_uri": {"$regex": "^s3://"},
+        "config_yaml": {"$nin": [None, ""]},
+    }
+    max_size_field = "size"
+
+    collection_name = "creator_tasks"
+
+    @classmethod
+    def get_size(cls, task):
+        try:
+            return humanfriendly.parse_size(task["config"]["size"])
+        except (KeyError, TypeError, humanfriendly.InvalidSize):
+            return None
+
     def __init__(self):
-        super().__init__(Database(), "creator_tasks")
+        super().__init__(Database(), self.collection_name)
 
 
 class DownloaderTasks(Tasks):
@@ -715,13 +1199,21 @@ class DownloaderTasks(Tasks):
         "image_fname": {"type": "string", "regex": "^.+$", "required": True},
         "image_checksum": {"type": "string", "required": True},
         "image_size": {"type": "integer", "required": True},  # bytes
+        "image_compression": {"type": "string", "required": False, "nullable": True},
+        "image_compressed_size": {  # bytes
+            "type": "integer",
+            "required": False,
+            "nullable": True,
+        },
         "logs": {"type": "list"},
         "status": {"type": "string", "required": True},
         "statuses": {"type": "list"},
     }
 
+    collection_name = "downloader_tasks"
+
     def __init__(self):
-        super().__init__(Database(), "downloader_tasks")
+        super().__init__(Database(), self.collection_name)
 
 
 class WriterTasks(Tasks):
@@ -733,14 +1225,114 @@ class WriterTasks(Tasks):
         "name": {"type": "string", "regex": "^.+$", "required": True},
         "image_checksum": {"type": "string", "required": True},
         "image_size": {"type": "integer", "required": True},  # bytes
+        "image_compression": {"type": "string", "required": False, "nullable": True},
         "sd_size": {"type": "integer", "required": True},
         "logs": {"type": "list"},
         "status": {"type": "string", "required": True},
         "statuses": {"type": "list"},
     }
 
+    collection_name = "writer_tasks"
+
+    def __init__(self):
+        super().__init__(Database(), self.collection_name)
+
+
+class TaskLogs(BaseCollection):
+    """Tasks logs stored as append-only chunks
+
+    Each document is a chunk of a task's log of a given kind, starting at
+    `offset` (in bytes) and of `size` bytes. The end of a log (its size) is
+    the offset+size of its last chunk. Chunks dont overlap but there can be
+    gaps should a worker have lost part of a log."""
+
+    KINDS = ["worker", "installer", "uploader", "downloader", "wipe", "writer"]
+
+    schema = {
+        "task": {"type": "string", "required": True},
+        "kind": {"type": "string", "allowed": KINDS, "required": True},
+        "offset": {"type": "integer", "required": True},
+        "size": {"type": "integer", "required": True},
+        "content": {"type": "binary", "required": True},
+        "on": {"type": "datetime", "required": True},
+    }
+
+    indexes = [
+        IndexModel(
+            [("task", ASCENDING), ("kind", ASCENDING), ("offset", ASCENDING)],
+            name="task_kind_offset",
+            unique=True,
+        )
+    ]
+
     def __init__(self):
-        super().__init__(Database(), "writer_tasks")
+        super().__init__(Database(), "task_logs")
+
+    @classmethod
+    def get_end(cls, task_id, kind):
+        """offset of the end of the log (its total size in bytes)"""
+        last = cls().find_one(
+            {"task": ensure_objectid(task_id), "kind": kind},
+            {"offset": 1, "size": 1},
+            sort=[("offset", DESCENDING)],
+        )
+        return last["offset"] + last["size"] if last else 0
+
+    @classmethod
+    def append(cls, task_id, kind, offset, chunk):
+        """append chunk (bytes, starting at offset) to log. returns new end offset
+
+        Already received bytes are ignored so clients can safely resend."""
+        end = cls.get_end(task_id, kind)
+        data = chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+        if offset + len(data) <= end:
+            return end
+
+        if offset < end:
+            data = data[end - offset :]
+            offset = end
+        try:
+            cls().insert_one(
+                {
+                    "task": ensure_objectid(task_id),
+                    "kind": kind,
+                    "offset": offset,
+                    "size": len(data),
+                    "content": data,
+                    "on": datetime.datetime.now(),
+                }
+            )
+        except DuplicateKeyError:
+            # concurrent append of the same range
+            return cls.get_end(task_id, kind)
+        return offset + len(data)
+
+    @classmethod
+    def read(cls, task_id, kind, offset=0, size=None):
+        """(data, total) bytes of log between offset and offset+size"""
+        query = {"task": ensure_objectid(task_id), "kind": kind}
+        total = cls.get_end(task_id, kind)
+        stop = total if size is None else min([offset + size, total])
+        if offset >= stop:
+            return b"", total
+
+        # chunk containing offset is the last one starting before or on it
+        first = cls().find_one(
+            dict(query, offset={"$lte": offset}),
+            {"offset": 1},
+            sort=[("offset", DESCENDING)],
+        )
+        query["offset"] = {"$gte": first["offset"] if first else 0, "$lt": stop}
+        data = b""
+        for chunk in cls().find(query).sort("offset", ASCENDING):
+            data += chunk["content"][
+                max([offset - chunk["offset"], 0]) : stop - chunk["offset"]
+            ]
+        return data, total
+
+    @classmethod
+    def delete_for(cls, task_id):
+        return cls().delete_many({"task": ensure_objectid(task_id)}).deleted_count
 
 
 class AutoImages(BaseCollection):
@@ -780,6 +1372,11 @@ class AutoImages(BaseCollection):
         "channel": {"type": "string", "required": True},
     }
 
+    indexes = [
+        IndexModel([("slug", ASCENDING)], name="slug"),
+        IndexModel([("status", ASCENDING)], name="status"),
+    ]
+
     def __init__(self):
         super().__init__(Database(), "autoimages")
 
@@ -854,6 +1451,214 @@ class AutoImages(BaseCollection):
         }
 
 
+class PopularContent(BaseCollection):
+    """most used content across manager's configurations, for cache warming
+
+    replaced as a whole whenever manager publishes its content stats"""
+
+    schema = {
+        "kind": {"type": "string", "allowed": ["file", "image"], "required": True},
+        "ident": {"type": "string", "required": True},
+        "url": {"type": "string", "required": True, "nullable": True},
+        "size": {"type": "integer", "required": True},  # bytes
+        "count": {"type": "integer", "required": True},  # nb of configs using it
+    }
+
+    indexes = [IndexModel([("count", DESCENDING)], name="count")]
+
+    def __init__(self):
+        super().__init__(Database(), "popular_content")
+
+    @classmethod
+    def replace_all(cls, items):
+        cls().delete_many({})
+        if items:
+            cls().insert_many(
+                [{key: item.get(key) for key in cls.schema.keys()} for item in items]
+            )
+
+    @classmethod
+    def get_top(cls, limit=None):
+        cursor = cls().find({}, {"_id": 0}).sort("count", DESCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+
+class PeriodicRuns(BaseCollection):
+    """timings of periodic-tasks runs, kept for a month"""
+
+    schema = {
+        "started_on": {"type": "datetime", "required": True},
+        "duration": {"type": "float", "required": True},  # seconds
+        "steps": {"type": "dict", "required": True},  # name: seconds
+        "counts": {"type": "dict", "required": True},  # name: nb of items handled
+    }
+
+    indexes = [
+        IndexModel(
+            [("started_on", ASCENDING)],
+            name="started_on",
+            expireAfterSeconds=30 * 24 * 3600,
+        )
+    ]
+
+    def __init__(self):
+        super().__init__(Database(), "periodic_runs")
+
+    @classmethod
+    def record(cls, started_on, duration, steps, counts):
+        cls().insert_one(
+            {
+                "started_on": started_on,
+                "duration": duration,
+                "steps": steps,
+                "counts": counts,
+            }
+        )
+
+
+class EmailOutbox(BaseCollection):
+    """emails to send (by email-outbox.py), as sending function and its args"""
+
+    pending = "pending"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+
+    # attempts before giving up
+    max_attempts = int(os.getenv("EMAIL_MAX_ATTEMPTS", "8"))
+    # seconds before first retry ; doubled on each attempt up to max_retry_delay
+    retry_delay = int(os.getenv("EMAIL_RETRY_DELAY", "60"))
+    max_retry_delay = int(os.getenv("EMAIL_MAX_RETRY_DELAY", "3600"))
+    # seconds after which a claimed email not reported is claimable again
+    sending_timeout = int(os.getenv("EMAIL_SENDING_TIMEOUT", "600"))
+
+    schema = {
+        # idempotency key (dropped when given up on, for the event to be retried)
+        "key": {"type": "string", "required": False},
+        "email": {"type": "string", "required": True},  # sending function
+        "args": {"type": "list", "required": True},
+        # order emails: order (with its tasks) when queued, rendered from
+        "snapshot": {"type": "dict", "required": False},
+        "status": {"type": "string", "required": True},
+        "attempts": {"type": "integer", "required": True},
+        "created_on": {"type": "datetime", "required": True},
+        "next_attempt_on": {"type": "datetime", "required": True},
+        "sent_on": {"type": "datetime", "required": False},
+        "error": {"type": "string", "required": False},
+        # recipients of the messages already sent (not resent on retries)
+        "sent_parts": {"type": "list", "required": False},
+    }
+
+    indexes = [
+        IndexModel([("key", ASCENDING)], name="key", unique=True, sparse=True),
+        IndexModel(
+            [("status", ASCENDING), ("next_attempt_on", ASCENDING)],
+            name="status_next_attempt",
+        ),
+        IndexModel(
+            [("sent_on", ASCENDING)],
+            name="sent_on",
+            expireAfterSeconds=30 * 24 * 3600,
+        ),
+    ]
+
+    def __init__(self):
+        super().__init__(Database(), "email_outbox")
+
+    @classmethod
+    def enqueue(cls, email, args, key=None, snapshot=None):
+        """add email to outbox. returns its _id (None if key already queued)
+
+        snapshot: order (with its tasks) as of the event, to render from"""
+        now = datetime.datetime.now()
+        document = {
+            "email": email,
+            "args": list(args),
+            "status": cls.pending,
+            "attempts": 0,
+            "created_on": now,
+            "next_attempt_on": now,
+        }
+        if key is not None:
+            document["key"] = key
+        if snapshot is not None:
+            document["snapshot"] = snapshot
+        try:
+            return cls().insert_one(document).inserted_id
+        except DuplicateKeyError:
+            return None
+
+    @classmethod
+    def claim(cls, now, limit):
+        """atomically take up to limit due emails, oldest first
+
+        emails claimed but not reported within sending_timeout are due again"""
+        emails = []
+        while len(emails) < limit:
+            email = cls().find_one_and_update(
+                {
+                    "status": {"$in": [cls.pending, cls.sending]},
+                    "next_attempt_on": {"$lte": now},
+                },
+                {
+                    "$set": {
+                        "status": cls.sending,
+                        "next_attempt_on": now
+                        + datetime.timedelta(seconds=cls.sending_timeout),
+                    },
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("next_attempt_on", ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if email is None:
+                break
+            emails.append(email)
+        return emails
+
+    @classmethod
+    def mark_sent(cls, email_id, now):
+        cls().update_one(
+            {"_id": email_id},
+            {"$set": {"status": cls.sent, "sent_on": now}, "$unset": {"error": ""}},
+        )
+
+    @classmethod
+    def add_sent_part(cls, email_id, part):
+        cls().update_one({"_id": email_id}, {"$addToSet": {"sent_parts": part}})
+
+    @classmethod
+    def mark_failed(cls, email, error, now):
+        """schedule a retry with exponential backoff or give up. returns status
+
+        given up emails release their key"""
+        if email["attempts"] >= cls.max_attempts:
+            status, next_attempt_on = cls.failed, now
+        else:
+            status = cls.pending
+            next_attempt_on = now + datetime.timedelta(
+                seconds=min(
+                    [
+                        cls.retry_delay * 2 ** (email["attempts"] - 1),
+                        cls.max_retry_delay,
+                    ]
+                )
+            )
+        update = {
+            "$set": {
+                "status": status,
+                "next_attempt_on": next_attempt_on,
+                "error": error,
+            }
+        }
+        if status == cls.failed:
+            update["$unset"] = {"key": ""}
+        cls().update_one({"_id": email["_id"]}, update)
+        return status
+
+
 class StripeCustomer(BaseCollection):
     schema = {
         "email": {
@@ -867,6 +1672,8 @@ class StripeCustomer(BaseCollection):
         "username": {"type": "string", "required": False},
     }
 
+    indexes = [IndexModel([("email", ASCENDING)], name="email")]
+
     def __init__(self):
         super().__init__(Database(), "stripe_customer")
 
@@ -897,6 +1704,8 @@ class StripeSession(BaseCollection):
         "http_url": {"type": "string", "required": False},
     }
 
+    indexes = [IndexModel([("session_id", ASCENDING)], name="session_id")]
+
     def __init__(self):
         super().__init__(Database(), "stripe_session")
 
@@ -5,9 +5,12 @@
 import re
 import os
 import io
+import time
 import base64
 import logging
-import tempfile
+import functools
+import threading
+import collections
 import urllib.parse
 
 import torf
@@ -21,6 +24,13 @@ from qrcode.image.pure import PymagingImage
 logger = logging.getLogger(__name__)
 re_newlines = re.compile(r"\r\n|\r")  # Used in normalize_newlines
 
+# magnets of torrents fetched for orders without a recorded one (LRU), by URL
+MAGNETS = collections.OrderedDict()  # torrent_url: (magnet, fetched_on)
+MAGNETS_SIZE = int(os.getenv("MAGNET_CACHE_SIZE", "256"))
+MAGNETS_TTL = int(os.getenv("MAGNET_CACHE_TTL", "3600"))  # seconds
+MAGNETS_LOCK = threading.Lock()
+TORRENT_FETCH_TIMEOUT = int(os.getenv("TORRENT_FETCH_TIMEOUT", "10"))  # seconds
+
 
 def get_id(an_object):
     """return the _id prop of the mongo object/dict"""
@@ -67,27 +77,49 @@ def public_download_url_has_torrent(order):
     )
 
 
+def fetch_magnet_for_torrent(torrent_url):
+    res = requests.get(torrent_url, timeout=TORRENT_FETCH_TIMEOUT)
+    res.raise_for_status()
+    torrent = torf.Torrent.read_stream(io.BytesIO(res.content))
+    return str(torrent.magnet())
+
+
 def get_magnet_for_torrent(torrent_url):
+    """magnet URI of a torrent file, cached for MAGNETS_TTL. None on error"""
+    now = time.monotonic()
+    with MAGNETS_LOCK:
+        cached = MAGNETS.get(torrent_url)
+        if cached is not None and now - cached[1] < MAGNETS_TTL:
+            MAGNETS.move_to_end(torrent_url)
+            return cached[0]
+
     try:
-        res = requests.get(torrent_url)
-        torrent = torf.Torrent.read_stream(io.BytesIO(res.content))
-        return str(torrent.magnet())
+        magnet = fetch_magnet_for_torrent(torrent_url)
     except Exception as exc:
         logger.error("Unable to retrieve torrent file")
         logger.exception(exc)
+        return None
+
+    with MAGNETS_LOCK:
+        MAGNETS.pop(torrent_url, None)
+        while len(MAGNETS) >= MAGNETS_SIZE:
+            MAGNETS.popitem(last=False)
+        MAGNETS[torrent_url] = (magnet, now)
+    return magnet
+
+
+def get_magnet_for(order):
+    """magnet URI of order's torrent: recorded on upload or from its file"""
+    recorded = (order.get("torrent") or {}).get("magnet")
+    if recorded:
+        return recorded
+    return get_magnet_for_torrent(get_public_download_torrent_url(order))
 
 
 def get_public_download_magnet_url(order):
     if not public_download_url_has_torrent(order):
         return
-    try:
-        res = requests.get(get_public_download_torrent_url(order))
-        torrent = torf.Torrent.read_stream(io.BytesIO(res.content))
-        return torrent.magnet()
-    except Exception as exc:
-        logger.error("Unable to retrieve torrent file")
-        logger.exception(exc)
-    return get_public_download_url(order)
+    return get_magnet_for(order) or get_public_download_url(order)
 
 
 def yesno(value):
@@ -118,13 +150,13 @@ def linebreaksbr(value, autoescape=True):
     return Markup(value.replace("\n", "<br />"))
 
 
+@functools.lru_cache(maxsize=int(os.getenv("QRCODE_CACHE_SIZE", "256")))
 def b64qrcode(text):
-    """encodes the text in PNG QRCode then return its base64 repr"""
+    """encodes the text in PNG QRCode then return its base64 repr. memoized"""
     img = qrcode.make(text, image_factory=PymagingImage)
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=True) as qfile:
-        img.save(qfile)
-        qfile.seek(0)
-        return base64.b64encode(qfile.read()).decode("utf-8")
+    buffer = io.BytesIO()
+    img.save(buffer)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
 
 
 def amount_str(amount):
@@ -1,7 +1,13 @@
+import os
+import copy
 import json
+import time
 import uuid
 import string
 import random
+import hashlib
+import threading
+import collections
 from datetime import datetime, timedelta
 
 import jwt
@@ -14,6 +20,11 @@ class AccessToken:
     )
     issuer = "scheduler"
 
+    # payloads of verified tokens (LRU), by token digest
+    verified = collections.OrderedDict()
+    verified_size = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+    verified_lock = threading.Lock()
+
     class JSONEncoder(json.JSONEncoder):
         def default(self, o):
             if isinstance(o, datetime):
@@ -42,4 +53,30 @@ class AccessToken:
 
     @classmethod
     def decode(cls, token: str) -> dict:
-        return jwt.decode(token, cls.secret, algorithms=["HS256"])
+        """verified payload of token. cached until it expires
+
+        returns a copy so callers can't alter the cached payload"""
+        if not isinstance(token, str):
+            return jwt.decode(token, cls.secret, algorithms=["HS256"])
+
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        with cls.verified_lock:
+            payload = cls.verified.get(key)
+            if payload is not None:
+                if payload["exp"] > time.time():
+                    cls.verified.move_to_end(key)
+                    return copy.deepcopy(payload)
+                del cls.verified[key]  # expired: let jwt raise
+
+        payload = jwt.decode(token, cls.secret, algorithms=["HS256"])
+        with cls.verified_lock:
+            if len(cls.verified) >= cls.verified_size:
+                now = time.time()
+                for expired in [
+                    key for key, value in cls.verified.items() if value["exp"] <= now
+                ]:
+                    del cls.verified[expired]
+            while len(cls.verified) >= cls.verified_size:
+                cls.verified.popitem(last=False)
+            cls.verified[key] = copy.deepcopy(payload)
+        return payload
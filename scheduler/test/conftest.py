@@ -1,3 +1,5 @@
+import os
+
 import pytest
 import requests
 
@@ -24,3 +26,32 @@ def access_token(authorize):
 @pytest.fixture(scope="class")
 def refresh_token(authorize):
     return authorize["refresh_token"]
+
+
+@pytest.fixture(scope="module")
+def mongodb(request):
+    """throwaway database (with indexes) on MONGODB_URI's mongod, per module"""
+    from pymongo import MongoClient
+    from pymongo.errors import ServerSelectionTimeoutError
+    from utils import mongo
+
+    uri = os.environ.setdefault("MONGODB_URI", "localhost")
+    client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        pytest.skip("no mongod reachable at MONGODB_URI")
+
+    dbname = "Cardshop_{}".format(request.module.__name__.rsplit(".", 1)[-1])
+    os.environ["MONGODB_DBNAME"] = dbname
+    mongo.create_indexes()
+    yield client[dbname]
+    client.drop_database(dbname)
+
+
+@pytest.fixture
+def database(mongodb):
+    """mongodb, emptied after each test"""
+    yield mongodb
+    for name in mongodb.list_collection_names():
+        mongodb[name].delete_many({})
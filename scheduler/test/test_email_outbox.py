@@ -0,0 +1,245 @@
+import datetime
+import pathlib
+import sys
+import types
+
+import pytest
+from bson import ObjectId
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("src")))
+
+import emailing  # noqa: E402
+from utils.mongo import EmailOutbox, Orders  # noqa: E402
+
+
+def get_now():
+    """now, as stored by mongo (milliseconds)"""
+    now = datetime.datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def get_email(email_id):
+    return EmailOutbox().find_one({"_id": email_id})
+
+
+def test_lifecycle(database):
+    email_id = EmailOutbox.enqueue("send_order_created_email", ["order"])
+    now = get_now()
+
+    email = EmailOutbox.claim(now, limit=10)[0]
+    assert email["_id"] == email_id
+    assert email["status"] == EmailOutbox.sending
+    assert email["attempts"] == 1
+    # claimed ones aren't due until they time out
+    assert not EmailOutbox.claim(now, limit=10)
+
+    EmailOutbox.mark_sent(email_id, now)
+    email = get_email(email_id)
+    assert email["status"] == EmailOutbox.sent
+    assert email["sent_on"] == now
+    timeout = datetime.timedelta(seconds=EmailOutbox.sending_timeout)
+    assert not EmailOutbox.claim(now + timeout, limit=10)
+
+
+def test_claim_order_and_limit(database):
+    email_ids = [EmailOutbox.enqueue("send_order_created_email", [i]) for i in range(3)]
+    now = get_now()
+
+    assert [email["_id"] for email in EmailOutbox.claim(now, limit=2)] == email_ids[:2]
+    assert [email["_id"] for email in EmailOutbox.claim(now, limit=2)] == email_ids[2:]
+    assert not EmailOutbox.claim(now, limit=2)
+
+
+def test_claim_unreported(database):
+    """emails claimed but not reported (sender died) are due again"""
+    email_id = EmailOutbox.enqueue("send_order_created_email", ["order"])
+    now = get_now()
+    EmailOutbox.claim(now, limit=1)
+
+    later = now + datetime.timedelta(seconds=EmailOutbox.sending_timeout)
+    email = EmailOutbox.claim(later, limit=1)[0]
+    assert email["_id"] == email_id
+    assert email["attempts"] == 2
+
+
+def test_mark_failed_backoff(database, monkeypatch):
+    monkeypatch.setattr(EmailOutbox, "max_attempts", 4)
+    monkeypatch.setattr(EmailOutbox, "retry_delay", 60)
+    monkeypatch.setattr(EmailOutbox, "max_retry_delay", 150)
+    email_id = EmailOutbox.enqueue("send_order_created_email", ["order"], key="k")
+    now = get_now()
+
+    for delay in (60, 120, 150):
+        email = EmailOutbox.claim(now, limit=1)[0]
+        assert EmailOutbox.mark_failed(email, "error", now) == EmailOutbox.pending
+        now += datetime.timedelta(seconds=delay)
+        assert get_email(email_id)["next_attempt_on"] == now
+        assert not EmailOutbox.claim(now - datetime.timedelta(seconds=1), limit=1)
+
+    email = EmailOutbox.claim(now, limit=1)[0]
+    assert email["attempts"] == 4
+    assert EmailOutbox.mark_failed(email, "error", now) == EmailOutbox.failed
+    email = get_email(email_id)
+    assert email["status"] == EmailOutbox.failed
+    assert email["error"] == "error"
+    assert not EmailOutbox.claim(now + datetime.timedelta(days=1), limit=1)
+
+
+def test_key(database, monkeypatch):
+    """an event's email is queued once, unless given up on"""
+    email_id = EmailOutbox.enqueue("send_order_created_email", ["order"], key="k")
+    assert EmailOutbox.enqueue("send_order_created_email", ["order"], key="k") is None
+    assert EmailOutbox.enqueue("send_order_created_email", ["order"], key="other")
+    # unkeyed ones are always queued
+    assert EmailOutbox.enqueue("send_order_created_email", ["order"])
+    assert EmailOutbox.enqueue("send_order_created_email", ["order"])
+
+    EmailOutbox.mark_sent(email_id, get_now())
+    assert EmailOutbox.enqueue("send_order_created_email", ["order"], key="k") is None
+
+    monkeypatch.setattr(EmailOutbox, "max_attempts", 1)
+    EmailOutbox().update_one({"_id": email_id}, {"$set": {"attempts": 1}})
+    status = EmailOutbox.mark_failed(get_email(email_id), "error", get_now())
+    assert status == EmailOutbox.failed
+    assert "key" not in get_email(email_id)
+    assert EmailOutbox.enqueue("send_order_created_email", ["order"], key="k")
+
+
+@pytest.fixture
+def outbox(database, monkeypatch):
+    """emailing's outbox with send_order_failed_email messaging recipients
+
+    returns (sent, failing): recipients sent to and those to fail sending to"""
+    sent, failing = [], set()
+
+    def send_order_failed_email(order_id):
+        for recipient in ("client@example.com", "operator@example.com"):
+            emailing.send_email(to=recipient, subject=order_id, contents="")
+
+    def send_email_via_smtp(to, **kwargs):
+        if ",".join(to) in failing:
+            raise IOError("unable to send")
+        sent.append(",".join(to))
+
+    monkeypatch.setattr(
+        emailing,
+        "QUEUEABLE_EMAILS",
+        {"send_order_failed_email": send_order_failed_email},
+    )
+    monkeypatch.setattr(emailing, "send_email_via_smtp", send_email_via_smtp)
+    # provider_session() connection
+    monkeypatch.setattr(
+        emailing, "get_sender", lambda: types.SimpleNamespace(close=lambda: None)
+    )
+    monkeypatch.delenv("MAILGUN_API_KEY", raising=False)
+    monkeypatch.delenv("SUPPORT_EMAIL", raising=False)
+    return sent, failing
+
+
+def queue_failed_email(order_id, on):
+    return emailing.queue_email(
+        emailing.send_order_failed_email,
+        order_id,
+        event=emailing.status_event(order_id, on),
+    )
+
+
+def test_send_from_outbox_retry(outbox):
+    """a retried email isn't sent again to recipients it reached"""
+    sent, failing = outbox
+    order_id = str(ObjectId())
+    on = datetime.datetime.now()
+    email_id = queue_failed_email(order_id, on)
+    # same status entry
+    assert queue_failed_email(order_id, on) is None
+
+    failing.add("operator@example.com")
+    assert emailing.send_from_outbox(10) == 1
+    email = get_email(email_id)
+    assert email["status"] == EmailOutbox.pending
+    assert email["sent_parts"] == ["client@example.com"]
+    assert sent == ["client@example.com"]
+
+    failing.clear()
+    EmailOutbox().update_one(
+        {"_id": email_id}, {"$set": {"next_attempt_on": datetime.datetime.now()}}
+    )
+    assert emailing.send_from_outbox(10) == 1
+    assert get_email(email_id)["status"] == EmailOutbox.sent
+    assert sent == ["client@example.com", "operator@example.com"]
+    assert queue_failed_email(order_id, on) is None
+
+
+def test_send_from_outbox_given_up(outbox, monkeypatch):
+    """the event of a given up email can be queued again"""
+    sent, failing = outbox
+    monkeypatch.setattr(EmailOutbox, "max_attempts", 1)
+    order_id = str(ObjectId())
+    on = datetime.datetime.now()
+    email_id = queue_failed_email(order_id, on)
+
+    failing.add("operator@example.com")
+    assert emailing.send_from_outbox(10) == 1
+    assert get_email(email_id)["status"] == EmailOutbox.failed
+    assert sent == ["client@example.com"]
+
+    # another status entry of the order is another email
+    assert queue_failed_email(order_id, on + datetime.timedelta(seconds=1))
+    assert queue_failed_email(order_id, on)
+    assert EmailOutbox().count_documents({}) == 3
+
+
+def test_send_from_outbox_session_failed(outbox, monkeypatch):
+    """emails claimed when the provider login fails are retried later"""
+    sent, _ = outbox
+
+    def get_sender():
+        raise IOError("unable to login")
+
+    monkeypatch.setattr(emailing, "get_sender", get_sender)
+    email_ids = [queue_failed_email(str(ObjectId()), get_now()) for index in range(2)]
+
+    assert emailing.send_from_outbox(10) == 2
+    assert not sent
+    for email_id in email_ids:
+        email = get_email(email_id)
+        assert email["status"] == EmailOutbox.pending
+        assert email["attempts"] == 1
+        assert email["error"] == "unable to login"
+
+
+def test_send_from_outbox_snapshot(outbox, monkeypatch):
+    """queued emails render the order as it was when queued"""
+    rendered = []
+
+    def send_order_failed_email(order_id):
+        order = emailing.OrderContext(order_id).order
+        rendered.append((order["status"]["status"], order["tasks"]["create"]))
+
+    monkeypatch.setattr(
+        emailing,
+        "QUEUEABLE_EMAILS",
+        {"send_order_failed_email": send_order_failed_email},
+    )
+    on = get_now()
+    order_id = str(
+        Orders()
+        .insert_one(
+            {
+                "statuses": [{"status": Orders.failed, "on": on}],
+                "tasks": {"write": []},
+            }
+        )
+        .inserted_id
+    )
+    queue_failed_email(order_id, on)
+
+    Orders().update_one(
+        {"_id": ObjectId(order_id)},
+        {"$push": {"statuses": {"status": Orders.canceled, "on": get_now()}}},
+    )
+    assert emailing.send_from_outbox(10) == 1
+    assert rendered == [(Orders.failed, None)]
+    # not a queued email: current order
+    send_order_failed_email(order_id)
+    assert rendered[-1] == (Orders.canceled, None)
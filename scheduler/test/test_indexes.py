@@ -0,0 +1,101 @@
+import datetime
+import pathlib
+import sys
+
+import pytest
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("src")))
+
+from utils import mongo  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def orders(mongodb):
+    """a few orders in the module's database (see conftest's mongodb)"""
+    mongo.Orders().insert_many([{"status": "shipped"} for _ in range(10)])
+
+
+def get_index_names(plan):
+    """names of indexes scanned in an explain() plan"""
+    if isinstance(plan, list):
+        return [name for item in plan for name in get_index_names(item)]
+    if not isinstance(plan, dict):
+        return []
+    names = [plan["indexName"]] if plan.get("stage") == "IXSCAN" else []
+    return names + [name for value in plan.values() for name in get_index_names(value)]
+
+
+@pytest.mark.parametrize(
+    "get_cursor, index_name",
+    [
+        (lambda: mongo.Users().find({"username": "manager"}), "username"),
+        (lambda: mongo.RefreshTokens().find({"token": "x"}), "token"),
+        (
+            lambda: mongo.Acknowlegments().find(
+                {"username": "creator", "worker_type": "creator", "slot": "0"}
+            ),
+            "username_worker_type_slot",
+        ),
+        (lambda: mongo.Orders().find({"status": "pending_expiry"}), "status_id"),
+        (
+            lambda: mongo.Orders()
+            .find({"status": "shipped", "_id": {"$lt": ObjectId()}})
+            .sort("_id", DESCENDING),
+            "status_id",
+        ),
+        (lambda: mongo.Orders().find({"client.email": "x"}), "client_email"),
+        (
+            lambda: mongo.Orders().find(
+                {
+                    "status": "pending_expiry",
+                    "sd_card.expiration": {"$lt": datetime.datetime.now()},
+                }
+            ),
+            "status_expiration",
+        ),
+        (
+            lambda: mongo.WriterTasks().find(
+                {"expires_at": {"$lte": datetime.datetime.now()}}
+            ),
+            "expires_at",
+        ),
+        (
+            lambda: mongo.CreatorTasks().find(
+                mongo.CreatorTasks.availables_query("creator", "kiwix")
+            ),
+            "status_channel_worker",
+        ),
+        (
+            lambda: mongo.WriterTasks().find(
+                mongo.WriterTasks.availables_query("writer", "kiwix")
+            ),
+            "status_channel_worker",
+        ),
+        (lambda: mongo.DownloaderTasks().find({"order": "x"}), "order"),
+        (
+            lambda: mongo.TaskLogs()
+            .find({"task": "x", "kind": "worker"})
+            .sort("offset", ASCENDING),
+            "task_kind_offset",
+        ),
+        (lambda: mongo.AutoImages().find({"slug": "x"}), "slug"),
+        (lambda: mongo.AutoImages().find({"status": "building"}), "status"),
+        (lambda: mongo.Warehouses().find({"upload_uri": "x"}), "upload_uri"),
+        (
+            lambda: mongo.EmailOutbox()
+            .find(
+                {
+                    "status": {"$in": ["pending", "sending"]},
+                    "next_attempt_on": {"$lte": datetime.datetime.now()},
+                }
+            )
+            .sort("next_attempt_on", ASCENDING),
+            "status_next_attempt",
+        ),
+    ],
+)
+def test_query_uses_index(orders, get_cursor, index_name):
+    plan = get_cursor().explain()["queryPlanner"]["winningPlan"]
+    assert index_name in get_index_names(plan)
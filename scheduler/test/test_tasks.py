@@ -0,0 +1,278 @@
+import datetime
+import pathlib
+import sys
+import threading
+
+import pytest
+from bson import ObjectId
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("src")))
+
+from utils import mongo  # noqa: E402
+
+CREATOR = {"username": "creator"}
+
+
+def add_task(**kwargs):
+    """a creator task any creator can claim, unless overridden by kwargs"""
+    task = {
+        "order": str(ObjectId()),
+        "channel": "kiwix",
+        "worker": None,
+        "size": 64,
+        "upload_uri": "s3://s3.example.com/?bucketName=images",
+        "config_yaml": "files: []",
+        "status": mongo.CreatorTasks.pending,
+        "statuses": [],
+        **kwargs,
+    }
+    return mongo.CreatorTasks().insert_one(task).inserted_id
+
+
+def test_claim_oldest_first(database):
+    task_ids = [add_task() for _ in range(3)]
+
+    task = mongo.CreatorTasks.claim(CREATOR)
+    assert task["_id"] == task_ids[0]
+    assert task["status"] == mongo.CreatorTasks.received
+    assert task["worker"] == CREATOR["username"]
+    assert task["statuses"][-1]["status"] == mongo.CreatorTasks.received
+    assert "logs" not in task
+
+    assert mongo.CreatorTasks.claim(CREATOR)["_id"] == task_ids[1]
+    assert mongo.CreatorTasks.claim(CREATOR)["_id"] == task_ids[2]
+    assert mongo.CreatorTasks.claim(CREATOR) is None
+    assert not mongo.CreatorTasks.has_availables(CREATOR["username"])
+
+
+def test_claim_task_id(database):
+    add_task()
+    task_id = add_task()
+
+    assert mongo.CreatorTasks.claim(CREATOR, task_id=str(task_id))["_id"] == task_id
+    # already claimed
+    assert mongo.CreatorTasks.claim(CREATOR, task_id=task_id) is None
+
+
+def test_claim_skips_unclaimable(database):
+    add_task(worker="other")
+    add_task(config_yaml="")
+    add_task(upload_uri="https://example.com/images/")
+    add_task(status=mongo.CreatorTasks.received)
+    assigned_id = add_task(worker=CREATOR["username"])
+
+    assert mongo.CreatorTasks.claim(CREATOR)["_id"] == assigned_id
+    assert mongo.CreatorTasks.claim(CREATOR) is None
+
+
+def test_claim_private_channel(database):
+    mongo.Channels().insert_one({"slug": "private", "private": True})
+    task_id = add_task(channel="private")
+
+    assert not mongo.CreatorTasks.has_availables(CREATOR["username"], "kiwix")
+    assert mongo.CreatorTasks.claim(CREATOR) is None
+    task = mongo.CreatorTasks.claim({**CREATOR, "channel": "private"})
+    assert task["_id"] == task_id
+
+
+@pytest.mark.parametrize(
+    "max_size, expected", [(None, "large"), (64, "small"), (16, None)]
+)
+def test_claim_max_size(database, max_size, expected):
+    task_ids = {"large": add_task(size=128), "small": add_task(size=32)}
+
+    # polling and claiming agree on what's available
+    has_availables = mongo.CreatorTasks.has_availables(
+        CREATOR["username"], "kiwix", max_size=max_size
+    )
+    found = mongo.CreatorTasks.find_availables(
+        CREATOR["username"], "kiwix", max_size=max_size
+    )
+    task = mongo.CreatorTasks.claim(CREATOR, max_size=max_size)
+    if expected is None:
+        assert not has_availables and not found and task is None
+    else:
+        assert has_availables
+        assert found[0]["_id"] == task["_id"] == task_ids[expected]
+
+
+def test_claim_max_size_ignored(database):
+    """only creator tasks have a size (GB) for max_size to apply to"""
+    task_id = (
+        mongo.DownloaderTasks()
+        .insert_one(
+            {
+                "order": str(ObjectId()),
+                "channel": "kiwix",
+                "worker": None,
+                "image_size": 2**40,  # bytes
+                "status": mongo.DownloaderTasks.pending,
+                "statuses": [],
+            }
+        )
+        .inserted_id
+    )
+    downloader = {"username": "downloader"}
+
+    assert mongo.DownloaderTasks.has_availables("downloader", "kiwix", max_size=16)
+    task = mongo.DownloaderTasks.claim(downloader, max_size=16)
+    assert task["_id"] == task_id
+
+
+def test_concurrent_claims(database):
+    task_ids = [add_task() for _ in range(20)]
+    claimed = []
+
+    def claim_all(worker):
+        while True:
+            task = mongo.CreatorTasks.claim(worker)
+            if task is None:
+                return
+            claimed.append((task["_id"], task["worker"], worker["username"]))
+
+    workers = [
+        threading.Thread(target=claim_all, args=({"username": f"creator{index}"},))
+        for index in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # each task claimed once, by the worker recorded on it
+    assert sorted([task_id for task_id, _, _ in claimed]) == task_ids
+    assert all([recorded == username for _, recorded, username in claimed])
+
+
+def add_writer_task(**kwargs):
+    task = {"order": str(ObjectId()), "status": mongo.WriterTasks.received}
+    return (
+        mongo.WriterTasks().insert_one({**task, "statuses": [], **kwargs}).inserted_id
+    )
+
+
+def assert_expires_after(task_id, delay, before):
+    """task_id's recorded expires_at is delay after its status update"""
+    after = datetime.datetime.now()
+    expires_at = mongo.WriterTasks().find_one({"_id": task_id})["expires_at"]
+    # mongo stores milliseconds
+    assert before - datetime.timedelta(milliseconds=1) <= expires_at - delay <= after
+
+
+@pytest.mark.parametrize(
+    "status, image_size, delay",
+    [
+        (mongo.WriterTasks.wiping_sdcard, None, datetime.timedelta(minutes=30)),
+        (
+            mongo.WriterTasks.writing,
+            mongo.WriterTasks.TRANSFER_MIN_BPS * 3600,
+            datetime.timedelta(hours=1),
+        ),
+        # unknown size
+        (mongo.WriterTasks.writing, None, mongo.WriterTasks.TRANSFER_DEFAULT_TIMEOUT),
+    ],
+)
+def test_update_status_expires_at(database, status, image_size, delay):
+    task_id = add_writer_task(image_size=image_size)
+    before = datetime.datetime.now()
+    task = mongo.WriterTasks.update_status(task_id, status)
+    assert task["status"] == status
+    assert_expires_after(task_id, delay, before)
+
+    # statuses that don't time out unset it
+    mongo.WriterTasks.update_status(task_id, mongo.WriterTasks.written)
+    assert "expires_at" not in mongo.WriterTasks().find_one({"_id": task_id})
+
+
+def test_timeout_expired(database):
+    now = datetime.datetime.now()
+    past = now - datetime.timedelta(minutes=1)
+    expired_id = add_writer_task(status=mongo.WriterTasks.writing, expires_at=past)
+    add_writer_task(
+        status=mongo.WriterTasks.writing, expires_at=now + datetime.timedelta(hours=1)
+    )
+    add_writer_task(status=mongo.WriterTasks.written)
+    # expired but updated (not expired anymore) once listed
+    updated_id = add_writer_task(status=mongo.WriterTasks.writing, expires_at=past)
+
+    expired = mongo.Tasks.all_expired(now)
+    assert sorted([task["_id"] for _, task in expired]) == [expired_id, updated_id]
+    assert all([task_cls is mongo.WriterTasks for task_cls, _ in expired])
+
+    mongo.WriterTasks.update_status(updated_id, mongo.WriterTasks.written)
+    assert mongo.WriterTasks.timeout([expired_id, updated_id], now) == [expired_id]
+    task = mongo.WriterTasks().find_one({"_id": expired_id})
+    assert task["status"] == mongo.WriterTasks.timedout
+    assert task["statuses"][-1]["status"] == mongo.WriterTasks.timedout
+    assert "expires_at" not in task
+    assert not mongo.Tasks.all_expired(now)
+
+
+def test_backfill_expires_at(database):
+    since = datetime.datetime.now().replace(microsecond=0)
+    statuses = [{"status": mongo.WriterTasks.wiping_sdcard, "on": since}]
+    task_id = add_writer_task(status=mongo.WriterTasks.wiping_sdcard, statuses=statuses)
+    add_writer_task(status=mongo.WriterTasks.written)
+
+    assert mongo.Tasks.backfill_expires_at() == 1
+    expires_at = mongo.WriterTasks().find_one({"_id": task_id})["expires_at"]
+    assert expires_at == since + datetime.timedelta(minutes=30)
+    assert mongo.Tasks.backfill_expires_at() == 0
+
+
+def test_append_log(database):
+    task_id = str(ObjectId())
+
+    assert mongo.TaskLogs.append(task_id, "worker", 0, b"abc") == 3
+    assert mongo.TaskLogs.append(task_id, "worker", 3, "dé") == 6
+    assert mongo.TaskLogs.append(task_id, "uploader", 0, b"other") == 5
+    assert mongo.TaskLogs.read(task_id, "worker") == ("abcdé".encode("utf-8"), 6)
+    assert mongo.TaskLogs.read(task_id, "worker", offset=2, size=2) == (b"cd", 6)
+
+
+def test_append_log_resent(database):
+    """already received bytes are ignored"""
+    task_id = str(ObjectId())
+    mongo.TaskLogs.append(task_id, "worker", 0, b"abcd")
+
+    assert mongo.TaskLogs.append(task_id, "worker", 0, b"ab") == 4
+    assert mongo.TaskLogs.append(task_id, "worker", 2, b"cdef") == 6
+    assert mongo.TaskLogs.read(task_id, "worker") == (b"abcdef", 6)
+    assert mongo.TaskLogs().count_documents({"task": ObjectId(task_id)}) == 2
+
+
+def test_append_log_conflict(database, monkeypatch):
+    """append racing another one of the same range keeps the first"""
+    task_id = str(ObjectId())
+    mongo.TaskLogs.append(task_id, "worker", 0, b"abc")
+
+    # end as seen before the other append was inserted
+    get_end = mongo.TaskLogs.get_end
+    stale = [0]
+    monkeypatch.setattr(
+        mongo.TaskLogs,
+        "get_end",
+        lambda task_id, kind: stale.pop() if stale else get_end(task_id, kind),
+    )
+    assert mongo.TaskLogs.append(task_id, "worker", 0, b"xyz") == 3
+    assert mongo.TaskLogs.read(task_id, "worker") == (b"abc", 3)
+
+
+def test_concurrent_appends(database):
+    task_id = str(ObjectId())
+    ends = []
+    appenders = [
+        threading.Thread(
+            target=lambda: ends.append(
+                mongo.TaskLogs.append(task_id, "worker", 0, b"abc")
+            )
+        )
+        for _ in range(8)
+    ]
+    for appender in appenders:
+        appender.start()
+    for appender in appenders:
+        appender.join()
+
+    assert ends == [3] * 8
+    assert mongo.TaskLogs.read(task_id, "worker") == (b"abc", 3)
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pathlib
+import sys
+
+import pytest
+import torf
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("worker")))
+
+from utils import ONE_MiB  # noqa: E402
+from utils.digest import ImageDigests  # noqa: E402
+from utils.sparse import get_data_size, get_extents  # noqa: E402
+
+PIECE_SIZE = 2**16
+PART_SIZE = ONE_MiB
+# (offset, length) of data written in the sparse file, rest are holes
+DATA = [(0, 5000), (ONE_MiB + 4096, 70000), (3 * ONE_MiB + 12345, 300000)]
+SIZE = 6 * ONE_MiB + 777  # ends with a hole
+
+
+@pytest.fixture(scope="module")
+def sparse_file(tmp_path_factory):
+    fpath = tmp_path_factory.mktemp("digest") / "image.img"
+    with open(fpath, "wb") as fh:
+        fh.truncate(SIZE)
+        for offset, length in DATA:
+            fh.seek(offset)
+            fh.write(os.urandom(length))
+    return fpath
+
+
+def get_expected(fpath):
+    """md5, S3 ETag and torrent pieces computed the straightforward way"""
+    content = fpath.read_bytes()
+    parts = [
+        hashlib.md5(content[offset : offset + PART_SIZE]).digest()
+        for offset in range(0, len(content), PART_SIZE)
+    ]
+    torrent = torf.Torrent(path=fpath, piece_size=PIECE_SIZE)
+    torrent.generate()
+    return {
+        "md5": hashlib.md5(content).hexdigest(),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "etag": "{}-{}".format(hashlib.md5(b"".join(parts)).hexdigest(), len(parts)),
+        "pieces": torrent.metainfo["info"]["pieces"],
+    }
+
+
+def get_digests(fpath, threads):
+    return ImageDigests(
+        fpath=fpath,
+        piece_size=PIECE_SIZE,
+        part_size=PART_SIZE,
+        multipart_threshold=PART_SIZE,
+        extra=["sha256"],
+        threads=threads,
+    )
+
+
+def assert_digests_match(digests, expected):
+    assert digests.size == SIZE
+    assert digests.md5 == expected["md5"]
+    assert digests.extra == {"sha256": expected["sha256"]}
+    assert digests.etag == expected["etag"]
+    assert b"".join(digests.pieces) == expected["pieces"]
+
+
+def test_get_extents(sparse_file):
+    extents = get_extents(sparse_file)
+    assert extents[0][0] == 0
+    assert sum([length for _, length, _ in extents]) == SIZE
+    for (offset, length, _), (next_offset, _, _) in zip(extents, extents[1:]):
+        assert offset + length == next_offset
+    # written ranges are always within data extents
+    for offset, length in DATA:
+        assert any(
+            is_data and start <= offset and offset + length <= start + extent_length
+            for start, extent_length, is_data in extents
+        )
+    if get_data_size(extents) == SIZE:
+        pytest.skip("filesystem doesn't report holes")
+    assert not extents[-1][2]
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+@pytest.mark.parametrize("read_size", [100000, 8 * ONE_MiB])
+def test_compute(sparse_file, threads, read_size):
+    digests = get_digests(sparse_file, threads).compute(read_size=read_size)
+    assert_digests_match(digests, get_expected(sparse_file))
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_update(sparse_file, threads):
+    """content fed by another reader (single-pass upload) in uneven chunks"""
+    digests = get_digests(sparse_file, threads)
+    with open(sparse_file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(PART_SIZE - 1), b""):
+            digests.update(chunk)
+    assert_digests_match(digests.finalize(), get_expected(sparse_file))
+
+
+def test_small_file_etag(tmp_path):
+    fpath = tmp_path / "small.img"
+    fpath.write_bytes(os.urandom(1000))
+    digests = get_digests(fpath, threads=1).compute()
+    assert digests.etag == digests.md5 == hashlib.md5(fpath.read_bytes()).hexdigest()
@@ -0,0 +1,66 @@
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("worker")))
+
+from utils.logs import LogTail, get_incomplete_suffix_len  # noqa: E402
+
+EMOJI = "🙂".encode("utf-8")  # 4 bytes
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        (b"", 0),
+        (b"abc", 0),
+        ("é".encode("utf-8"), 0),
+        ("aé".encode("utf-8")[:-1], 1),
+        (EMOJI, 0),
+        (EMOJI[:1], 1),
+        (EMOJI[:2], 2),
+        (EMOJI[:3], 3),
+        (b"a" + EMOJI[:3], 3),
+    ],
+)
+def test_get_incomplete_suffix_len(data, expected):
+    assert get_incomplete_suffix_len(data) == expected
+
+
+@pytest.mark.parametrize("split", [1, 2, 3])
+def test_chunk_never_splits_codepoint(tmp_path, split):
+    path = tmp_path / "log.txt"
+    path.write_bytes(b"abc" + EMOJI[:split])
+    tail = LogTail(path, max_size=1024)
+
+    # incomplete sequence is held back until the rest is written
+    assert tail.get_chunk(0, 100) == (0, b"abc")
+    with open(path, "ab") as fh:
+        fh.write(EMOJI[split:] + b"def")
+    assert tail.get_chunk(3, 100) == (3, EMOJI + b"def")
+
+    # size limit cutting through a codepoint
+    assert tail.get_chunk(0, 3 + split) == (0, b"abc")
+    tail.close()
+
+
+def test_closed_returns_incomplete_sequence(tmp_path):
+    path = tmp_path / "log.txt"
+    path.write_bytes(b"abc" + EMOJI[:2])
+    tail = LogTail(path, max_size=1024)
+    tail.close()
+    assert tail.get_chunk(0, 100) == (0, b"abc" + EMOJI[:2])
+
+
+def test_chunk_before_buffer_is_read_from_file(tmp_path):
+    path = tmp_path / "log.txt"
+    content = "é".encode("utf-8") * 100
+    path.write_bytes(content)
+    tail = LogTail(path, max_size=20)
+    assert tail.getvalue() == "é" * 10
+    assert tail.buffer_start == len(content) - 20
+
+    # odd size would end in the middle of a codepoint
+    assert tail.get_chunk(2, 11) == (2, "é".encode("utf-8") * 5)
+    tail.close()
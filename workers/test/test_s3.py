@@ -0,0 +1,119 @@
+import os
+import pathlib
+import sys
+import types
+
+import pytest
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("worker")))
+
+from utils import ONE_MiB  # noqa: E402
+from utils.digest import ImageDigests  # noqa: E402
+from utils.s3 import MultipartUploader, UploadInterrupted  # noqa: E402
+
+BUCKET = "images"
+KEY = "image.img"
+PART_SIZE = 5 * ONE_MiB  # S3's minimum (but for last part)
+
+
+@pytest.fixture
+def s3_storage(monkeypatch):
+    """KiwixStorage stand-in (client and bucket_name) over a moto S3"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield types.SimpleNamespace(client=client, bucket_name=BUCKET)
+
+
+@pytest.fixture
+def fpath(tmp_path):
+    fpath = tmp_path / KEY
+    fpath.write_bytes(os.urandom(2 * PART_SIZE + 1000))
+    return fpath
+
+
+def get_uploader(s3_storage, fpath, **kwargs):
+    return MultipartUploader(
+        s3_storage=s3_storage,
+        fpath=fpath,
+        key=KEY,
+        state_path=fpath.with_name("upload.json"),
+        part_size=PART_SIZE,
+        concurrency=1,
+        **kwargs,
+    )
+
+
+def interrupt_after_first_part(s3_storage, fpath):
+    """uploader stopped once its first part is uploaded"""
+    uploader = get_uploader(s3_storage, fpath)
+    uploader.should_stop = lambda: len(uploader.parts) >= 1
+    with pytest.raises(UploadInterrupted):
+        uploader.upload()
+    assert list(uploader.parts) == [1]
+    assert uploader.state_path.exists()
+    return uploader
+
+
+def test_upload_resumes(s3_storage, fpath):
+    interrupted = interrupt_after_first_part(s3_storage, fpath)
+
+    digests = ImageDigests(
+        fpath=fpath,
+        piece_size=2**16,
+        part_size=PART_SIZE,
+        multipart_threshold=PART_SIZE,
+    )
+    uploader = get_uploader(s3_storage, fpath, on_read=digests.update)
+    uploaded = []
+    upload_part = uploader.upload_part
+    uploader.upload_part = lambda number, data: (
+        uploaded.append(number),
+        upload_part(number, data),
+    )
+    etag = uploader.upload()
+
+    assert uploader.upload_id == interrupted.upload_id
+    assert uploaded == [2, 3]
+    assert not uploader.state_path.exists()
+    # uploaded parts are read too, for caller to hash the whole file
+    assert etag == digests.finalize().etag
+    body = s3_storage.client.get_object(Bucket=BUCKET, Key=KEY)["Body"].read()
+    assert body == fpath.read_bytes()
+
+
+def test_outdated_state_restarts_upload(s3_storage, fpath):
+    interrupted = interrupt_after_first_part(s3_storage, fpath)
+    os.utime(fpath, (0, 0))
+
+    uploader = get_uploader(s3_storage, fpath)
+    uploader.upload()
+    assert uploader.upload_id != interrupted.upload_id
+    body = s3_storage.client.get_object(Bucket=BUCKET, Key=KEY)["Body"].read()
+    assert body == fpath.read_bytes()
+
+
+def test_abort(s3_storage, fpath):
+    uploader = interrupt_after_first_part(s3_storage, fpath)
+    uploader.abort()
+
+    assert not uploader.state_path.exists()
+    uploads = s3_storage.client.list_multipart_uploads(Bucket=BUCKET)
+    assert not uploads.get("Uploads")
+    # nothing to resume from
+    assert not get_uploader(s3_storage, fpath).load_state()
+
+
+def test_small_file_single_request(s3_storage, tmp_path):
+    fpath = tmp_path / KEY
+    fpath.write_bytes(b"content")
+    read = []
+    etag = get_uploader(s3_storage, fpath, on_read=read.append).upload()
+    assert read == [b"content"]
+    head = s3_storage.client.head_object(Bucket=BUCKET, Key=KEY)
+    assert etag == head["ETag"].strip('"')
@@ -2,188 +2,572 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
-import io
+import os
 import time
+import threading
+import shutil
 import logging
+import pathlib
 
 from tasks.create import CreateTask
+from utils.cache import CacheWarmer, ContentCache
+from utils.logs import LogTail
+from utils.s3 import MultipartUploader
 from utils.setting import Setting
 from utils.scheduler import (
     get_available_tasks,
     request_task,
     get_task,
+    append_log,
     upload_logs,
+    update_task_status,
+    get_timings_summary,
+    poll_tasks,
+    claim_task,
 )
 
+ONE_GB = int(1e9)  # task sizes are expressed in GB
 
 logger = logging.getLogger(__name__)
 
 
-class CreatorWorker:
+class Slot:
+    """A single CreateTask execution context within the worker
 
-    def __init__(self):
-        self.running: bool = True
+    Each slot has its own task, job, logger (and thus log stream)
+    and log-upload timer so that slots can be handled independently"""
+
+    def __init__(self, name: str):
+        self.name: str = name
 
         self.task: dict = None
         self.job: CreateTask = None
-        self.log_stream: io.StringIO = None  # stores worker log during job
-        self.log_handler: logging.Handler = None  # handles logging during job
+        self.logger: logging.Logger = logger.getChild(f"slot{name}")
+        self.log_handler: logging.Handler = None  # writes worker log during job
+        self.log_tail: LogTail = None  # follows worker log during job
+        self.log_offsets: dict = {}  # kind: offset of log on scheduler
+        self.log_upload_timer: list = [0]
+
+    def __repr__(self):
+        return f"Slot({self.name})"
+
+    @property
+    def busy(self):
+        return self.task is not None
+
+    @property
+    def reserved_space(self):
+        """disk space this slot's task may still consume in working_dir"""
+        if not self.busy:
+            return 0
+        required = int(self.task.get("size") or 0) * ONE_GB
+        used = 0
+        stem = pathlib.Path(self.task["fname"]).stem
+        for path in Setting.working_dir.glob(f"{stem}*"):
+            try:
+                used += path.stat().st_blocks * 512
+            except OSError:
+                continue
+        return max([required - used, 0])
+
+    @property
+    def worker_log_path(self):
+        return Setting.working_dir.joinpath(f"{self.task['_id']}_worker.log")
+
+    @property
+    def log_tails(self):
+        """all logs of the slot's task: worker log and job's ones"""
+        tails = {"worker_log": self.log_tail} if self.log_tail else {}
+        if self.job is not None:
+            tails.update(self.job.log_tails)
+        return tails
+
+    def attach_logger(self, append=False):
+        # plug dedicated file to slot's logger
+        self.log_handler = logging.FileHandler(
+            self.worker_log_path, mode="a" if append else "w"
+        )
+        self.logger.addHandler(self.log_handler)
+        self.log_tail = LogTail(self.worker_log_path)
+        self.log_offsets = {}
+
+    def detach_logger(self):
+        """stop recording worker log (its tail remains readable)"""
+        if self.log_handler is None:
+            return
+        self.logger.removeHandler(self.log_handler)
+        self.log_handler.close()
+        self.log_handler = None
+        self.log_tail.close()
+
+    def remove_log_files(self):
+        self.worker_log_path.unlink(missing_ok=True)
+        if self.job is not None:
+            self.job.remove_log_files()
+
+
+class UnsentLogs:
+    """Logs of a finished task scheduler has not fully received
+
+    Kept, with their files, for CreatorWorker to send them again later"""
+
+    def __init__(self, slot):
+        self.task_id = slot.task["_id"]
+        self.slot_name = slot.name
+        self.tails = slot.log_tails
+        self.offsets = slot.log_offsets
+        self.worker_log_path = slot.worker_log_path
+        self.job = slot.job
+
+    def __repr__(self):
+        return f"UnsentLogs(#{self.task_id})"
+
+    def remove_log_files(self):
+        self.worker_log_path.unlink(missing_ok=True)
+        if self.job is not None:
+            self.job.remove_log_files()
+
+
+class Dispatcher(threading.Thread):
+    """Long-polls scheduler for tasks and status changes of running ones
+
+    Replaces periodic polling of available tasks and per-second status
+    checks of running tasks. Main loop reads `tasks` and `statuses`.
+    Stops (`supported` False) if scheduler has no long-poll endpoint."""
+
+    def __init__(self, worker):
+        super().__init__(daemon=True)
+        self.worker = worker
+        self.supported: bool = True
+        self.statuses: dict = {}  # task_id: status on scheduler
+        self.tasks: list = []  # available tasks, once tasks_available is set
+        self.tasks_available = threading.Event()
+        self._should_stop = threading.Event()
+
+    def stop(self):
+        self._should_stop.set()
+
+    def pop_tasks(self):
+        tasks, self.tasks = self.tasks, []
+        self.tasks_available.clear()
+        return tasks
+
+    def run(self):
+        while not self._should_stop.is_set():
+            running = [slot.task for slot in self.worker.slots]
+            watch = {
+                task["_id"]: self.statuses.get(task["_id"]) for task in running if task
+            }
+            want_tasks = (
+                bool(self.worker.free_slots) and not self.tasks_available.is_set()
+            )
+            # only tasks we could start count, lest the poll returns right away
+            max_size = self.worker.get_max_task_size() if want_tasks else None
+            want_tasks = want_tasks and max_size is not None
+            success, code, response = poll_tasks(
+                watch, want_tasks, timeout=Setting.poll_timeout, max_size=max_size
+            )
+            if code in (404, 405):
+                logger.warning("scheduler can't long-poll ; polling periodically")
+                self.supported = False
+                return
+            if code == 429:
+                # scheduler has too many waiting polls: claim as if polling
+                logger.debug("scheduler busy, polling again later")
+                if want_tasks:
+                    self.tasks_available.set()
+                self._should_stop.wait(Setting.poll_interval)
+                continue
+            if not success:
+                logger.error("ERROR long-polling: {}".format(response))
+                self._should_stop.wait(Setting.poll_interval)
+                continue
+
+            self.statuses = response.get("watched", {})
+            if response.get("tasks"):
+                self.tasks = response["tasks"]
+                self.tasks_available.set()
+
+
+class CreatorWorker:
+    def __init__(self):
+        self.running: bool = True
+        self.slots: list = []
+        self.dispatcher: Dispatcher = None
+        self.poll_timer: list = [0]
+        self.can_claim: bool = True  # scheduler supports atomic claims
+        self.can_append_logs: bool = True  # scheduler supports log chunks
+        self.unsent_logs: list = []  # UnsentLogs of finished tasks
+        self.unsent_logs_timer: list = [0]
+        self.content_cache: ContentCache = None
+        self.cache_warmer: CacheWarmer = None
 
     def start(self):
         logger.info("Welcome to Imager worker:")
         self.read_setting()
+        self.slots = [Slot(str(index)) for index in range(Setting.nb_slots)]
+        logger.info(f"Using {len(self.slots)} slot(s)")
+        self.start_cache_warmer()
+        self.resume_tasks()
+        self.dispatcher = Dispatcher(self)
+        self.dispatcher.start()
         self.run_loop()
 
     def read_setting(self):
         Setting.read_from_env()
 
+    def start_cache_warmer(self):
+        """pre-fetch popular content in background if enabled"""
+        if not Setting.cache_warm_size:
+            return
+        self.content_cache = ContentCache(Setting.cache_warm_dir)
+        self.cache_warmer = CacheWarmer(
+            self.content_cache,
+            max_size=Setting.cache_warm_size,
+            interval=Setting.cache_warm_interval,
+        )
+        logger.info(f"Warming up to {Setting.cache_warm_size}b of popular content")
+        self.cache_warmer.start()
+
     def stop(self):
         """stops worker completely"""
         logger.info("received stop request ; shutting down (please wait).")
-        # cancelling job and marking as failed
-        if self.busy and self.job is not None and self.job.is_alive():
-            self.job.stop()
-            self.job.join(timeout=30)
-            self.cleanup_task()
+        if self.cache_warmer:
+            self.cache_warmer.stop()
+        if self.dispatcher:
+            self.dispatcher.stop()
+        # cancelling jobs and marking as failed (uploads are kept for resume)
+        for slot in self.busy_slots:
+            if slot.job is not None and slot.job.is_alive():
+                slot.job.suspend()
+        for slot in self.busy_slots:
+            if slot.job is not None:
+                slot.job.join(timeout=30)
+            self.cleanup_task(slot)
 
         self.running = False
 
     @property
     def busy(self):
-        return self.task is not None
+        return bool(self.busy_slots)
 
-    def start_task(self, task):
-        self._attach_logger()
-        self.task = task
-
-        logger.info("Starting to work on {}".format(self.task["_id"]))
-        self.job = CreateTask(args=(self.task, logger))
-        self.job.start()
+    @property
+    def busy_slots(self):
+        return [slot for slot in self.slots if slot.busy]
 
-    def stop_task(self):
-        if not self.busy:
+    @property
+    def free_slots(self):
+        return [slot for slot in self.slots if not slot.busy]
+
+    def start_task(self, slot, task, resume_state=None):
+        slot.task = task
+        slot.attach_logger(append=bool(resume_state))
+        slot.log_upload_timer = [0]
+
+        slot.logger.info("Starting to work on {}".format(slot.task["_id"]))
+        slot.job = CreateTask(
+            args=(slot.task, slot.logger, resume_state, self.content_cache)
+        )
+        slot.job.start()
+
+    def resume_tasks(self):
+        """restart uploads of tasks suspended by a previous run of the worker"""
+        for state_path in sorted(Setting.working_dir.glob("*.upload.json")):
+            state = MultipartUploader.read_state(state_path) or {}
+            metadata = state.get("metadata", {})
+            task_id = metadata.get("task_id")
+            success, task = get_task(task_id) if task_id else (False, None)
+            ours = (
+                success
+                and task.get("status") == "uploading"
+                and task.get("worker") == Setting.username
+            )
+            if ours and self.free_slots and pathlib.Path(state["fpath"]).exists():
+                logger.info("resuming upload of task #{}".format(task_id))
+                self.start_task(self.free_slots[0], task, resume_state=state)
+                continue
+
+            logger.info("discarding upload state {}".format(state_path.name))
+            if ours:
+                update_task_status(
+                    task_id, "failed_to_upload", "upload could not be resumed"
+                )
+            state_path.unlink()
+            for path in (state.get("fpath"), metadata.get("uploader_log")):
+                if path:
+                    pathlib.Path(path).unlink(missing_ok=True)
+            if task_id:
+                Setting.working_dir.joinpath(f"{task_id}_worker.log").unlink(
+                    missing_ok=True
+                )
+
+    def stop_task(self, slot):
+        if not slot.busy:
             return
 
-        if self.job is not None and self.job.is_alive():
-            self.job.stop()
-            self.job.join(timeout=30)
+        if slot.job is not None and slot.job.is_alive():
+            slot.job.stop()
+            slot.job.join(timeout=30)
+
+        self.cleanup_task(slot)
+
+    def get_max_task_size(self):
+        """largest task size (GB) we can admit ; None if we can't start any"""
+        reserved = sum([slot.reserved_space for slot in self.busy_slots])
+        available = shutil.disk_usage(Setting.working_dir).free - reserved
+        if available < Setting.min_free_space:
+            logger.info(
+                "not enough space in {}: {}".format(Setting.working_dir, available)
+            )
+            return None
+        if not self.can_admit_any():
+            return None
+        return (available - Setting.min_free_space) // ONE_GB
+
+    def can_admit(self, task):
+        """whether resources allow starting task on a free slot"""
+        required = int(task.get("size") or 0) * ONE_GB + Setting.min_free_space
+        reserved = sum([slot.reserved_space for slot in self.busy_slots])
+        available = shutil.disk_usage(Setting.working_dir).free - reserved
+        if available < required:
+            logger.info(
+                "not enough space in {} for #{}: {} < {}".format(
+                    Setting.working_dir, task["_id"], available, required
+                )
+            )
+            return False
+        return self.can_admit_any()
+
+    def can_admit_any(self):
+        """whether cache space and load allow starting another task"""
+        cache_free = shutil.disk_usage(Setting.cache_dir).free
+        if cache_free < Setting.min_free_space:
+            logger.info(
+                "not enough space in {}: {}".format(Setting.cache_dir, cache_free)
+            )
+            return False
+
+        # always accept a task if we are idle
+        if not self.busy:
+            return True
 
-        self.cleanup_task()
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if load > Setting.max_load:
+            logger.info("load too high to start another task: {:.2f}".format(load))
+            return False
 
-    def _attach_logger(self):
-        # plug dedicated stream to logger
-        self.log_stream = io.StringIO("")
-        self.log_handler = logging.StreamHandler(self.log_stream)
-        logger.addHandler(self.log_handler)
+        return True
 
-    def get_available_tasks(self):
+    def get_available_tasks(self, slot):
         logger.info("requesting list of tasks for worker {}".format(Setting.username))
-        success, tasks = get_available_tasks()
+        success, tasks = get_available_tasks(slot=slot.name)
         if not success:
             logger.error("ERROR getting tasks: {}".format(tasks))
             return []
         return tasks
 
-    def request_task(self, task_id):
+    def request_task(self, slot, task_id):
         logger.info("requesting task #{} to scheduler.".format(task_id))
-        success, tid = request_task(task_id)
+        success, tid = request_task(task_id, slot=slot.name)
         return success
 
-    def upload_worker_logs(self, logs):
-        logger.info("sending logs for task #{}.".format(self.task["_id"]))
-        success, tid = upload_logs(task_id=self.task["_id"], logs=logs)
-
-    def send_ack(self):
-        logger.info("sending ACK to scheduler. working on #{}".format(self.task["_id"]))
-
-    def read_worker_log(self):
-        """returns worker log for seld.task"""
-        if self.log_handler is None or self.log_stream is None:
-            return None
-        logger.removeHandler(self.log_handler)
-        self.log_handler.flush()
-        self.log_handler.close()
-        self.log_handler = None
-        self.log_stream.seek(0)
-        content = self.log_stream.read()
-        self.log_stream.close()
-        self.log_stream = None
-        return content
-
-    def cleanup_task(self):
-        logs = {"worker_log": self.read_worker_log()}
-        if self.job:
-            logs.update(self.job.logs)
-        self.upload_worker_logs(logs)
-        # clean-up
-        self.job = None
-        self.task = None
+    def upload_worker_logs(self, slot):
+        """send scheduler what it doesn't have yet of slot's logs"""
+        logger.info("sending logs for task #{}.".format(slot.task["_id"]))
+        return self.send_logs(
+            slot.task["_id"], slot.log_tails, slot.log_offsets, slot.name
+        )
+
+    def send_logs(self, task_id, tails, offsets, slot_name=None):
+        """send new chunks of logs (tails by kind). returns whether all sent
+
+        offsets (kind: offset on scheduler) are updated as chunks are sent"""
+        if not self.can_append_logs:
+            return self.send_whole_logs(task_id, tails, slot_name)
+        for kind, tail in tails.items():
+            offset = offsets.get(kind, 0)
+            while True:
+                start, data = tail.get_chunk(offset, Setting.log_chunk_size)
+                if not data:
+                    break
+                success, code, response = append_log(
+                    task_id=task_id,
+                    kind=kind.rsplit("_log", 1)[0],
+                    offset=start,
+                    data=data,
+                    slot=slot_name,
+                )
+                if code in (404, 405):
+                    # older scheduler (or task gone, then whole logs fail too)
+                    return self.send_whole_logs(task_id, tails, slot_name)
+                if not success:
+                    logger.error("ERROR sending {}: {}".format(kind, response))
+                    return False
+                # scheduler tells us where to continue from
+                if response["offset"] == offset:
+                    break
+                offset = offsets[kind] = response["offset"]
+        return True
+
+    def send_whole_logs(self, task_id, tails, slot_name=None):
+        """replace logs on scheduler with whole ones. returns whether sent"""
+        success, code, response = upload_logs(
+            task_id=task_id,
+            logs={kind: tail.read_all() for kind, tail in tails.items()},
+            slot=slot_name,
+        )
+        if success and self.can_append_logs:
+            logger.warning("scheduler can't append logs ; sending them whole")
+            self.can_append_logs = False
+        elif code == 404:
+            logger.warning("task #{} is gone, not sending logs".format(task_id))
+            return True
+        elif not success:
+            logger.error("ERROR sending logs: {}".format(response))
+        return success
 
-    @property
-    def has_been_canceled(self):
-        if not self.busy:
+    def send_unsent_logs(self):
+        """retry sending logs of finished tasks, removing them once sent"""
+        for unsent in list(self.unsent_logs):
+            logger.info("sending remaining logs for task #{}".format(unsent.task_id))
+            if self.send_logs(
+                unsent.task_id, unsent.tails, unsent.offsets, unsent.slot_name
+            ):
+                unsent.remove_log_files()
+                self.unsent_logs.remove(unsent)
+
+    def cleanup_task(self, slot):
+        slot.detach_logger()
+        sent = self.upload_worker_logs(slot)
+        # clean-up (logs of a suspended upload are continued on resume)
+        if slot.job is None or not slot.job.resumable:
+            if sent:
+                slot.remove_log_files()
+            else:
+                # kept until scheduler has them all
+                self.unsent_logs.append(UnsentLogs(slot))
+        slot.job = None
+        slot.task = None
+        slot.log_tail = None
+        # look for a new task right away
+        self.poll_timer = [0]
+
+    def has_been_canceled(self, slot):
+        if not slot.busy:
             return False
-        success, task = get_task(self.task["_id"])
+        if self.dispatcher and self.dispatcher.supported:
+            return self.dispatcher.statuses.get(slot.task["_id"]) == "canceled"
+        success, task = get_task(slot.task["_id"])
         if success:
             return task.get("status") == "canceled"
         return False
 
+    def check_slot(self, slot):
+        """periodic check of a busy slot: logs, cancellation, completion"""
+        if not slot.log_upload_timer.pop():
+            logger.info("periodic log upload for {}".format(slot))
+            self.upload_worker_logs(slot)
+            slot.log_upload_timer = Setting.get_timer(Setting.log_upload_interval)
+
+        if self.has_been_canceled(slot):
+            slot.logger.info("task cancelation requested. stopping task")
+            self.stop_task(slot)
+            return
+
+        if not slot.job.is_alive():
+            slot.logger.info("job is not alive")
+            if slot.job.exception:
+                slot.logger.error("job crashed: {}".format(slot.job.exception))
+            else:
+                slot.logger.info("job successful")
+
+            self.cleanup_task(slot)
+
+    def fill_slots(self):
+        """claim tasks on scheduler and start them on free slots"""
+        if self.dispatcher and self.dispatcher.tasks_available.is_set():
+            self.dispatcher.pop_tasks()  # we claim instead
+        if not self.can_claim:
+            return self.fill_slots_from_list()
+
+        for slot in self.free_slots:
+            max_size = self.get_max_task_size()
+            if max_size is None:
+                return
+            success, code, task = claim_task(slot=slot.name, max_size=max_size)
+            if code == 405:
+                logger.warning("scheduler can't claim tasks ; requesting instead")
+                self.can_claim = False
+                return self.fill_slots_from_list()
+            if not success:
+                logger.error("ERROR claiming task: {}".format(task))
+                return
+            if not task:
+                return
+            self.start_task(slot, task)
+
+    def fill_slots_from_list(self):
+        """fetch tasks on scheduler and request those we can for free slots"""
+        free_slots = self.free_slots
+        for task in self.get_available_tasks(free_slots[0]):
+            # skip tasks that are scheduled for other workers
+            try:
+                if task["worker"] is not None and task["worker"] != Setting.username:
+                    continue
+                # TODO: remove
+                if not task["upload_uri"].startswith("s3://"):
+                    continue
+                if not task.get("config_yaml", ""):
+                    continue
+            except Exception:
+                pass
+
+            if not self.can_admit(task):
+                continue
+
+            # notify scheduler we want to take it
+            if self.request_task(free_slots[0], task["_id"]):
+                self.start_task(free_slots.pop(0), task)
+                if not free_slots:
+                    break
+
     def run_loop(self):
         logger.info("Starting...")
 
         url = "{api}/tasks/{type}".format(api=Setting.api_url, type="creator")
         logger.info("Working off {}".format(url))
 
-        poll_timer, log_upload_timer = [0], [0]
+        timings_timer = Setting.get_timer(Setting.timings_interval)
         while self.running:
-            if self.busy:
-                # send ack to scheduler. we're working on self.task
-                # self.send_ack()
-
-                if not log_upload_timer.pop():
-                    logger.info("periodic log upload..................")
-                    self.upload_worker_logs(self.job.logs)
-                    log_upload_timer = Setting.get_timer(Setting.log_upload_interval)
-
-                if self.has_been_canceled:
-                    logger.info("task cancelation requested. stopping task")
-                    self.stop_task()
-                    continue
-
-                if not self.job.is_alive():
-                    logger.info("job is not alive")
-                    if self.job.exception:
-                        logger.error("job crashed: {}".format(self.job.exception))
-                    else:
-                        logger.info("job successful")
-
-                    self.cleanup_task()
-            else:
-                if not poll_timer.pop():
-                    # fetch tasks on scheduler
-                    for task in self.get_available_tasks():
-                        # skip tasks that are scheduled for other workers
-                        try:
-                            if (
-                                task["worker"] is not None
-                                and task["worker"] != Setting.username
-                            ):
-                                continue
-                            # TODO: remove
-                            if not task["upload_uri"].startswith("s3://"):
-                                continue
-                            if not task.get("config_yaml", ""):
-                                continue
-                        except Exception:
-                            pass
-
-                        # notify scheduler we want to take it
-                        if self.request_task(task["_id"]):
-                            self.start_task(task)
-                            break
-                    poll_timer = Setting.get_timer(Setting.poll_interval)
+            for slot in self.busy_slots:
+                self.check_slot(slot)
+
+            long_polling = self.dispatcher and self.dispatcher.supported
+            if self.free_slots and (
+                (long_polling and self.dispatcher.tasks_available.is_set())
+                or not self.poll_timer.pop()
+            ):
+                self.fill_slots()
+                self.poll_timer = Setting.get_timer(
+                    Setting.idle_poll_interval
+                    if long_polling
+                    else Setting.poll_interval
+                )
+
+            if self.unsent_logs and not self.unsent_logs_timer.pop():
+                self.send_unsent_logs()
+                self.unsent_logs_timer = Setting.get_timer(Setting.log_upload_interval)
+
+            if not timings_timer.pop():
+                self.log_timings()
+                timings_timer = Setting.get_timer(Setting.timings_interval)
 
             time.sleep(1)
 
+        self.log_timings()
         logger.info("exiting gracefuly.")
 
+    def log_timings(self):
+        logger.info("scheduler API requests timings:")
+        for line in get_timings_summary():
+            logger.info(f"  {line}")
@@ -3,7 +3,6 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import datetime
-import io
 import json
 import logging
 import re
@@ -15,10 +14,20 @@ import urllib.parse
 import torf
 import yaml
 from kiwixstorage import KiwixStorage
-from utils import get_checksum
-from utils.s3 import ImageTransferHook
+from utils.digest import ImageDigests
+from utils.logs import LogTail
+from utils.s3 import (
+    ImageTransferHook,
+    MultipartUploader,
+    UploadInterrupted,
+    get_part_size,
+)
 from utils.scheduler import authenticate, get_access_token, update_task_status
 from utils.setting import Setting
+from utils.sparse import get_data_size, get_extents, write_extents_map
+from utils.compression import compress_zstd
+from utils.compression import get_suffix as get_compression_suffix
+from utils.cache import ContentCache
 
 try:
     from yaml import CDumper as Dumper
@@ -44,11 +53,15 @@ class CreateTask(threading.Thread):
 
         self.exception: Exception = None  # exception to be re-raised by caller
         self.task: dict = {}
-        self.logs = {}
+        self.log_tails = {}  # kind: LogTail
 
         self._should_stop: bool = False  # stop flag
+        self._suspended: bool = False  # stopped but upload to be resumed
+        self.resume_state: dict = None  # upload state of a suspended task
+        self.content_cache: ContentCache = None  # warmed popular content, if any
 
         self.extra = {}  # extra data to populate and send
+        self.digests: ImageDigests = None  # single-pass hashes of built image
 
         self.logger = logging.getLogger(__name__)  # to be overwritten
 
@@ -56,10 +69,25 @@ class CreateTask(threading.Thread):
         self.logger.info("stopping thread")
         self._should_stop = True
 
+    def suspend(self):
+        """stop thread, keeping an ongoing upload resumable by next worker run"""
+        self.logger.info("suspending thread")
+        self._suspended = True
+        self._should_stop = True
+
     @property
     def canceled(self):
         return self._should_stop
 
+    @property
+    def suspended(self):
+        return self._suspended
+
+    @property
+    def resumable(self):
+        """whether an upload was suspended and can be resumed from disk"""
+        return self.suspended and self.upload_state_path.exists()
+
     def report_status(self, status, status_log=None):
         self.logger.info(
             "updating task #{} status to: {}".format(self.task["_id"], status)
@@ -72,11 +100,52 @@ class CreateTask(threading.Thread):
     def file_path(self, ext):
         return Setting.working_dir.joinpath(self.task["fname"]).with_suffix(f".{ext}")
 
-    def read_log(self, path):
-        cat = subprocess.run(["cat", str(path)], text=True, capture_output=True)
-        return "{stdout}\n{stderr}".format(
-            stdout=cat.stdout or "", stderr=cat.stderr or ""
-        )
+    @property
+    def logs(self):
+        """text of all logs (bounded to Setting.log_buffer_size each)"""
+        return {kind: tail.getvalue() for kind, tail in self.log_tails.items()}
+
+    def run_logged_process(self, kind, args, log_path, log_args=None):
+        """run args while following its output in log_path as `kind` log
+
+        returns the process' returncode ; terminates it on cancel request"""
+        log_args = log_args or args
+        self.logger.info("Starting {args}\n".format(args=" ".join(log_args)))
+
+        with open(log_path, "w") as log_fd:
+            log_fd.write("{args}\n".format(args=" ".join(log_args)))
+            log_fd.flush()
+            self.log_tails[kind] = LogTail(log_path)
+            ps = subprocess.Popen(
+                args=args,
+                stdout=log_fd,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                close_fds=True,
+            )
+
+            self.logger.info("{} started: {}".format(kind, ps))
+            while ps.returncode is None:
+                # kill upon request
+                if self.canceled:
+                    self.logger.info("terminating {}…".format(kind))
+                    ps.terminate()
+                    ps.wait(10)
+                    ps.kill()
+                    ps.wait(10)
+                    break
+
+                # block until process ends or to check for cancel request
+                try:
+                    ps.wait(1)
+                except subprocess.TimeoutExpired:
+                    continue
+
+            ps.wait(10)
+
+        self.logger.info("collecting full terminated log")
+        self.log_tails[kind].close()
+        return ps.returncode
 
     def remove_files(self, only_errorneous=True):
         suffixes = [".ERROR.img", ".BUILDING.img"]
@@ -86,13 +155,17 @@ class CreateTask(threading.Thread):
         for suffix in suffixes:
             path = Setting.working_dir.joinpath(self.img_name + suffix)
             if path.is_file():
-                logger.info("removing {}".format(path.name))
+                self.logger.info("removing {}".format(path.name))
                 path.unlink()
 
-        # delete config and log
-        for path in (self.log_path, self.config_path):
-            if path.is_file():
-                path.unlink()
+        # delete config (logs are removed once sent, see remove_log_files)
+        if self.config_path.is_file():
+            self.config_path.unlink()
+
+    def remove_log_files(self):
+        for tail in self.log_tails.values():
+            tail.close()
+            tail.path.unlink(missing_ok=True)
 
     @property
     def img_path(self):
@@ -102,6 +175,20 @@ class CreateTask(threading.Thread):
     def img_name(self):
         return self.img_path.stem
 
+    @property
+    def compression(self):
+        """compression requested by warehouse (None for raw image)"""
+        return self.task.get("compression")
+
+    @property
+    def artifact_path(self):
+        """file to upload: image or its compressed version"""
+        if not self.compression:
+            return self.img_path
+        return self.img_path.with_name(
+            self.img_path.name + get_compression_suffix(self.compression)
+        )
+
     @property
     def log_path(self):
         return self.file_path("txt")
@@ -114,8 +201,12 @@ class CreateTask(threading.Thread):
     def config_path(self):
         return self.file_path("yaml")
 
+    @property
+    def upload_state_path(self):
+        return self.file_path("upload.json")
+
     def run(self):
-        self.task, self.logger = self._args
+        self.task, self.logger, self.resume_state, self.content_cache = self._args
 
         # make sure warehouse URI is OK before we start
         try:
@@ -141,6 +232,12 @@ class CreateTask(threading.Thread):
             ),
         ]
 
+        if self.resume_state:
+            # image was built by a previous run which got suspended while uploading
+            self.logger.info("resuming upload of {}".format(self.artifact_path.name))
+            self.extra["image"] = self.resume_state["metadata"]["image"]
+            states = states[1:]
+
         for method, working_status, success_status, failed_status in states:
             try:
                 self.report_status(working_status)
@@ -148,7 +245,10 @@ class CreateTask(threading.Thread):
             except Exception as exp:
                 self.logger.exception(exp)
                 self.exception = exp
-                if self.canceled:
+                if self.suspended and method == "upload_image":
+                    # keep uploading status ; next worker run will resume it
+                    self.logger.info("upload suspended")
+                elif self.canceled:
                     self.report_status("canceled")
                 else:
                     self.report_status(failed_status, str(exp))
@@ -168,7 +268,9 @@ class CreateTask(threading.Thread):
         if ic_version:
             imager_path = imager_path.with_name(f"image-creator_{ic_version}")
             if not imager_path.exists():
-                logger.warning(f"requested image-creator version missing: {ic_version}")
+                self.logger.warning(
+                    f"requested image-creator version missing: {ic_version}"
+                )
                 imager_path = Setting.imager_binary_path
 
         # write config to file, making sure to exclude special image-creator prop
@@ -176,6 +278,16 @@ class CreateTask(threading.Thread):
             del payload["image-creator"]
         except KeyError:
             ...
+
+        # use warmed files as local sources
+        served = []
+        if self.content_cache:
+            served, self.extra["cache"] = self.content_cache.apply(payload)
+            self.logger.info(
+                "cache: {hits} hits ({hit_bytes}b), "
+                "{misses} misses ({miss_bytes}b)".format(**self.extra["cache"])
+            )
+
         self.config_path.write_text(
             yaml.dump(payload, Dumper=Dumper, explicit_start=True, sort_keys=False)
         )
@@ -199,58 +311,132 @@ class CreateTask(threading.Thread):
             str(self.img_path),
         ]
 
-        self.logger.info("Starting {args}\n".format(args=" ".join(args)))
-
-        self.logs["installer_log"] = "{args}\n".format(args=" ".join(args))
-        log_fd = open(str(self.log_path), "w")
-        ps = subprocess.Popen(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
-        )
-
-        self.logger.info("installer started: {}".format(ps))
-        while ps.poll() is None:
-            self.logs["installer_log"] = self.read_log(self.log_path)
-
-            # kill upon request
-            if self.canceled:
-                self.logger.info("terminating installer…")
-                ps.terminate()
-                ps.wait(10)
-                ps.kill()
-                ps.wait(10)
-                break
-
-        ps.wait(10)
+        try:
+            returncode = self.run_logged_process("installer_log", args, self.log_path)
+        finally:
+            if served:
+                self.content_cache.release(served)
 
-        successful = ps.returncode == 0 and self.img_path.exists()
+        successful = returncode == 0 and self.img_path.exists()
 
         if successful:
             self.logger.info("installer ran successfuly.")
-            # get and store size and checksum
+            # checksums are computed when uploading (see upload_image_s3)
             self.extra["image"] = {
                 "fname": self.img_path.name,
                 "size": self.img_path.stat().st_size,
-                "checksum": "{0}:{1}".format(*get_checksum(str(self.img_path))),
             }
         else:
-            self.logger.error("installer failed: {}".format(ps.returncode))
-
-        self.logger.info("collecting full terminated log")
-        self.logs["installer_log"] = self.read_log(self.log_path)
+            self.logger.error("installer failed: {}".format(returncode))
 
         # clean up working folder
         build_dir.cleanup()
         self.remove_files()
 
         if not successful:
-            raise subprocess.SubprocessError("installer rc: {}".format(ps.returncode))
+            raise subprocess.SubprocessError("installer rc: {}".format(returncode))
+
+        if self.compression:
+            self.compress_image()
+
+    def compress_image(self):
+        """replace image with its compressed artifact"""
+        self.logger.info(
+            "compressing {} using {}".format(self.img_path.name, self.compression)
+        )
+        started_on = datetime.datetime.now()
+        try:
+            if self.compression == "zstd":
+                compress_zstd(
+                    self.img_path,
+                    self.artifact_path,
+                    level=Setting.zstd_level,
+                    threads=Setting.zstd_threads,
+                )
+            else:
+                raise ValueError(f"unsupported compression: {self.compression}")
+        except Exception:
+            self.artifact_path.unlink(missing_ok=True)
+            self.img_path.unlink(missing_ok=True)
+            raise
+
+        self.img_path.unlink()
+        compressed_size = self.artifact_path.stat().st_size
+        self.logger.info(
+            "compressed into {} in {}: {} to {} bytes ({:.1%})".format(
+                self.artifact_path.name,
+                datetime.datetime.now() - started_on,
+                self.extra["image"]["size"],
+                compressed_size,
+                compressed_size / max([self.extra["image"]["size"], 1]),
+            )
+        )
+        self.extra["image"].update(
+            {
+                "fname": self.artifact_path.name,
+                "compression": self.compression,
+                "compressed_size": compressed_size,
+            }
+        )
+
+    @property
+    def uploads_to_s3(self):
+        return self.task["upload_uri"].startswith("s3://")
+
+    @property
+    def has_checksum(self):
+        return bool((self.extra.get("image") or {}).get("checksum"))
+
+    def get_image_digests(self, callback=None):
+        """ImageDigests for image, matching torrent and S3 upload settings"""
+        size = self.artifact_path.stat().st_size
+        part_size = get_part_size(size, Setting.s3_part_size)
+        return ImageDigests(
+            fpath=self.artifact_path,
+            piece_size=torf.Torrent.calculate_piece_size(size),
+            part_size=part_size,
+            multipart_threshold=part_size,
+            extra=Setting.extra_digests,
+            threads=Setting.hash_threads,
+            callback=callback,
+        )
+
+    def compute_digests(self, output=None):
+        """md5, S3 ETag, torrent pieces and extra digests in a single read
+
+        progress is written to output stream if specified"""
+        self.logger.info("computing digests for {}".format(self.artifact_path.name))
+        hook = (
+            ImageTransferHook(
+                output=output,
+                fpath=self.artifact_path,
+                name=f"hashing {self.artifact_path.name}",
+            )
+            if output
+            else None
+        )
+        self.record_digests(self.get_image_digests(callback=hook).compute())
+
+    def record_digests(self, digests):
+        self.digests = digests
+        self.logger.info(
+            "digests computed: {} (etag: {})".format(digests.checksum, digests.etag)
+        )
+        # digests are those of the uploaded artifact
+        self.extra["image"].update(
+            {
+                "compressed_size" if self.compression else "size": digests.size,
+                "checksum": digests.checksum,
+                "etag": digests.etag,
+            }
+        )
+        if digests.extra:
+            self.extra["image"]["digests"] = digests.extra
+        if digests.extents:
+            self.extra["image"]["data_size"] = get_data_size(digests.extents)
 
     def upload_image(self):
-        if self.task["upload_uri"].startswith("s3://"):
+        if self.uploads_to_s3:
             self.upload_image_s3()
         else:
             self.upload_image_with_curl()
@@ -265,11 +451,16 @@ class CreateTask(threading.Thread):
         qs["secretAccessKey"] = Setting.s3_secret_key
 
         # setup upload logging
-        uploader_log = io.StringIO()
-        uploader_logger = logging.getLogger("uploader_log")
+        # (one logger per task as several tasks may run concurrently)
+        uploader_log = open(
+            self.uploader_log_path, "a" if self.resume_state else "w", buffering=1
+        )
+        self.log_tails["uploader_log"] = LogTail(self.uploader_log_path)
+        uploader_logger = logging.getLogger(f"uploader_log.{self.task['_id']}")
         uploader_logger.propagate = True
         uploader_logger.setLevel(logging.DEBUG)
-        uploader_logger.addHandler(logging.StreamHandler(stream=uploader_log))
+        uploader_handler = logging.StreamHandler(stream=uploader_log)
+        uploader_logger.addHandler(uploader_handler)
 
         # init and test storage
         uploader_logger.info("initializing S3")
@@ -286,52 +477,83 @@ class CreateTask(threading.Thread):
             f"S3 initialized for {s3_storage.url.netloc}/{s3_storage.bucket_name}"
         )
 
-        # torrent
-        dl_url = urllib.parse.urlparse(self.task["download_uri"])
-        upload_torrent = "torrent" in dl_url.scheme
-
-        if upload_torrent:
-            parts = list(urllib.parse.urlsplit(dl_url.geturl()))
-            parts[0] = parts[0].replace("+torrent", "")
-            dl_url = urllib.parse.urlparse(urllib.parse.urlunsplit(parts))
-
-            uploader_logger.info(f"Creating torrent file for {self.img_path.name}")
-            torrent_path = self.img_path.with_suffix(f"{self.img_path.suffix}.torrent")
-            download_url = f"{dl_url.geturl()}/{self.img_path.name}"
-            torrent = torf.Torrent(
-                path=self.img_path,
-                trackers=[
-                    "https://opentracker.xyz:443/announce",
-                    "http://torrent.nwps.ws:80/announce",
-                    "udp://tracker.open-internet.nl:6969/announce",
-                    "udp://tracker.coppersurfer.tk:6969/announce",
-                    "udp://tracker.openbittorrent.com:80/announce",
-                ],
-                webseeds=[download_url],
-            )
-            torrent.generate()
-            torrent.write(torrent_path)
-            uploader_logger.info(f".. created {torrent_path.name}")
-
-            uploader_logger.info(f"Uploading {torrent_path.name}")
-            s3_storage.upload_file(fpath=str(torrent_path), key=torrent_path.name)
-            uploader_logger.info(".. uploaded")
-            torrent_path.unlink()
+        # get checksums (torrent pieces and S3 ETag are computed in the same
+        # read so we never hash the image again). With PIPELINED_UPLOAD, this is
+        # done from the uploader's reads: a single pass over the (built) image
+        digests = None
+        if not self.has_checksum:
+            if Setting.pipelined_upload:
+                digests = self.get_image_digests()
+            else:
+                uploader_logger.info(f"Computing digests for {self.artifact_path.name}")
+                self.compute_digests(output=uploader_log)
 
         # upload
-        uploader_logger.info(f"Uploading to {self.img_path.name}")
+        uploader_logger.info(
+            f"Uploading to {self.artifact_path.name}"
+            + (" (computing digests along)" if digests else "")
+        )
+        uploader = MultipartUploader(
+            s3_storage=s3_storage,
+            fpath=self.artifact_path,
+            key=self.artifact_path.name,
+            state_path=self.upload_state_path,
+            part_size=Setting.s3_part_size,
+            concurrency=Setting.s3_concurrency,
+            bandwidth=Setting.s3_bandwidth,
+            callback=ImageTransferHook(output=uploader_log, fpath=self.artifact_path),
+            should_stop=lambda: self.canceled,
+            on_read=digests.update if digests else None,
+            metadata={
+                "task_id": self.task["_id"],
+                "image": self.extra.get("image"),
+                "uploader_log": str(self.uploader_log_path),
+            },
+        )
+        uploader_logger.debug(
+            f"using {uploader.nb_parts} parts of {uploader.part_size}b "
+            f"with {uploader.concurrency} threads"
+        )
         try:
-            hook = ImageTransferHook(output=uploader_log, fpath=self.img_path)
-            s3_storage.upload_file(
-                fpath=str(self.img_path), key=self.img_path.name, Callback=hook
-            )
+            etag = uploader.upload()
             uploaded = True
         except Exception as exc:
             uploaded = False
+            if isinstance(exc, UploadInterrupted) and self.suspended:
+                uploader_logger.info("uploader suspended (will resume)")
+                self.close_uploader_log(uploader_logger, uploader_handler, uploader_log)
+                raise
+            uploader.abort()
             uploader_logger.error(f"uploader failed: {exc}")
             uploader_logger.exception(exc)
         else:
             uploader_logger.info("uploader ran successfuly.")
+            if digests:
+                self.record_digests(digests.finalize())
+            self.check_etag(etag, uploader_logger)
+
+        # torrent (uses pieces hashed along with checksum)
+        dl_url = urllib.parse.urlparse(self.task["download_uri"])
+        upload_torrent = uploaded and "torrent" in dl_url.scheme
+
+        if upload_torrent:
+            try:
+                torrent_path = self.upload_torrent(s3_storage, uploader_logger)
+            except Exception as exc:
+                uploaded = upload_torrent = False
+                uploader_logger.error(f"torrent failed: {exc}")
+                uploader_logger.exception(exc)
+
+        # map of data extents, for downloaders/writers to skip holes
+        upload_sparse_map = uploaded and Setting.sparse_map and not self.compression
+        if upload_sparse_map:
+            try:
+                sparse_map_path = self.upload_sparse_map(s3_storage, uploader_logger)
+            except Exception as exc:
+                # image is usable without it
+                upload_sparse_map = False
+                uploader_logger.error(f"sparse map failed: {exc}")
+                uploader_logger.exception(exc)
 
         # setting autodelete
         try:
@@ -340,7 +562,9 @@ class CreateTask(threading.Thread):
                 days=max([2, self.task["media_duration"]])
             )
             uploader_logger.info(f"Setting autodelete to {expire_on}")
-            s3_storage.set_object_autodelete_on(key=self.img_path.name, on=expire_on)
+            s3_storage.set_object_autodelete_on(
+                key=self.artifact_path.name, on=expire_on
+            )
         except Exception as exc:
             uploader_logger.error("Failed to set autodelete")
             uploader_logger.exception(exc)
@@ -353,17 +577,22 @@ class CreateTask(threading.Thread):
                 uploader_logger.error("Failed to set autodelete on torrent")
                 uploader_logger.exception(exc)
 
-        self.logger.info("collecting uploader log")
-        try:
-            self.logs["uploader_log"] = uploader_log.getvalue()
-            uploader_log.close()
-        except Exception as exc:
-            self.logger.error(f"Failed to collect logs: {exc}")
+        if upload_sparse_map:
+            try:
+                uploader_logger.info(f"Setting sparse map autodelete to {expire_on}")
+                s3_storage.set_object_autodelete_on(
+                    key=sparse_map_path.name, on=expire_on
+                )
+            except Exception as exc:
+                uploader_logger.error("Failed to set autodelete on sparse map")
+                uploader_logger.exception(exc)
+
+        self.close_uploader_log(uploader_logger, uploader_handler, uploader_log)
 
         # remove image
         try:
-            self.logger.info("removing image file: {}".format(self.img_path.name))
-            self.img_path.unlink()
+            self.logger.info("removing image file: {}".format(self.artifact_path.name))
+            self.artifact_path.unlink()
         except Exception as exp:
             self.logger.error("Unable to remove image file: {}".format(exp))
             self.logger.exception(exp)
@@ -371,9 +600,99 @@ class CreateTask(threading.Thread):
         if not uploaded:
             raise subprocess.SubprocessError("S3 upload failed")
 
+    def upload_torrent(self, s3_storage, uploader_logger):
+        """create and upload image's torrent. returns its path"""
+        parts = list(urllib.parse.urlsplit(self.task["download_uri"]))
+        parts[0] = parts[0].replace("+torrent", "")
+        dl_url = urllib.parse.urlparse(urllib.parse.urlunsplit(parts))
+
+        uploader_logger.info(f"Creating torrent file for {self.artifact_path.name}")
+        torrent_path = self.artifact_path.with_suffix(
+            f"{self.artifact_path.suffix}.torrent"
+        )
+        download_url = f"{dl_url.geturl()}/{self.artifact_path.name}"
+        torrent = torf.Torrent(
+            path=self.artifact_path,
+            trackers=[
+                "https://opentracker.xyz:443/announce",
+                "http://torrent.nwps.ws:80/announce",
+                "udp://tracker.open-internet.nl:6969/announce",
+                "udp://tracker.coppersurfer.tk:6969/announce",
+                "udp://tracker.openbittorrent.com:80/announce",
+            ],
+            webseeds=[download_url],
+        )
+        if self.digests and self.digests.piece_size == torrent.piece_size:
+            # reuse pieces hashed along with checksum
+            torrent.metainfo["info"]["pieces"] = b"".join(self.digests.pieces)
+        else:
+            torrent.generate(
+                threads=Setting.hash_threads,
+                callback=lambda torrent, path, done, total: uploader_logger.info(
+                    f"hashed {done}/{total} pieces"
+                ),
+                interval=10,
+            )
+        torrent.write(torrent_path)
+        uploader_logger.info(f".. created {torrent_path.name}")
+        # recorded so scheduler doesn't have to fetch the torrent for its magnet
+        self.extra["image"]["torrent"] = {
+            "infohash": torrent.infohash,
+            "magnet": str(torrent.magnet()),
+        }
+
+        uploader_logger.info(f"Uploading {torrent_path.name}")
+        s3_storage.upload_file(fpath=str(torrent_path), key=torrent_path.name)
+        uploader_logger.info(".. uploaded")
+        torrent_path.unlink()
+        return torrent_path
+
+    def upload_sparse_map(self, s3_storage, uploader_logger):
+        """create and upload image's extents map. returns its path"""
+        sparse_map_path = self.artifact_path.with_suffix(
+            f"{self.artifact_path.suffix}.extents.json"
+        )
+        extents = (self.digests and self.digests.extents) or get_extents(
+            self.artifact_path
+        )
+        write_extents_map(extents, self.artifact_path.stat().st_size, sparse_map_path)
+        uploader_logger.info(
+            f".. created {sparse_map_path.name} "
+            f"({get_data_size(extents)}b of data in {len(extents)} extents)"
+        )
+
+        uploader_logger.info(f"Uploading {sparse_map_path.name}")
+        s3_storage.upload_file(fpath=str(sparse_map_path), key=sparse_map_path.name)
+        uploader_logger.info(".. uploaded")
+        sparse_map_path.unlink()
+        self.extra["image"]["sparse_map"] = sparse_map_path.name
+        return sparse_map_path
+
+    def close_uploader_log(self, uploader_logger, uploader_handler, uploader_log):
+        self.logger.info("collecting uploader log")
+        uploader_logger.removeHandler(uploader_handler)
+        try:
+            uploader_log.close()
+            self.log_tails["uploader_log"].close()
+        except Exception as exc:
+            self.logger.error(f"Failed to collect logs: {exc}")
+
+    def check_etag(self, etag, uploader_logger):
+        """compare uploaded object's ETag with the one computed locally"""
+        expected = (self.extra.get("image") or {}).get("etag")
+        if not expected:
+            return
+        if etag != expected:
+            uploader_logger.warning(f"ETag mismatch: {etag} on S3, {expected} locally")
+        else:
+            uploader_logger.info(f"ETag matches: {etag}")
+
     def upload_image_with_curl(self):
         self.logger.info("Starting curl upload")
 
+        if not self.has_checksum:
+            self.compute_digests()
+
         self.logger.info("re-authenticate to ensure token is still valid")
         authenticate(force=True)
 
@@ -398,7 +717,7 @@ class CreateTask(threading.Thread):
             "--user",
             "{user}:{passwd}".format(user=Setting.username, passwd=get_access_token()),
             "--upload-file",
-            str(self.img_path),
+            str(self.artifact_path),
             url,
         ]
 
@@ -406,48 +725,22 @@ class CreateTask(threading.Thread):
             args = args[0:1] + ["--proxy", Setting.proxy] + args[1:]
 
         log_args = args[:-4] + ["{}:xxxxx".format(Setting.username)] + args[-3:]
-        self.logger.info("Starting {args}\n".format(args=" ".join(log_args)))
-
-        self.logs["uploader_log"] = "{args}\n".format(args=" ".join(log_args))
-        log_fd = open(str(self.uploader_log_path), "w")
-        ps = subprocess.Popen(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
+        returncode = self.run_logged_process(
+            "uploader_log", args, self.uploader_log_path, log_args=log_args
         )
 
-        self.logger.info("uploader started: {}".format(ps))
-        while ps.poll() is None:
-            self.logs["uploader_log"] = self.read_log(self.uploader_log_path)
-
-            # kill upon request
-            if self.canceled:
-                self.logger.info("terminating uploader…")
-                ps.terminate()
-                ps.wait(10)
-                ps.kill()
-                ps.wait(10)
-                break
-
-        ps.wait(10)
-
-        if ps.returncode == 0:
+        if returncode == 0:
             self.logger.info("uploader ran successfuly.")
         else:
-            self.logger.error("uploader failed: {}".format(ps.returncode))
-
-        self.logger.info("collecting full terminated log")
-        self.logs["uploader_log"] = self.read_log(self.uploader_log_path)
+            self.logger.error("uploader failed: {}".format(returncode))
 
         # remove image
         try:
-            self.logger.info("removing image file: {}".format(self.img_path.name))
-            self.img_path.unlink()
+            self.logger.info("removing image file: {}".format(self.artifact_path.name))
+            self.artifact_path.unlink()
         except Exception as exp:
             self.logger.error("Unable to remove image file: {}".format(exp))
             self.logger.exception(exp)
 
-        if ps.returncode != 0:
-            raise subprocess.SubprocessError("uploader rc: {}".format(ps.returncode))
+        if returncode != 0:
+            raise subprocess.SubprocessError("uploader rc: {}".format(returncode))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import hashlib
+import logging
+import pathlib
+import threading
+import time
+import urllib.parse
+
+from . import ONE_MiB, stream
+from .scheduler import get_popular_content
+
+logger = logging.getLogger(__name__)
+
+
+class ContentCache:
+    """Worker-side store of popular files, fetched before tasks need them
+
+    image-creator's own cache (--cache-dir) only gets content on first use.
+    Files listed as popular by the manager are downloaded here in advance
+    and configs are rewritten to use them as local (file://) sources.
+
+    OCI images are pulled by image-creator from their registry and can't be
+    referenced locally: they're not warmed."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self.lock = threading.Lock()
+        self._in_use = {}  # url: nb of tasks using it
+
+    def path_for(self, url):
+        name = pathlib.Path(urllib.parse.urlparse(url).path).name
+        return self.root.joinpath(
+            "{}_{}".format(hashlib.sha1(url.encode("UTF-8")).hexdigest()[:16], name)
+        )
+
+    def has(self, url):
+        return self.path_for(url).exists()
+
+    def warm(self, items, max_size, should_stop=lambda: False):
+        """fetch missing files of (most popular first) items within max_size
+
+        files not part of the selection are removed unless in use"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        selected, total = set(), 0
+        for item in items:
+            if item.get("kind") != "file" or not item.get("url"):
+                continue
+            if total + item["size"] > max_size:
+                continue
+            selected.add(self.path_for(item["url"]))
+            total += item["size"]
+            if self.has(item["url"]):
+                continue
+            if should_stop():
+                return
+
+            fpath = self.path_for(item["url"])
+            tmp_path = fpath.with_name(f"{fpath.name}.part")
+            logger.info(f"warming cache with {item['url']}")
+            started_on = time.monotonic()
+            try:
+                stream(
+                    item["url"],
+                    tmp_path,
+                    callback=lambda *args: None,
+                    block_size=ONE_MiB,
+                )
+            except Exception as exc:
+                logger.error(f"failed to fetch {item['url']}: {exc}")
+                tmp_path.unlink(missing_ok=True)
+                selected.discard(fpath)
+                continue
+            tmp_path.rename(fpath)
+            logger.info(
+                f".. fetched {item['size']}b in {time.monotonic() - started_on:.0f}s"
+            )
+
+        with self.lock:
+            in_use = {self.path_for(url) for url in self._in_use}
+            for fpath in self.root.iterdir():
+                if fpath not in selected and fpath not in in_use:
+                    logger.info(f"evicting {fpath.name} from cache")
+                    fpath.unlink(missing_ok=True)
+
+    def apply(self, payload):
+        """rewrite payload's files to use warmed ones
+
+        returns URLs served from cache, to release() once used, and hit/miss
+        stats"""
+        served = []
+        stats = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0}
+        with self.lock:
+            for entry in payload.get("files") or []:
+                url = entry.get("url")
+                if not url or not url.startswith("http"):
+                    continue
+                size = entry.get("size") or 0
+                size = size if isinstance(size, int) and size > 0 else 0
+                if self.has(url):
+                    self._in_use[url] = self._in_use.get(url, 0) + 1
+                    served.append(url)
+                    entry["url"] = self.path_for(url).as_uri()
+                    stats["hits"] += 1
+                    stats["hit_bytes"] += size
+                else:
+                    stats["misses"] += 1
+                    stats["miss_bytes"] += size
+        return served, stats
+
+    def release(self, urls):
+        """mark URLs served by apply() as no longer used"""
+        with self.lock:
+            for url in urls:
+                if self._in_use.get(url, 0) > 1:
+                    self._in_use[url] -= 1
+                else:
+                    self._in_use.pop(url, None)
+
+
+class CacheWarmer(threading.Thread):
+    """Refreshes a ContentCache from scheduler's popular content periodically"""
+
+    def __init__(self, cache, max_size, interval):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.max_size = max_size
+        self.interval = interval
+        self._should_stop = threading.Event()
+
+    def stop(self):
+        self._should_stop.set()
+
+    def run(self):
+        while not self._should_stop.is_set():
+            try:
+                success, response = get_popular_content()
+                if success:
+                    self.cache.warm(
+                        response.get("items", []),
+                        self.max_size,
+                        should_stop=self._should_stop.is_set,
+                    )
+                else:
+                    logger.error(f"unable to get popular content: {response}")
+            except Exception as exc:
+                logger.error(f"failed to warm cache: {exc}")
+                logger.exception(exc)
+            self._should_stop.wait(self.interval)
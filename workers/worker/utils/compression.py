@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+try:
+    import pyzstd
+except ImportError:
+    # only required for warehouses requesting zstd compression
+    pyzstd = None
+
+from . import ONE_MiB
+from .digest import READ_SIZE, update_with_zeros
+from .sparse import get_extents
+
+# compression: suffix appended to image fname
+SUFFIXES = {"zstd": ".zst"}
+ZSTD_FRAME_SIZE = ONE_MiB * 64  # uncompressed bytes per seekable frame
+
+
+def get_suffix(compression):
+    if compression not in SUFFIXES:
+        raise ValueError(f"unsupported compression: {compression}")
+    return SUFFIXES[compression]
+
+
+def compress_zstd(src, dst, level=3, threads=0, callback=None):
+    """compress src into dst using the seekable zstd format
+
+    Frames of ZSTD_FRAME_SIZE allow random access (ranges, torrent pieces) in
+    the decompressed content. Holes of src are not read. `callback` is called
+    with the number of uncompressed bytes processed."""
+    if pyzstd is None:
+        raise RuntimeError("zstd compression requires the pyzstd module")
+    callback = callback or (lambda amount: None)
+    options = {
+        pyzstd.CParameter.compressionLevel: level,
+        pyzstd.CParameter.nbWorkers: threads,
+    }
+
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(src, "rb", buffering=0) as fh, pyzstd.SeekableZstdFile(
+        dst, "w", level_or_option=options, max_frame_content_size=ZSTD_FRAME_SIZE
+    ) as zfh:
+        for offset, length, is_data in get_extents(src):
+            if not is_data:
+                update_with_zeros(zfh.write, length)
+                callback(length)
+                continue
+            fh.seek(offset)
+            while length:
+                nb_read = fh.readinto(view[: min([length, READ_SIZE])])
+                if not nb_read:
+                    break
+                zfh.write(view[:nb_read])
+                callback(nb_read)
+                length -= nb_read
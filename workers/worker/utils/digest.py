@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import collections
+import functools
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import blake3
+except ImportError:
+    # optional faster digest
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    # optional faster digest
+    xxhash = None
+
+from . import ONE_MiB
+from .sparse import get_extents
+
+READ_SIZE = ONE_MiB * 8
+ZEROS = memoryview(bytes(READ_SIZE))
+logger = logging.getLogger(__name__)
+
+
+def get_hash_factory(name):
+    """hash constructor for a digest name (hashlib ones, blake3 or xxh3_*)"""
+    if name == "blake3":
+        if blake3 is None:
+            raise ValueError("blake3 digest requires the blake3 module")
+        return blake3.blake3
+    if name.startswith("xxh"):
+        if xxhash is None or not hasattr(xxhash, name):
+            raise ValueError(f"{name} digest requires the xxhash module")
+        return getattr(xxhash, name)
+    return lambda: hashlib.new(name)
+
+
+def update_with_zeros(update, length):
+    """call update with length zero bytes, in chunks of a shared buffer"""
+    while length:
+        chunk = min([length, len(ZEROS)])
+        update(ZEROS[:chunk])
+        length -= chunk
+
+
+@functools.lru_cache(maxsize=None)
+def get_zeros_digest(func, size):
+    """digest of size zero bytes (cached: holes are made of such blocks)"""
+    hasher = func()
+    update_with_zeros(hasher.update, size)
+    return hasher.digest()
+
+
+class BlockHasher:
+    """Hashes a stream in fixed-size blocks (torrent pieces, multipart parts)"""
+
+    def __init__(self, block_size, func=hashlib.sha1):
+        self.block_size = block_size
+        self.func = func
+        self.digests = []
+        self._hash = None
+        self._remaining = 0
+
+    def update(self, data: memoryview):
+        while len(data):
+            if self._hash is None:
+                self._hash = self.func()
+                self._remaining = self.block_size
+            chunk = data[: self._remaining]
+            self._hash.update(chunk)
+            self._remaining -= len(chunk)
+            data = data[len(chunk) :]
+            if not self._remaining:
+                self.digests.append(self._hash.digest())
+                self._hash = None
+
+    @property
+    def block_remaining(self):
+        """bytes missing to complete current block (0 if none started)"""
+        return self._remaining if self._hash is not None else 0
+
+    def add_digests(self, digests):
+        self.digests += digests
+
+    def update_zeros(self, length):
+        """same as update() with length zero bytes, full blocks not hashed"""
+        remaining = min([self.block_remaining, length])
+        update_with_zeros(self.update, remaining)
+        length -= remaining
+
+        nb_blocks, length = divmod(length, self.block_size)
+        if nb_blocks:
+            digest = get_zeros_digest(self.func, self.block_size)
+            self.add_digests([digest] * nb_blocks)
+        update_with_zeros(self.update, length)
+
+    def finalize(self):
+        """last (incomplete) block digest is added. returns digests"""
+        if self._hash is not None:
+            self.digests.append(self._hash.digest())
+            self._hash = None
+        return self.digests
+
+
+class ThreadedBlockHasher(BlockHasher):
+    """BlockHasher hashing complete blocks on executor's threads
+
+    hashlib releases the GIL while hashing large buffers so blocks are hashed
+    in parallel. Blocks are copied (callers reuse their buffer) and at most
+    `max_pending` of them wait for their digest."""
+
+    def __init__(self, block_size, func, executor, max_pending):
+        super().__init__(block_size, func)
+        self.executor = executor
+        self.max_pending = max_pending
+        self._block = bytearray()
+        self._pending = collections.deque()  # digests (or futures of), in order
+
+    def _digest(self, block):
+        return self.func(block).digest()
+
+    def _pop(self):
+        digest = self._pending.popleft()
+        self.digests.append(digest if isinstance(digest, bytes) else digest.result())
+
+    def _submit(self):
+        self._pending.append(self.executor.submit(self._digest, self._block))
+        self._block = bytearray()
+        while len(self._pending) > self.max_pending:
+            self._pop()
+
+    @property
+    def block_remaining(self):
+        return self.block_size - len(self._block) if self._block else 0
+
+    def add_digests(self, digests):
+        self._pending += digests
+
+    def update(self, data: memoryview):
+        while len(data):
+            chunk = data[: self.block_size - len(self._block)]
+            self._block += chunk
+            data = data[len(chunk) :]
+            if len(self._block) == self.block_size:
+                self._submit()
+
+    def finalize(self):
+        if self._block:
+            self._submit()
+        while self._pending:
+            self._pop()
+        return self.digests
+
+
+class ImageDigests:
+    """Every checksum we need about an image, computed in a single read pass
+
+    - `md5`: hex digest of the whole file (our `checksum`)
+    - `etag`: S3 ETag of the file once uploaded in parts of `part_size`
+    - `pieces`: SHA-1 digests of each `piece_size` torrent piece
+    - `extra`: hex digests of requested additional algorithms
+
+    Either `compute()` reads the file or content is fed (in order) via
+    `update()` by another reader (uploader) then `finalize()` is called.
+    `compute()` doesn't read holes of sparse files and reuses digests of
+    zero pieces and parts: only md5 and extra digests have to hash zeros.
+
+    md5 and extra digests are sequential by nature but pieces and parts
+    are hashed by `threads` threads when more than one."""
+
+    def __init__(
+        self,
+        fpath,
+        piece_size,
+        part_size,
+        multipart_threshold,
+        extra=None,
+        threads=1,
+        callback=None,
+    ):
+        self.fpath = fpath
+        self.piece_size = piece_size
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.extra_names = list(extra or [])
+        self.callback = callback or (lambda amount: None)  # called w/ bytes hashed
+
+        self.size = 0
+        self.extents = []  # (offset, length, is_data) when computed
+        self.md5 = None
+        self.etag = None
+        self.pieces = []
+        self.extra = {}
+
+        self._md5 = hashlib.md5()
+        self._extra = {name: get_hash_factory(name)() for name in self.extra_names}
+        if threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+            self._parts = ThreadedBlockHasher(
+                self.part_size, hashlib.md5, self._executor, threads
+            )
+            self._pieces = ThreadedBlockHasher(
+                self.piece_size, hashlib.sha1, self._executor, threads
+            )
+        else:
+            self._executor = None
+            self._parts = BlockHasher(self.part_size, hashlib.md5)
+            self._pieces = BlockHasher(self.piece_size, hashlib.sha1)
+
+    def update(self, data):
+        """hash next bytes of the file"""
+        data = memoryview(data)
+        self._md5.update(data)
+        for hasher in self._extra.values():
+            hasher.update(data)
+        self._parts.update(data)
+        self._pieces.update(data)
+        self.size += len(data)
+        self.callback(len(data))
+
+    def update_zeros(self, length):
+        """same as update() with length zero bytes, without reading them"""
+        update_with_zeros(self._md5.update, length)
+        for hasher in self._extra.values():
+            update_with_zeros(hasher.update, length)
+        self._parts.update_zeros(length)
+        self._pieces.update_zeros(length)
+        self.size += length
+        self.callback(length)
+
+    def finalize(self):
+        """compute digests from all data hashed"""
+        self.md5 = self._md5.hexdigest()
+        self.extra = {name: hasher.hexdigest() for name, hasher in self._extra.items()}
+        self.pieces = self._pieces.finalize()
+        parts_digests = self._parts.finalize()
+        if self._executor:
+            self._executor.shutdown()
+        if self.size < self.multipart_threshold:
+            self.etag = self.md5
+        else:
+            self.etag = "{}-{}".format(
+                hashlib.md5(b"".join(parts_digests)).hexdigest(), len(parts_digests)
+            )
+        return self
+
+    def compute(self, read_size=READ_SIZE):
+        # single buffer reused for every read
+        buffer = bytearray(read_size)
+        view = memoryview(buffer)
+        self.extents = get_extents(self.fpath)
+        with open(self.fpath, "rb", buffering=0) as fh:
+            for offset, length, is_data in self.extents:
+                if not is_data:
+                    self.update_zeros(length)
+                    continue
+                fh.seek(offset)
+                while length:
+                    nb_read = fh.readinto(view[: min([length, read_size])])
+                    if not nb_read:  # file shrunk (shouldn't happen)
+                        break
+                    self.update(view[:nb_read])
+                    length -= nb_read
+        return self.finalize()
+
+    @property
+    def checksum(self):
+        """hashname:digest as stored in scheduler"""
+        return f"md5:{self.md5}"
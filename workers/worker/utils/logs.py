@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import threading
+
+from .setting import Setting
+
+
+class LogTail:
+    """Incrementally follows a log file written to by a subprocess or handler
+
+    Only bytes appended since the previous read are read (offset-tracked) and
+    kept in a buffer bounded to `max_size` bytes (oldest content is dropped).
+    Reads happen on demand so it's safe to query from another thread."""
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size or Setting.log_buffer_size
+        self.offset = 0  # number of bytes read from file so far
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.closed = False
+        self._fh = None
+
+    def __repr__(self):
+        return f"LogTail({self.path}, offset={self.offset})"
+
+    @property
+    def buffer_start(self):
+        """offset in file of the first byte of buffer"""
+        return self.offset - len(self.buffer)
+
+    def read(self):
+        """read new bytes from file into buffer. returns nb of new bytes"""
+        with self.lock:
+            if self.closed:
+                return 0
+            if self._fh is None:
+                try:
+                    self._fh = open(self.path, "rb")
+                except FileNotFoundError:
+                    return 0
+
+            size = os.fstat(self._fh.fileno()).st_size
+            if size - self.offset > self.max_size:
+                # skip what would not fit in buffer anyway
+                self.buffer.clear()
+                self.offset = size - self.max_size
+                self._fh.seek(self.offset)
+
+            data = self._fh.read(size - self.offset)
+            self.offset += len(data)
+            self.buffer += data
+            if len(self.buffer) > self.max_size:
+                del self.buffer[: len(self.buffer) - self.max_size]
+            return len(data)
+
+    def getvalue(self):
+        """text content of (bounded) buffer, after reading new bytes"""
+        self.read()
+        with self.lock:
+            return self.buffer.decode("utf-8", errors="replace")
+
+    def read_all(self):
+        """text of whole log: file if still there, (bounded) buffer otherwise"""
+        try:
+            with open(self.path, "rb") as fh:
+                return fh.read().decode("utf-8", errors="replace")
+        except OSError:
+            return self.getvalue()
+
+    def get_chunk(self, offset, size):
+        """(start, data) of up to size bytes of log from offset
+
+        Data comes from buffer or file if offset is before buffer. If that
+        content is not available anymore, start is moved to buffer_start.
+        Data never ends with an incomplete UTF-8 sequence unless closed."""
+        self.read()
+        with self.lock:
+            start = max([offset, 0])
+            if start >= self.buffer_start:
+                index = start - self.buffer_start
+                data = bytes(self.buffer[index : index + size])
+            else:
+                try:
+                    with open(self.path, "rb") as fh:
+                        fh.seek(start)
+                        data = fh.read(min([size, self.offset - start]))
+                except OSError:
+                    start = self.buffer_start
+                    data = bytes(self.buffer[:size])
+            closed = self.closed
+
+        if not closed:
+            data = data[: len(data) - get_incomplete_suffix_len(data)]
+        return start, data
+
+    def close(self):
+        """read remaining bytes and release file. buffer is still readable"""
+        self.read()
+        with self.lock:
+            self.closed = True
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def get_incomplete_suffix_len(data: bytes) -> int:
+    """number of bytes at end of data that are an incomplete UTF-8 sequence"""
+    for index in range(1, min([len(data), 3]) + 1):
+        byte = data[-index]
+        if byte & 0xC0 != 0x80:  # not a continuation byte
+            # lead byte announcing more bytes than available
+            if byte >= 0xF0:
+                expected = 4
+            elif byte >= 0xE0:
+                expected = 3
+            elif byte >= 0xC0:
+                expected = 2
+            else:
+                expected = 1
+            return index if expected > index else 0
+    return 0
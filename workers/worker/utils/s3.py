@@ -2,10 +2,287 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import json
+import logging
+import math
+import os
+import pathlib
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from kiwixstorage import TransferHook
 
+from . import ONE_MiB
+
+DEFAULT_PART_SIZE = ONE_MiB * 8  # boto3's default
+MAX_PARTS = 10000  # S3 limit of parts per multipart upload
+logger = logging.getLogger(__name__)
+
+
+def get_part_size(size, part_size=DEFAULT_PART_SIZE):
+    """multipart part size for a size-bytes upload (adjusted like boto3 does)"""
+    while math.ceil(size / part_size) > MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+
+class UploadInterrupted(Exception):
+    pass
+
+
+class BandwidthLimiter:
+    """Caps throughput of threads sharing it to rate bytes/s (0 is unlimited)
+
+    Each consumer reserves the time its amount takes at rate and sleeps until
+    its reservation starts, so the cap is met on average over parts."""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max([now, self.next_at])
+            self.next_at = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class MultipartUploader:
+    """Parallel and resumable multipart upload of a file to S3
+
+    Parts are uploaded by `concurrency` threads. Upload ID and completed parts
+    are saved to `state_path` after each part so that an interrupted upload
+    (worker restart) can be continued by a new instance instead of restarted.
+    Files smaller than `part_size` are sent in a single request.
+
+    File is read sequentially (once) and each part handed to `on_read`, in
+    order, before being uploaded (parts already uploaded when resuming are
+    read too) so caller can process content without reading it again.
+    `metadata` is saved along the state so caller can resume from it."""
+
+    def __init__(
+        self,
+        s3_storage,
+        fpath,
+        key,
+        state_path,
+        part_size=DEFAULT_PART_SIZE,
+        concurrency=10,
+        bandwidth=0,
+        callback=None,
+        should_stop=None,
+        on_read=None,
+        metadata=None,
+    ):
+        self.s3_storage = s3_storage
+        self.fpath = pathlib.Path(fpath)
+        self.key = key
+        self.state_path = pathlib.Path(state_path)
+        self.size = self.fpath.stat().st_size
+        self.part_size = get_part_size(self.size, part_size)
+        self.concurrency = max([concurrency, 1])
+        self.limiter = BandwidthLimiter(bandwidth)
+        self.callback = callback or (lambda amount: None)
+        self.should_stop = should_stop or (lambda: False)
+        self.on_read = on_read
+        self.metadata = metadata or {}
+
+        self.upload_id = None
+        self.parts = {}  # part number: etag
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self.s3_storage.client
+
+    @property
+    def bucket_name(self):
+        return self.s3_storage.bucket_name
+
+    @property
+    def nb_parts(self):
+        return math.ceil(self.size / self.part_size)
+
+    def get_part_range(self, number):
+        """(offset, size) of part number (starts at 1)"""
+        offset = (number - 1) * self.part_size
+        return offset, min([self.part_size, self.size - offset])
+
+    @staticmethod
+    def read_state(state_path):
+        """state dict saved at state_path or None"""
+        try:
+            with open(state_path, "r") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self):
+        with self.lock:
+            state = {
+                "fpath": str(self.fpath),
+                "key": self.key,
+                "size": self.size,
+                "mtime": self.fpath.stat().st_mtime,
+                "part_size": self.part_size,
+                "upload_id": self.upload_id,
+                "parts": self.parts,
+                "metadata": self.metadata,
+            }
+            # write then rename so a crash never leaves a truncated state
+            tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+            with open(tmp_path, "w") as fh:
+                json.dump(state, fh)
+            os.replace(tmp_path, self.state_path)
+
+    def remove_state(self):
+        self.state_path.unlink(missing_ok=True)
+
+    def load_state(self):
+        """restore upload ID and parts from a matching saved state"""
+        state = self.read_state(self.state_path)
+        if not state:
+            return False
+        if (
+            state.get("key") != self.key
+            or state.get("size") != self.size
+            or state.get("mtime") != self.fpath.stat().st_mtime
+            or state.get("part_size") != self.part_size
+        ):
+            logger.warning(f"discarding outdated upload state for {self.key}")
+            return False
+
+        # only trust parts S3 has (and has the same etag for)
+        try:
+            uploaded = {}
+            paginator = self.client.get_paginator("list_parts")
+            for page in paginator.paginate(
+                Bucket=self.bucket_name, Key=self.key, UploadId=state["upload_id"]
+            ):
+                for part in page.get("Parts", []):
+                    uploaded[str(part["PartNumber"])] = part["ETag"]
+        except Exception as exc:
+            logger.warning(f"unable to resume upload {state['upload_id']}: {exc}")
+            return False
+
+        self.upload_id = state["upload_id"]
+        self.parts = {
+            int(number): etag
+            for number, etag in state["parts"].items()
+            if uploaded.get(number) == etag
+        }
+        return True
+
+    def upload_part(self, number, data):
+        if self.should_stop():
+            raise UploadInterrupted(f"upload of {self.key} interrupted")
+        size = len(data)
+        self.limiter.consume(size)
+        resp = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        with self.lock:
+            self.parts[number] = resp["ETag"]
+        self.save_state()
+        self.callback(size)
+
+    def upload(self):
+        """upload file (resuming from state if possible). returns ETag"""
+        if self.size < self.part_size:
+            data = self.fpath.read_bytes()
+            if self.on_read:
+                self.on_read(data)
+            self.limiter.consume(self.size)
+            resp = self.client.put_object(
+                Bucket=self.bucket_name, Key=self.key, Body=data
+            )
+            self.callback(self.size)
+            return resp["ETag"].strip('"')
+
+        if self.load_state():
+            logger.info(
+                f"resuming upload {self.upload_id}: "
+                f"{len(self.parts)}/{self.nb_parts} parts already uploaded"
+            )
+            self.callback(sum(self.get_part_range(n)[1] for n in self.parts))
+        else:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key
+            )["UploadId"]
+            self.parts = {}
+            self.save_state()
+
+        # at most `concurrency` parts read and waiting for/being uploaded
+        in_flight = threading.BoundedSemaphore(self.concurrency)
+        futures = []
+        with open(self.fpath, "rb", buffering=0) as fh, ThreadPoolExecutor(
+            max_workers=self.concurrency
+        ) as executor:
+            try:
+                for number in range(1, self.nb_parts + 1):
+                    if number in self.parts and self.on_read is None:
+                        continue
+                    if self.should_stop():
+                        raise UploadInterrupted(f"upload of {self.key} interrupted")
+                    offset, size = self.get_part_range(number)
+                    in_flight.acquire()
+                    fh.seek(offset)
+                    data = fh.read(size)
+                    if self.on_read:
+                        self.on_read(data)
+                    if number in self.parts:
+                        in_flight.release()
+                        continue
+                    future = executor.submit(self.upload_part, number, data)
+                    future.add_done_callback(lambda future: in_flight.release())
+                    futures.append(future)
+
+                    # raise failures early (also drops done futures)
+                    for future in [future for future in futures if future.done()]:
+                        future.result()
+                        futures.remove(future)
+
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+
+        resp = self.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": self.parts[number]}
+                    for number in sorted(self.parts)
+                ]
+            },
+        )
+        self.remove_state()
+        return resp["ETag"].strip('"')
+
+    def abort(self):
+        """cancel multipart upload on S3 (parts are dropped) and forget state"""
+        if self.upload_id:
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+                )
+            except Exception as exc:
+                logger.warning(f"unable to abort upload {self.upload_id}: {exc}")
+        self.remove_state()
+
 
 class ImageTransferHook(TransferHook):
     def __init__(self, output, fpath=None, size=None, name=""):
@@ -34,9 +311,10 @@ class ImageTransferHook(TransferHook):
 
     def __call__(self, bytes_amount):
         # only print if we've seen the interval bytes since last print
-        if self.seen_so_far + bytes_amount >= self.printed + self.print_interval:
-            with self.lock:
+        # (called from several transfer threads: check and update atomically)
+        with self.lock:
+            if self.seen_so_far + bytes_amount >= self.printed + self.print_interval:
                 super().__call__(bytes_amount)
-            self.printed = self.seen_so_far
-        else:
-            self.seen_so_far += bytes_amount
+                self.printed = self.seen_so_far
+            else:
+                self.seen_so_far += bytes_amount
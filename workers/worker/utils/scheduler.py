@@ -1,8 +1,14 @@
+import re
 import json
+import base64
+import time
 import logging
 import datetime
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .setting import Setting
 
@@ -15,6 +21,9 @@ ACCESS_TOKEN_EXPIRY = datetime.datetime(1970, 1, 1)
 REFRESH_TOKEN = None
 REFRESH_TOKEN_EXPIRY = None
 WORKER_TYPE = "creator"
+SESSION = None
+SESSION_LOCK = threading.Lock()
+TIMINGS = {}  # "METHOD /path": Histogram
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +32,94 @@ class SchedulerAPIError(Exception):
     pass
 
 
+class Histogram:
+    """request durations distribution (seconds), prometheus-style buckets"""
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, duration):
+        for index, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += duration
+        self.max = max([self.max, duration])
+
+    def percentile(self, ratio):
+        """upper bound of the bucket holding that percentile"""
+        target, seen = self.count * ratio, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min([bound, self.max])
+        return self.max
+
+    def __str__(self):
+        if not self.count:
+            return "n=0"
+        return "n={} avg={:.3f}s p50<={:.3f}s p95<={:.3f}s max={:.3f}s".format(
+            self.count,
+            self.sum / self.count,
+            self.percentile(0.5),
+            self.percentile(0.95),
+            self.max,
+        )
+
+
+def get_session():
+    """process-wide keep-alive session to scheduler, shared by all threads
+
+    connection errors are retried with backoff for all methods (request was
+    not sent) ; gateway errors only for idempotent ones"""
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            retries = Retry(
+                total=Setting.api_retries,
+                connect=Setting.api_retries,
+                read=Setting.api_retries,
+                status=Setting.api_retries,
+                backoff_factor=1,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                max_retries=retries,
+                pool_connections=1,
+                pool_maxsize=Setting.nb_slots * 2 + 2,  # tasks, main loop, warmer
+            )
+            SESSION = requests.Session()
+            SESSION.mount("http://", adapter)
+            SESSION.mount("https://", adapter)
+        return SESSION
+
+
+def record_timing(method, path, duration):
+    # group requests by endpoint, not by task
+    key = "{} {}".format(method, re.sub(r"[0-9a-f]{24}", "{id}", path.split("?")[0]))
+    with SESSION_LOCK:
+        TIMINGS.setdefault(key, Histogram()).observe(duration)
+
+
+def get_timings_summary():
+    """one line per endpoint, most called first"""
+    with SESSION_LOCK:
+        return [
+            f"{key}: {histogram}"
+            for key, histogram in sorted(
+                TIMINGS.items(), key=lambda item: item[1].count, reverse=True
+            )
+        ]
+
+
 def get_url(path):
     return "/".join([Setting.api_url, path[1:] if path[0] == "/" else path])
 
@@ -33,14 +130,17 @@ def get_access_token():
 
 
 def get_token(username, password):
-    req = requests.post(
+    started_on = time.monotonic()
+    req = get_session().post(
         url=get_url("/auth/authorize"),
         headers={
             "username": username,
             "password": password,
             "Content-type": "application/json",
         },
+        timeout=Setting.api_timeout,
     )
+    record_timing(POST, "/auth/authorize", time.monotonic() - started_on)
     req.raise_for_status()
     return req.json().get("access_token"), req.json().get("refresh_token")
 
@@ -84,19 +184,24 @@ def get_token_headers():
 
 
 @auth_required
-def query_api(method, path, payload=None):
+def query_api(method, path, payload=None, params=None, reauth=True, timeout=None):
+    started_on = time.monotonic()
     try:
-        req = getattr(requests, method.lower(), requests.get)(
+        req = get_session().request(
+            method=method,
             url=get_url(path),
             headers=get_token_headers(),
             json=payload,
-            timeout=30,
+            params=params,
+            timeout=timeout or Setting.api_timeout,
         )
     except Exception as exp:
         import traceback
 
         print(traceback.format_exc())
         return (False, "ConnectionError", "ConnectionErrorL -- {}".format(exp))
+    finally:
+        record_timing(method, path, time.monotonic() - started_on)
 
     try:
         resp = req.json() if req.text else {}
@@ -119,22 +224,25 @@ def query_api(method, path, payload=None):
     # Unauthorised error: attempt to re-auth as scheduler might have restarted?
     if req.status_code == 401:
         authenticate(True)
+        if reauth and ACCESS_TOKEN:
+            return query_api(
+                method, path, payload, params, reauth=False, timeout=timeout
+            )
 
     return (False, req.status_code, resp["error"] if "error" in resp else str(resp))
 
 
-@auth_required
 def test_connection():
     return query_api(GET, "/")
 
 
-@auth_required
 def get_available_tasks(slot=None):
-    success, code, response = query_api(GET, "/tasks/{}".format(WORKER_TYPE))
+    success, code, response = query_api(
+        GET, "/tasks/{}".format(WORKER_TYPE), params={"slot": slot}
+    )
     return success, response
 
 
-@auth_required
 def get_task(task_id):
     success, code, response = query_api(
         GET, "/tasks/{type}/{id}".format(type=WORKER_TYPE, id=task_id)
@@ -142,15 +250,52 @@ def get_task(task_id):
     return success, response
 
 
-@auth_required
-def request_task(task_id):
+def poll_tasks(watch, want_tasks, slot=None, timeout=20, max_size=None):
+    """long-poll scheduler until tasks are available or a watched one changes
+
+    watch is {task_id: status as we know it}. only tasks of at most max_size
+    (GB) count as available. returns code as well so
+    callers can tell an older scheduler (404) from a failure"""
+    success, code, response = query_api(
+        GET,
+        "/tasks/{}/poll".format(WORKER_TYPE),
+        params={
+            "tasks": int(want_tasks),
+            "watch": ",".join(
+                "{}:{}".format(task_id, status or "")
+                for task_id, status in watch.items()
+            ),
+            "slot": slot,
+            "timeout": timeout,
+            "max_size": max_size,
+        },
+        timeout=timeout + Setting.api_timeout,
+    )
+    return success, code, response
+
+
+def claim_task(slot=None, max_size=None):
+    """atomically get the next task we can handle assigned to us
+
+    response is an empty dict if there's none. returns code as well so
+    callers can tell an older scheduler (405) from a failure"""
     success, code, response = query_api(
-        PATCH, "/tasks/{type}/{id}/request".format(type=WORKER_TYPE, id=task_id)
+        POST,
+        "/tasks/{}/claim".format(WORKER_TYPE),
+        params={"slot": slot, "max_size": max_size},
+    )
+    return success, code, response
+
+
+def request_task(task_id, slot=None):
+    success, code, response = query_api(
+        PATCH,
+        "/tasks/{type}/{id}/request".format(type=WORKER_TYPE, id=task_id),
+        params={"slot": slot},
     )
     return success, response
 
 
-@auth_required
 def update_task_status(task_id, status, log=None, extra={}):
     payload = {"status": status, "log": log, "extra": extra}
     success, code, response = query_api(
@@ -161,21 +306,42 @@ def update_task_status(task_id, status, log=None, extra={}):
     return success, response
 
 
-@auth_required
-def upload_logs(task_id, logs={}):
-    for key, value in logs.items():
-        if value is None:
-            del logs[key]
+def upload_logs(task_id, logs={}, slot=None):
+    """replace logs of task with (whole) logs. returns code as well"""
+    logs = {key: value for key, value in logs.items() if value is not None}
 
     success, code, response = query_api(
         POST,
         "/tasks/{type}/{id}/logs".format(type=WORKER_TYPE, id=task_id),
         payload=logs,
+        params={"slot": slot},
+    )
+    return success, code, response
+
+
+def append_log(task_id, kind, offset, data, slot=None):
+    """send data (bytes) of log from offset. response has offset to continue at
+
+    returns code as well so callers can tell an older scheduler (404/405)"""
+    payload = {
+        "kind": kind,
+        "offset": offset,
+        "data": base64.b64encode(data).decode("ascii"),
+    }
+    success, code, response = query_api(
+        POST,
+        "/tasks/{type}/{id}/logs/append".format(type=WORKER_TYPE, id=task_id),
+        payload=payload,
+        params={"slot": slot},
     )
+    return success, code, response
+
+
+def get_popular_content():
+    success, code, response = query_api(GET, "/workers/popular-content")
     return success, response
 
 
-@auth_required
 def send_sos(error):
     success, code, response = query_api(
         POST, "/workers/sos", payload={"error": error, "type": WORKER_TYPE}
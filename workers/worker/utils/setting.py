@@ -8,6 +8,8 @@ import os
 import sys
 from pathlib import Path
 
+import humanfriendly
+
 logger = logging.getLogger(__name__)
 
 
@@ -23,11 +25,37 @@ class Setting:
     imager_binary_path: Path = None
     curl_binary_path: Path = None
 
-    poll_interval = 10
+    poll_interval = 10  # when scheduler doesn't support long-polling
+    poll_timeout = 20  # max duration of a long-poll request
+    idle_poll_interval = 300  # safety poll of tasks despite long-polling
     log_upload_interval = 20
+    timings_interval = 3600  # seconds between logs of API requests timings
+    api_timeout: int = 30  # seconds per scheduler API request
+    api_retries: int = 3  # retries on connection and gateway errors
+    log_buffer_size: int = humanfriendly.parse_size("8MiB")  # per log kept in RAM
+    log_chunk_size: int = humanfriendly.parse_size("1MiB")  # max per log upload
+
+    nb_slots: int = 1  # number of tasks to run concurrently
+    min_free_space: int = humanfriendly.parse_size("10GiB")  # kept free on disks
+    max_load: float = 0.8  # per-core load above which we dont start more tasks
 
     s3_access_key = None
     s3_secret_key = None
+    s3_part_size: int = humanfriendly.parse_size("8MiB")  # multipart part size
+    s3_concurrency: int = 10  # parts uploaded in parallel
+    s3_bandwidth: int = 0  # upload cap in bytes/s (0 is unlimited)
+    # hash image from the upload's reads (single pass) instead of before it.
+    # upload still starts once image is built: it doesn't overlap image-creator
+    pipelined_upload: bool = False
+    hash_threads: int = os.cpu_count() or 1  # threads hashing pieces and parts
+    sparse_map: bool = False  # upload a map of image's data extents along
+    zstd_level: int = 3  # compression level for warehouses requesting zstd
+    zstd_threads: int = os.cpu_count() or 1  # zstd compression workers
+    cache_warm_dir: Path = None  # kept apart from image-creator's cache_dir
+    cache_warm_size: int = 0  # popular content fetched in advance (0 disables)
+    cache_warm_interval: int = 3600  # seconds between popular content refreshes
+
+    extra_digests: list = []  # digests computed in addition to md5 (blake3, xxh3_128)
 
     @classmethod
     def get_timer(cls, interval):
@@ -47,8 +75,47 @@ class Setting:
             "CARDSHOP_API_URL", "https://api.imager.kiwix.org"
         )
 
+        cls.poll_timeout = int(os.getenv("POLL_TIMEOUT", cls.poll_timeout))
+        cls.api_timeout = int(os.getenv("API_TIMEOUT", cls.api_timeout))
+        cls.api_retries = int(os.getenv("API_RETRIES", cls.api_retries))
+
         cls.s3_access_key = os.getenv("S3_ACCESS_KEY", cls.s3_access_key)
         cls.s3_secret_key = os.getenv("S3_SECRET_KEY", cls.s3_secret_key)
+        if os.getenv("S3_PART_SIZE"):
+            cls.s3_part_size = humanfriendly.parse_size(os.getenv("S3_PART_SIZE"))
+        cls.s3_concurrency = max(
+            [int(os.getenv("S3_CONCURRENCY", cls.s3_concurrency)), 1]
+        )
+        if os.getenv("S3_BANDWIDTH"):
+            cls.s3_bandwidth = humanfriendly.parse_size(os.getenv("S3_BANDWIDTH"))
+        cls.pipelined_upload = bool(os.getenv("PIPELINED_UPLOAD", False))
+        cls.hash_threads = max([int(os.getenv("HASH_THREADS", cls.hash_threads)), 1])
+        cls.sparse_map = bool(os.getenv("SPARSE_MAP", False))
+        cls.zstd_level = int(os.getenv("ZSTD_LEVEL", cls.zstd_level))
+        cls.zstd_threads = max([int(os.getenv("ZSTD_THREADS", cls.zstd_threads)), 1])
+        cls.cache_warm_dir = Path(
+            os.getenv("CACHE_WARM_DIR", cls.working_dir.joinpath("warm"))
+        ).resolve()
+        if os.getenv("CACHE_WARM_SIZE"):
+            cls.cache_warm_size = humanfriendly.parse_size(os.getenv("CACHE_WARM_SIZE"))
+        cls.cache_warm_interval = int(
+            os.getenv("CACHE_WARM_INTERVAL", cls.cache_warm_interval)
+        )
+
+        cls.extra_digests = [
+            name.strip()
+            for name in os.getenv("EXTRA_DIGESTS", "").split(",")
+            if name.strip()
+        ]
+
+        cls.nb_slots = max([int(os.getenv("NB_SLOTS", cls.nb_slots)), 1])
+        if os.getenv("MIN_FREE_SPACE"):
+            cls.min_free_space = humanfriendly.parse_size(os.getenv("MIN_FREE_SPACE"))
+        cls.max_load = float(os.getenv("MAX_LOAD", cls.max_load))
+        if os.getenv("LOG_BUFFER_SIZE"):
+            cls.log_buffer_size = humanfriendly.parse_size(os.getenv("LOG_BUFFER_SIZE"))
+        if os.getenv("LOG_CHUNK_SIZE"):
+            cls.log_chunk_size = humanfriendly.parse_size(os.getenv("LOG_CHUNK_SIZE"))
 
         logger.info("Checking Settings...")
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import errno
+import json
+import os
+
+
+def get_extents(fpath):
+    """[(offset, length, is_data)] covering whole file, holes being not is_data
+
+    Holes are found using SEEK_DATA/SEEK_HOLE. Should the platform or
+    filesystem not support it, the whole file is a single data extent."""
+    size = os.path.getsize(fpath)
+    if not size:
+        return []
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size, True)]
+
+    extents = []
+    with open(fpath, "rb") as fh:
+        fd = fh.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as exc:
+                if exc.errno != errno.ENXIO:  # not supported
+                    return [(0, size, True)]
+                data_start = size  # nothing but a hole until the end
+            if data_start > offset:
+                extents.append((offset, data_start - offset, False))
+            if data_start >= size:
+                break
+            hole_start = min([os.lseek(fd, data_start, os.SEEK_HOLE), size])
+            extents.append((data_start, hole_start - data_start, True))
+            offset = hole_start
+    return extents
+
+
+def get_data_size(extents):
+    """number of bytes in data extents"""
+    return sum([length for _, length, is_data in extents if is_data])
+
+
+def write_extents_map(extents, size, fpath):
+    """JSON map of data extents, for downloaders/writers to skip holes
+
+    {"size": <image size>, "data": [[offset, length], ...]}"""
+    with open(fpath, "w") as fh:
+        json.dump(
+            {
+                "size": size,
+                "data": [
+                    [offset, length] for offset, length, is_data in extents if is_data
+                ],
+            },
+            fh,
+        )